@@ -125,6 +125,9 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Responses from statsapi, dailyfaceoff, etc. are cached here (set to None to always download)
+HTTP_CACHE_DIR = os.path.join(BASE_DIR, 'cache/http')
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -0,0 +1,139 @@
+import logging
+import numpy as np
+import time
+import tracemalloc
+from integer_program import integer_program
+from knapsack import knapsack, brute_force, find_player_pair, find_player_triples, prune_dominated
+from player_pool import PlayerPool, position_codes
+
+__author__ = "jaredg"
+
+logger = logging.getLogger(__name__)
+
+# Skaters dressed by each team on a synthetic slate, and one starting goalie per team
+team_positions = {"C": 4, "W": 8, "D": 6}
+salary_ranges = {"C": (25, 90), "W": (25, 90), "D": (25, 80), "G": (65, 90)}
+salary_cap = 50000
+
+
+def get_limit(salary_divisor=100):
+    return salary_cap // salary_divisor
+
+
+def generate_slate(number_of_games, seed=0, salary_divisor=100):
+    # Random DraftKings style slate with values that roughly follow salary. Salaries are divided by salary_divisor,
+    # 100 as in get_player_data by default, smaller divisors add random dollars below the hundreds so the solvers see
+    # the finer salaries (the default slate stays the same for a seed)
+    random_state = np.random.RandomState(seed)
+    name_and_ids = []
+    codes = []
+    weights = []
+    for team in range(number_of_games * 2):
+        for position, number_of_players in list(team_positions.items()) + [("G", 1)]:
+            for player in range(number_of_players):
+                name_and_ids.append("Team" + str(team) + " " + position + str(player) + " (" + str(
+                    len(name_and_ids)) + ")")
+                codes.append(position_codes[position])
+                weights.append(random_state.randint(*salary_ranges[position]))
+
+    weights = np.array(weights)
+    values = np.round(weights / 15.0 + random_state.gamma(2.0, 0.6, len(weights)), 2)
+    if salary_divisor != 100:
+        dollars = np.random.RandomState(seed + 1).randint(0, 100, len(weights))
+        weights = (weights * 100 + dollars) // salary_divisor
+    pool = PlayerPool(name_and_ids, np.arange(len(weights)), codes, weights, values)
+    goalies = pool.get_position("G")
+    skaters = pool.subset(np.flatnonzero(pool.positions != position_codes["G"]))
+    return skaters, goalies
+
+
+def solve_with_best_util(solver):
+    # Same Util choice as calculate_lineups, the best value skater
+    def solve(skaters, goalies, limit):
+        skaters = skaters.sorted_by_value()
+        return solver(skaters.subset(slice(1, None)), goalies, skaters[0], limit)
+    return solve
+
+
+# Backends run by the benchmark, add new solvers here to have them tracked
+backends = {
+    "knapsack": solve_with_best_util(knapsack),
+    "knapsack_vectorized": solve_with_best_util(
+        lambda skaters, goalies, util, limit: knapsack(skaters, goalies, util, limit, vectorized=True)),
+    "knapsack_pruned": solve_with_best_util(
+        lambda skaters, goalies, util, limit: knapsack(skaters, goalies, util, limit, vectorized=True, prune=True)),
+    "knapsack_sparse": solve_with_best_util(
+        lambda skaters, goalies, util, limit: knapsack(skaters, goalies, util, limit, vectorized=True, sparse=True)),
+    "brute_force": solve_with_best_util(
+        lambda skaters, goalies, util, limit: brute_force(skaters, goalies, util, limit, number_of_sets=1,
+                                                          prune=True)),
+    "integer_program": integer_program,
+}
+
+
+def get_candidate_counts(skaters):
+    counts = {}
+    for position, find_sets in [("D", find_player_pair), ("C", find_player_pair), ("W", find_player_triples)]:
+        set_of_players = find_sets(skaters, position, vectorized=True)
+        counts[position] = len(set_of_players)
+        counts[position + "_pruned"] = len(prune_dominated(set_of_players))
+    return counts
+
+
+def run_backend(backend, skaters, goalies, limit):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        set_of_players = backends[backend](skaters, goalies, limit)
+        error = None
+    except Exception as e:
+        logging.error("Backend " + backend + " failed: " + str(e))
+        set_of_players = []
+        error = str(e)
+    wall_time = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best_set = max(set_of_players, key=lambda tup: tup[10]) if set_of_players else None
+    return {"backend": backend,
+            "wall_time": wall_time,
+            "peak_memory": peak_memory,
+            "weight": best_set[9] if best_set else None,
+            "value": best_set[10] if best_set else None,
+            "error": error}
+
+
+def run_benchmark(games, backend_names, repeat=1, seed=0, salary_divisor=100):
+    # One result per slate size and backend, the optimality gap is against the best value any backend found on the
+    # slate (the integer program is exact, so with it included the gap is to the true optimum)
+    limit = get_limit(salary_divisor)
+    results = []
+    for number_of_games in games:
+        skaters, goalies = generate_slate(number_of_games, seed, salary_divisor)
+        candidate_counts = get_candidate_counts(skaters)
+        logging.info("Benchmarking " + str(number_of_games) + " game slate with " + str(len(skaters)) + " skaters: " +
+                     str(candidate_counts))
+
+        slate_results = []
+        for backend in backend_names:
+            runs = [run_backend(backend, skaters, goalies, limit) for i in range(repeat)]
+            result = min(runs, key=lambda run: run['wall_time'])
+            result.update({"games": number_of_games,
+                           "skaters": len(skaters),
+                           "goalies": len(goalies),
+                           "seed": seed,
+                           "salary_divisor": salary_divisor,
+                           "repeat": repeat,
+                           "candidates": candidate_counts})
+            logging.info(result)
+            slate_results.append(result)
+
+        best_value = max([result['value'] for result in slate_results if result['value'] is not None], default=None)
+        for result in slate_results:
+            if result['value'] is not None and best_value:
+                result['optimality_gap'] = (best_value - result['value']) / best_value
+            else:
+                result['optimality_gap'] = None
+        results += slate_results
+
+    return results
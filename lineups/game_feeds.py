@@ -0,0 +1,93 @@
+import aiohttp
+import asyncio
+import logging
+import queue
+import threading
+
+__author__ = "jaredg"
+
+logger = logging.getLogger(__name__)
+
+statsapi_url = 'https://statsapi.web.nhl.com/api/v1'
+
+# Marks the end of the feeds put on the queue by the fetching thread
+end_of_feeds = object()
+
+
+def get_game_feed_url(game_pk, base_url=statsapi_url):
+    return base_url + '/game/' + str(game_pk) + '/feed/live'
+
+
+async def fetch_json(session, url, retries=3, backoff=0.5):
+    # Body of the JSON response as it was sent, so it can be cached byte for byte. Retry connection errors, timeouts
+    # and server errors, waiting backoff, 2 * backoff, 4 * backoff, ... seconds
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                return await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Client errors other than rate limiting won't change on a retry
+            client_error = isinstance(e, aiohttp.ClientResponseError) and e.status < 500 and e.status != 429
+            if attempt == retries or client_error:
+                logger.error("Could not fetch " + url + " after " + str(attempt + 1) + " attempts.")
+                logger.error("Got the following error:")
+                logger.error(e)
+                raise e
+            delay = backoff * 2 ** attempt
+            logger.warning("Retrying " + url + " in " + str(delay) + " seconds, got: " + str(e))
+            await asyncio.sleep(delay)
+
+
+async def fetch_game_feeds(game_pks, feeds, stopped, base_url=statsapi_url, concurrency=8, retries=3, backoff=0.5,
+                           timeout=60):
+    # Download the feeds at most concurrency at a time over one pooled session, each (game_pk, body) is put on the
+    # feeds queue as it arrives (waiting when the queue is full, so the downloads don't run far ahead of the writes)
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async def fetch_game_feed(game_pk):
+            # Retries keep their place, so the concurrency also bounds the load on the server while retrying
+            async with semaphore:
+                if stopped.is_set():
+                    return
+                body = await fetch_json(session, get_game_feed_url(game_pk, base_url), retries, backoff)
+            await loop.run_in_executor(None, feeds.put, (game_pk, body))
+
+        await asyncio.gather(*[fetch_game_feed(game_pk) for game_pk in game_pks])
+
+
+def iterate_game_feeds(game_pks, base_url=statsapi_url, concurrency=8, retries=3, backoff=0.5, timeout=60,
+                       max_queued=32):
+    # Yield (game_pk, body of the feed) in the order the downloads finish. The downloads run in an event loop on their own
+    # thread, so the caller stays the single (synchronous) consumer writing to the database.
+    feeds = queue.Queue(maxsize=max_queued)
+    stopped = threading.Event()
+
+    def run():
+        try:
+            asyncio.run(fetch_game_feeds(game_pks, feeds, stopped, base_url, concurrency, retries, backoff, timeout))
+            feeds.put(end_of_feeds)
+        except Exception as e:
+            feeds.put(e)
+
+    thread = threading.Thread(target=run, name="game-feeds", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = feeds.get()
+            if item is end_of_feeds:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Stop starting downloads if the consumer stops early, and let any waiting put through
+        stopped.set()
+        while thread.is_alive():
+            try:
+                feeds.get(timeout=0.1)
+            except queue.Empty:
+                pass
@@ -0,0 +1,41 @@
+__author__ = "jaredg"
+
+# Stats totalled in PlayerSeasonAggregate and PlayerDailyAggregate (along with the number of games)
+aggregate_fields = ['goals', 'assists', 'shots_on_goal', 'blocked_shots', 'short_handed_points', 'hat_tricks', 'wins',
+                    'saves', 'goals_against', 'shutouts', 'time_on_ice_seconds']
+
+# A goalie needs (almost) the whole game for a shutout, being pulled for an extra attacker at the end still counts
+shutout_seconds = 59 * 60 + 30
+
+
+def get_seconds(time):
+    # Seconds in a "MM:SS" time from the feeds (minutes can go past 60 in overtime), a plain number is minutes (penalty
+    # minutes)
+    if time is None or time == '':
+        return 0
+    if ':' not in str(time):
+        return int(time) * 60
+    minutes, seconds = str(time).split(':')
+    return int(minutes) * 60 + int(seconds)
+
+
+def is_aggregated_game(game):
+    # Regular season (02) and playoff (03) games, from the game type in the game PK
+    return game.game_pk // 10000 % 100 in (2, 3)
+
+
+def get_aggregate_values(pgs):
+    # What one PlayerGameStats row adds to its player's aggregates, also used by the migrations filling them
+    return {'games': 1,
+            'goals': pgs.goals,
+            'assists': pgs.assists,
+            'shots_on_goal': pgs.shots,
+            'blocked_shots': pgs.blocked,
+            'short_handed_points': pgs.short_handed_goals + pgs.short_handed_assists,
+            'hat_tricks': int(pgs.goals >= 3),
+            'wins': int(pgs.decision == 'W'),
+            'saves': pgs.saves,
+            'goals_against': pgs.shots_against - pgs.saves,
+            'shutouts': int(pgs.decision == 'W' and pgs.shots_against == pgs.saves and
+                            pgs.time_on_ice_seconds > shutout_seconds),
+            'time_on_ice_seconds': pgs.time_on_ice_seconds}
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+from django.conf import settings
+
+__author__ = "jaredg"
+
+logger = logging.getLogger('django')
+
+# Seconds a response stays fresh by the first pattern matching its URL, None is forever. Game feeds are only kept
+# forever once the game is final (see get_ttl), the other entries are how often each source changes during a day.
+ttl_rules = [
+    (re.compile(r'statsapi\.web\.nhl\.com/api/v1/game/\d+/feed/live'), 60),
+    (re.compile(r'statsapi\.web\.nhl\.com/api/v1/schedule'), 5 * 60),
+    (re.compile(r'statsapi\.web\.nhl\.com/api/v1/teams'), 24 * 60 * 60),
+    (re.compile(r'statsapi\.web\.nhl\.com/api/v1/people/'), 24 * 60 * 60),
+    (re.compile(r'suggest\.svc\.nhl\.com/'), 24 * 60 * 60),
+    (re.compile(r'nhl\.com/stats/rest/'), 60 * 60),
+    (re.compile(r'dailyfaceoff\.com/starting-goalies/'), 10 * 60),
+    (re.compile(r'dailyfaceoff\.com/teams'), 60 * 60),
+    (re.compile(r'vegasinsider\.com/'), 5 * 60),
+]
+default_ttl = 5 * 60
+game_feed_pattern = re.compile(r'/game/\d+/feed/live')
+
+# Fixture files captured responses are replayed from, by the first pattern matching the URL (the name is formatted
+# with the groups of the match, dates in the schedule URL are left out so a captured schedule replays on any day)
+fixture_rules = [
+    (re.compile(r'statsapi\.web\.nhl\.com/api/v1/game/(\d+)/feed/live'), 'feeds/{0}.json'),
+    (re.compile(r'statsapi\.web\.nhl\.com/api/v1/schedule'), 'schedule.json'),
+    (re.compile(r'statsapi\.web\.nhl\.com/api/v1/teams'), 'teams.json'),
+    (re.compile(r'statsapi\.web\.nhl\.com/api/v1/people/(\d+)'), 'people/{0}.json'),
+    (re.compile(r'suggest\.svc\.nhl\.com/svc/suggest/v1/minactiveplayers/([^/]+)/'), 'suggest/{0}.json'),
+    (re.compile(r'nhl\.com/stats/rest/grouped/team/basic/season/teamsummary\?cayenneExp=seasonId=(\d+)'),
+     'team_stats/{0}.json'),
+    (re.compile(r'dailyfaceoff\.com/starting-goalies/(\d+)/(\d+)/(\d+)/'), 'starting_goalies/{0}-{1}-{2}.html'),
+    (re.compile(r'dailyfaceoff\.com/teams/(.+?)/?$'), 'lines/{0}.html'),
+    (re.compile(r'dailyfaceoff\.com/teams/?$'), 'lines/teams.html'),
+    (re.compile(r'vegasinsider\.com/nhl/odds/'), 'odds.html'),
+]
+
+# While replay_dir is set every response comes from its fixture files and nothing is downloaded, while capture_dir is
+# set every response downloaded is also written there as a fixture (see set_fixture_dirs)
+replay_dir = None
+capture_dir = None
+
+
+def set_fixture_dirs(replay=None, capture=None):
+    global replay_dir, capture_dir
+    replay_dir = replay
+    capture_dir = capture
+
+
+def get_fixture_name(url):
+    for pattern, name in fixture_rules:
+        match = pattern.search(url)
+        if match:
+            return name.format(*[urllib.parse.unquote(group).replace('/', '_') for group in match.groups()])
+    raise ValueError("No fixture for " + url + ".")
+
+
+def get_fixture(url):
+    path = os.path.join(replay_dir, get_fixture_name(url))
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError as e:
+        logger.error("Could not replay " + url + " from " + path)
+        logger.error("Got the following error:")
+        logger.error(e)
+        raise e
+
+
+def capture_fixture(url, body):
+    if capture_dir:
+        write_file(os.path.join(capture_dir, get_fixture_name(url)), body)
+
+
+def get_cache_dir():
+    # Set HTTP_CACHE_DIR to None to turn the cache off
+    return getattr(settings, 'HTTP_CACHE_DIR', None)
+
+
+def get_ttl(url, body):
+    if game_feed_pattern.search(url) and is_final_game_feed(body):
+        return None
+    for pattern, ttl in ttl_rules:
+        if pattern.search(url):
+            return ttl
+    return default_ttl
+
+
+def is_final_game_feed(body):
+    try:
+        return json.loads(body.decode())['gameData']['status']['statusCode'] == "7"
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+def get_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_paths(cache_dir, url):
+    # Bodies are stored once by the hash of their content (objects/), each URL points at its body from a small entry
+    # (urls/) with the time it was fetched and how long it stays fresh
+    url_hash = get_hash(url.encode())
+    return os.path.join(cache_dir, 'urls', url_hash[:2], url_hash + '.json'), os.path.join(cache_dir, 'objects')
+
+
+def get_object_path(objects_dir, content_hash):
+    return os.path.join(objects_dir, content_hash[:2], content_hash)
+
+
+def write_file(path, data):
+    # Write to a temporary file and rename, so readers never see a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+    except Exception as e:
+        os.remove(temporary_path)
+        raise e
+
+
+def get_cached(url, cache_dir=None):
+    # Body of a fresh cached response for the URL, None if there isn't one
+    if replay_dir:
+        return get_fixture(url)
+    cache_dir = cache_dir or get_cache_dir()
+    if not cache_dir:
+        return None
+    entry_path, objects_dir = get_paths(cache_dir, url)
+    try:
+        with open(entry_path) as f:
+            entry = json.load(f)
+        if entry['ttl'] is not None and time.time() - entry['fetched'] > entry['ttl']:
+            return None
+        with open(get_object_path(objects_dir, entry['content_hash']), 'rb') as f:
+            body = f.read()
+    except (OSError, ValueError, KeyError):
+        return None
+    logger.debug("Using cached response for " + url)
+    capture_fixture(url, body)
+    return body
+
+
+def store(url, body, cache_dir=None):
+    capture_fixture(url, body)
+    cache_dir = cache_dir or get_cache_dir()
+    if not cache_dir:
+        return
+    entry_path, objects_dir = get_paths(cache_dir, url)
+    content_hash = get_hash(body)
+    object_path = get_object_path(objects_dir, content_hash)
+    try:
+        if not os.path.exists(object_path):
+            write_file(object_path, body)
+        write_file(entry_path, json.dumps({'url': url, 'content_hash': content_hash, 'fetched': time.time(),
+                                           'ttl': get_ttl(url, body)}).encode())
+    except OSError as e:
+        # A cache that can't be written shouldn't stop the update
+        logger.warning("Could not cache response for " + url + ": " + str(e))
+
+
+def cached_urlopen(url, cache_dir=None):
+    # Body of the response for the URL (what urlopen(url).read() returns), from the cache while it is fresh
+    body = get_cached(url, cache_dir)
+    if body is None:
+        body = urllib.request.urlopen(url).read()
+        store(url, body, cache_dir)
+    return body
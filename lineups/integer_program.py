@@ -0,0 +1,131 @@
+import logging
+import numpy as np
+from knapsack import get_player_arrays, get_player_positions, get_set_arrays
+from scipy.optimize import Bounds, LinearConstraint, milp
+from stacking import get_stacking_masks
+
+__author__ = "jaredg"
+
+logger = logging.getLogger(__name__)
+
+# DraftKings NHL roster: 2 C, 3 W, 2 D, 1 G and a Util that can be any skater, so each skater position can take one
+# more player than its slots
+roster_positions = {"C": 2, "W": 3, "D": 2}
+number_of_skaters = 8
+
+
+def integer_program(skaters, goalies, limit, stacking_rules=None):
+    # Solve the full lineup as a 0/1 integer program (HiGHS through scipy), one variable per skater and goalie, with
+    # the Util chosen by the solver instead of beforehand
+    logging.debug("Integer program with " + str(len(skaters)) + " skaters and " + str(len(goalies)) + " goalies.")
+    values, rows, lower_bounds, upper_bounds = get_lineup_model(skaters, goalies, limit, stacking_rules)
+    chosen = solve_lineup_model(values, rows, lower_bounds, upper_bounds, np.ones(len(values)))
+    if chosen is None:
+        raise ValueError("Could not solve the lineup integer program.")
+    return [get_chosen_set(skaters, goalies, chosen)]
+
+
+def integer_program_portfolio(skaters, goalies, limit, number_of_lineups, max_exposure=1.0, min_unique=1,
+                              stacking_rules=None):
+    # Yield up to number_of_lineups lineups from the same model, after each lineup a row is added so the next one
+    # shares at most 9 - min_unique players with it, and players in max_exposure of the lineups are fixed out
+    values, rows, lower_bounds, upper_bounds = get_lineup_model(skaters, goalies, limit, stacking_rules)
+    is_player = np.arange(len(values)) < len(skaters) + len(goalies)
+    variable_bounds = np.ones(len(values))
+    exposures = np.zeros(len(values), dtype=np.int64)
+    max_lineups = max(1, int(np.floor(max_exposure * number_of_lineups + 1e-9)))
+    logging.debug("Integer program portfolio of " + str(number_of_lineups) + " lineups, players in at most " + str(
+        max_lineups) + ", with " + str(min_unique) + " unique players between lineups.")
+
+    for i in range(number_of_lineups):
+        chosen = solve_lineup_model(values, rows, lower_bounds, upper_bounds, variable_bounds)
+        if chosen is None:
+            logging.warning("Could only find " + str(i) + " lineups within the exposure and unique player limits.")
+            return
+
+        yield get_chosen_set(skaters, goalies, chosen)
+        chosen &= is_player
+        rows.append(chosen.astype(np.float64))
+        lower_bounds.append(0)
+        upper_bounds.append(number_of_skaters + 1 - min_unique)
+        exposures += chosen
+        variable_bounds[exposures >= max_lineups] = 0
+
+
+def get_lineup_model(skaters, goalies, limit, stacking_rules=None):
+    # Objective values and constraint rows (salary, number of skaters and goalies, players at each position), as lists
+    # so the portfolio can add rows to them. Stacking rules (arguments of get_stacking_masks) add rows, and for line stacks one
+    # variable per line that can only be chosen with min_line_stack of its skaters.
+    skater_weights, skater_values = get_player_arrays(skaters)
+    goalie_weights, goalie_values = get_set_arrays(goalies)
+    skater_positions = get_player_positions(skaters)
+
+    is_skater = np.concatenate((np.ones(len(skaters)), np.zeros(len(goalies))))
+    is_goalie = 1 - is_skater
+    rows = [np.concatenate((skater_weights, goalie_weights)), is_skater, is_goalie]
+    lower_bounds = [0, number_of_skaters, 1]
+    upper_bounds = [limit, number_of_skaters, 1]
+    for position, slots in roster_positions.items():
+        rows.append(np.concatenate((skater_positions == position, np.zeros(len(goalies)))))
+        lower_bounds.append(slots)
+        upper_bounds.append(slots + 1)
+    values = np.concatenate((skater_values, goalie_values))
+    if stacking_rules is None:
+        return values, rows, lower_bounds, upper_bounds
+
+    stacking = get_stacking_masks(skaters, goalies, **stacking_rules)
+    # No skaters playing against the chosen goalie's team
+    if stacking["facing_goalie"] is not None:
+        for i, facing_goalie in enumerate(stacking["facing_goalie"]):
+            rows.append(np.concatenate((facing_goalie, number_of_skaters * (np.arange(len(goalies)) == i))))
+            lower_bounds.append(0)
+            upper_bounds.append(number_of_skaters)
+
+    # At least one line with min_line_stack of its skaters chosen
+    if stacking["lines"] is not None:
+        lines = stacking["lines"]
+        rows = [np.concatenate((row, np.zeros(len(lines)))) for row in rows]
+        for i, line in enumerate(lines):
+            rows.append(np.concatenate((line, np.zeros(len(goalies)), -stacking["min_line_stack"] * (
+                np.arange(len(lines)) == i))))
+            lower_bounds.append(0)
+            upper_bounds.append(np.inf)
+        rows.append(np.concatenate((np.zeros(len(skaters) + len(goalies)), np.ones(len(lines)))))
+        lower_bounds.append(1)
+        upper_bounds.append(np.inf)
+        values = np.concatenate((values, np.zeros(len(lines))))
+    return values, rows, lower_bounds, upper_bounds
+
+
+def solve_lineup_model(values, rows, lower_bounds, upper_bounds, variable_bounds):
+    # Chosen players as a boolean array, or None if there is no lineup within the constraints
+    result = milp(c=-values,
+                  constraints=LinearConstraint(np.array(rows, dtype=np.float64), lower_bounds, upper_bounds),
+                  integrality=np.ones(len(values)),
+                  bounds=Bounds(0, variable_bounds))
+    if not result.success:
+        logging.debug("Lineup integer program not solved: " + str(result.message))
+        return None
+    return np.round(result.x).astype(bool)
+
+
+def get_chosen_set(skaters, goalies, chosen):
+    chosen_skaters = [skaters[index] for index in np.nonzero(chosen[:len(skaters)])[0]]
+    chosen_goalie = goalies[np.nonzero(chosen[len(skaters):len(skaters) + len(goalies)])[0][0]]
+    return get_full_set(chosen_skaters, chosen_goalie)
+
+
+def get_full_set(chosen_skaters, chosen_goalie):
+    # Fill the C, W and D slots with the highest value skaters, the one left over is the Util
+    chosen_skaters = sorted(chosen_skaters, key=lambda tup: tup.get_value(), reverse=True)
+    lineup = []
+    for position, slots in roster_positions.items():
+        lineup += [skater for skater in chosen_skaters if skater.get_position() == position][:slots]
+    util = [skater for skater in chosen_skaters if skater not in lineup][0]
+
+    total_weight = sum(skater.get_weight() for skater in chosen_skaters) + chosen_goalie['weight']
+    total_value = sum(skater.get_value() for skater in chosen_skaters) + chosen_goalie['value']
+    return [skater.get_name_and_id() for skater in lineup] + [chosen_goalie['nameAndId'],
+                                                               util.get_name_and_id(),
+                                                               total_weight,
+                                                               total_value]
@@ -1,13 +1,87 @@
+import heapq
 import logging
+import numpy as np
+from player_pool import PlayerPool
+from stacking import get_stacking_masks
 
 __author__ = "jaredg"
 
 logger = logging.getLogger(__name__)
 
+# Structured array layouts used by the vectorized pair and triple generation, "players" holds the indices of the
+# players within the list of players for that position (in place of the nameAndId lists)
+pair_dtype = np.dtype([("players", np.intp, (2,)), ("weight", np.int64), ("value", np.float64)])
+triple_dtype = np.dtype([("players", np.intp, (3,)), ("weight", np.int64), ("value", np.float64)])
+
+
+def get_position_players(players, position):
+    if isinstance(players, PlayerPool):
+        return players.get_position(position)
+    return [item for item in players if item.get_position() == position]
+
+
+def get_player_arrays(players):
+    if isinstance(players, PlayerPool):
+        return players.weights, players.values
+    weights = np.array([player.get_weight() for player in players], dtype=np.int64)
+    values = np.array([player.get_value() for player in players], dtype=np.float64)
+    return weights, values
+
+
+def get_player_positions(players):
+    if isinstance(players, PlayerPool):
+        return players.get_position_names()
+    return np.array([player.get_position() for player in players])
+
+
+def get_name_and_ids(player_set, players=None):
+    # Sets from the vectorized mode only hold indices, so look up the names in the players for that position
+    if players is None:
+        return player_set['nameAndId']
+    if isinstance(players, PlayerPool):
+        return [players.name_and_ids[index] for index in player_set['players']]
+    return [players[index].get_name_and_id() for index in player_set['players']]
+
+
+def find_player_pair_array(weights, values):
+    # Same bounds as the loops in find_player_pair, which leave out the last player
+    first, second = np.triu_indices(max(len(weights) - 1, 0), k=1)
+    set_of_players = np.empty(len(first), dtype=pair_dtype)
+    set_of_players['players'][:, 0] = first
+    set_of_players['players'][:, 1] = second
+    set_of_players['weight'] = weights[first] + weights[second]
+    set_of_players['value'] = values[first] + values[second]
+    return set_of_players
+
+
+def find_player_triples_array(weights, values):
+    # Same bounds as the loops in find_player_triples, where the third player starts at i + j + 1
+    number_of_players = max(len(weights) - 1, 0)
+    first, second = np.triu_indices(number_of_players, k=1)
+    starts = first + second + 1
+    counts = np.clip(number_of_players - starts, 0, None)
+    first = np.repeat(first, counts)
+    second = np.repeat(second, counts)
+    third = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    set_of_players = np.empty(len(first), dtype=triple_dtype)
+    set_of_players['players'][:, 0] = first
+    set_of_players['players'][:, 1] = second
+    set_of_players['players'][:, 2] = third
+    set_of_players['weight'] = weights[first] + weights[second] + weights[third]
+    set_of_players['value'] = values[first] + values[second] + values[third]
+    return set_of_players
+
+
 # Find up to max_size pairs of players with maximum value to weight ratio
-def find_player_pair(players, position, max_set_size=200):
-    players = [item for item in players if item.get_position() == position]
+def find_player_pair(players, position, max_set_size=200, vectorized=False):
+    players = get_position_players(players, position)
     logging.debug("Number of " + position + " being used in pairs: " + str(len(players)))
+    if vectorized:
+        set_of_players = find_player_pair_array(*get_player_arrays(players))
+        logging.debug("Total number of " + position + " pairs: " + str(len(set_of_players)))
+        return set_of_players
+
     set_of_players = []
     for i in range(0, len(players) - 1):
         for j in range(i + 1, len(players) - 1):
@@ -26,9 +100,14 @@ def find_player_pair(players, position, max_set_size=200):
     # return sorted_set_of_players_optimal[:max_set_size] + sorted_set_of_players_highest_value[:max_set_size]
 
 
-def find_player_triples(players, position, max_triple_set_size=20000):
-    players = [item for item in players if item.get_position() == position]
+def find_player_triples(players, position, max_triple_set_size=20000, vectorized=False):
+    players = get_position_players(players, position)
     logging.debug("Number of " + position + " being used in triples: " + str(len(players)))
+    if vectorized:
+        set_of_players = find_player_triples_array(*get_player_arrays(players))
+        logging.debug("Total number of " + position + " triples: " + str(len(set_of_players)))
+        return set_of_players
+
     set_of_players = []
     for i in range(0, len(players) - 1):
         for j in range(i + 1, len(players) - 1):
@@ -48,15 +127,144 @@ def find_player_triples(players, position, max_triple_set_size=20000):
     # return sorted_set_of_players_optimal[:max_triple_set_size] + sorted_set_of_players_highest_value[
     #                                                              :max_triple_set_size]
 
+def iterate_player_triples(weights, values, max_weight=None):
+    # Yield every triple of players (each combination once, with no players left out) in order of weight, lightest
+    # first, as (weight, value, first, second, third). The players are sorted by weight and triples are expanded from
+    # a heap, each triple has a single parent that is no heavier, so only the heap is held instead of all the triples.
+    # Stops once the triples weigh more than max_weight.
+    order = np.argsort(weights, kind='stable')
+    sorted_weights = weights[order].tolist()
+    sorted_values = values[order].tolist()
+    order = order.tolist()
+    number_of_players = len(order)
+    if number_of_players < 3:
+        return
+
+    heap = [(sorted_weights[0] + sorted_weights[1] + sorted_weights[2], 0, 1, 2)]
+    while heap:
+        weight, i, j, k = heapq.heappop(heap)
+        if max_weight is not None and weight > max_weight:
+            return
+        yield weight, sorted_values[i] + sorted_values[j] + sorted_values[k], order[i], order[j], order[k]
+
+        if k + 1 == number_of_players:
+            continue
+        heapq.heappush(heap, (weight - sorted_weights[k] + sorted_weights[k + 1], i, j, k + 1))
+        if k == j + 1:
+            heapq.heappush(heap, (weight - sorted_weights[j] + sorted_weights[k + 1], i, j + 1, k + 1))
+            if j == i + 1:
+                heapq.heappush(heap, (weight - sorted_weights[i] + sorted_weights[k + 1], i + 1, j + 1, k + 1))
+
+
+def prune_dominated_stream(sets, number_of_sets=1, max_value=np.inf):
+    # Same sets as prune_dominated, for sets coming in order of weight, only the sets of the current weight and the
+    # best number_of_sets values so far are held. Stops once number_of_sets sets are worth max_value, no heavier set
+    # can be worth more.
+    best_values = []
+    group = []
+    for item in sets:
+        if group and item[0] != group[0][0]:
+            for kept in prune_weight_group(group, best_values, number_of_sets):
+                yield kept
+            group = []
+            if len(best_values) == number_of_sets and best_values[-1] >= max_value:
+                return
+        group.append(item)
+
+    for kept in prune_weight_group(group, best_values, number_of_sets):
+        yield kept
+
+
+def prune_weight_group(group, best_values, number_of_sets):
+    # Sets of the same weight that fewer than number_of_sets lighter or better sets are worth at least as much as,
+    # best_values is updated in place with the values of the group
+    group = sorted(group, key=lambda tup: tup[1], reverse=True)
+    kept = []
+    for position, item in enumerate(group[:number_of_sets]):
+        dominated_by = len([value for value in best_values if value >= item[1]]) + position
+        if dominated_by < number_of_sets:
+            kept.append(item)
+    best_values[:] = sorted(best_values + [item[1] for item in group[:number_of_sets]], reverse=True)[:number_of_sets]
+    return kept
+
+
+def find_player_triples_streaming(players, position, max_weight=None, number_of_sets=1):
+    # Triples streamed lightest first straight through the dominance pruning, only the triples left after pruning
+    # are kept, as a structured array like find_player_triples with vectorized
+    players = get_position_players(players, position)
+    weights, values = get_player_arrays(players)
+    logging.debug("Number of " + position + " being used in streamed triples: " + str(len(players)))
+
+    # Value of the best triple, summed in the same order as when it is streamed, once it is reached the rest of the
+    # triples are all dominated
+    max_value = np.inf
+    if len(players) >= 3:
+        order = np.argsort(weights, kind='stable')
+        best = np.sort(np.argsort(-values[order], kind='stable')[:3])
+        max_value = values[order[best[0]]] + values[order[best[1]]] + values[order[best[2]]]
+
+    kept = list(prune_dominated_stream(iterate_player_triples(weights, values, max_weight), number_of_sets,
+                                       max_value))
+    set_of_players = np.empty(len(kept), dtype=triple_dtype)
+    if kept:
+        kept = np.array(kept)
+        set_of_players['weight'] = kept[:, 0]
+        set_of_players['value'] = kept[:, 1]
+        set_of_players['players'] = kept[:, 2:].astype(np.intp)
+    logging.debug("Number of " + position + " triples kept from stream: " + str(len(set_of_players)))
+    return set_of_players
+
+
+# Remove any set of players that another set of the same position beats on both weight and value, only the best set
+# for each weight is kept and only if it is worth more than every lighter set, the optimal lineup never needs the others.
+# When keeping the best number_of_sets lineups, a set is only removed once that many other sets beat it.
+def prune_dominated(set_of_players, number_of_sets=1):
+    weights, values = get_set_arrays(set_of_players)
+    kept = get_non_dominated(weights, values, number_of_sets)
+    if isinstance(set_of_players, np.ndarray):
+        pruned_set_of_players = set_of_players[kept]
+    else:
+        pruned_set_of_players = [set_of_players[index] for index in kept]
+
+    logging.debug("Pruned " + str(len(set_of_players) - len(pruned_set_of_players)) + " dominated sets, " + str(
+        len(pruned_set_of_players)) + " left.")
+    return pruned_set_of_players
+
+
+def get_non_dominated(weights, values, number_of_sets=1):
+    order = np.lexsort((-values, weights))
+    sorted_values = values[order]
+    if number_of_sets == 1:
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = sorted_values[1:] > np.maximum.accumulate(sorted_values)[:-1]
+    else:
+        keep = np.zeros(len(order), dtype=bool)
+        sorted_weights = weights[order]
+        starts = np.flatnonzero(np.r_[True, sorted_weights[1:] != sorted_weights[:-1]])
+        best_values = np.empty(0)
+        for start in starts:
+            group_values = sorted_values[start:start + number_of_sets]
+            group_values = group_values[:np.searchsorted(sorted_weights[start:start + number_of_sets],
+                                                         sorted_weights[start], side='right')]
+            # Lighter sets worth at least as much, plus the better sets of the same weight
+            dominated_by = np.searchsorted(-best_values, -group_values, side='right') + np.arange(len(group_values))
+            keep[start:start + len(group_values)] = dominated_by < number_of_sets
+            best_values = np.sort(np.concatenate((best_values, group_values)))[::-1][:number_of_sets]
+
+    # Keep the original order of the sets, so ties are broken the same way as without pruning
+    return np.sort(order[keep])
+
+
 # http://stackoverflow.com/questions/19389931/knapsack-constraint-python
-def multi_choice_knapsack(goalies, util, defensemen, centres, wingers, limit):
+def multi_choice_knapsack(goalies, util, defensemen, centres, wingers, limit, position_players=None):
     # Remove chosen G and W from limit
     limit -= util.get_weight()
     logging.debug("New limit, after removing chosen Util is: " + str(limit))
 
     # Run multiple-choice knapsack on the pairs of D, C, W, and a goalie
     positions = ["G", "C", "W", "D"]
-    table = [[0 for w in range(limit + 1)] for j in range(len(positions) + 1)]
+    # Every position has to add a set, so a cell no set fits into can't be used by the next position
+    table = [[0 if j == 0 else float('-inf') for w in range(limit + 1)] for j in range(len(positions) + 1)]
     player_added = [[0 for w in range(limit + 1)] for j in range(len(positions) + 1)]
     logging.debug("Knapsack: Going through all " + str(len(positions)) + " positions.")
     for i in range(1, len(positions) + 1):
@@ -73,21 +281,18 @@ def multi_choice_knapsack(goalies, util, defensemen, centres, wingers, limit):
             logging.error("Unknown position!")
 
         for w in range(1, limit + 1):
-            max_val_for_position = table[i - 1][w]
+            max_val_for_position = float('-inf')
             for player in current_player_set:
                 # Find the max for all player_set of that position
                 weight = player['weight']
-                nameAndId = player['nameAndId']
                 value = player['value']
-                position = player['position']
 
                 if weight <= w and table[i - 1][w - weight] + value > max_val_for_position:
                     max_val_for_position = table[i - 1][w - weight] + value
                     player_added[i][w] = player
                     logging.debug(
-                        "Adding player at (" + str(i) + "," + str(w) + "): " + str(nameAndId) + ", wt: " + str(
-                            weight) + ", val: " + str(value) + ", position: " + str(
-                            position))
+                        "Adding player at (" + str(i) + "," + str(w) + "): " + str(player) + ", wt: " + str(
+                            weight) + ", val: " + str(value) + ", position: " + str(positions[i - 1]))
             table[i][w] = max_val_for_position
 
     result = []
@@ -110,89 +315,426 @@ def multi_choice_knapsack(goalies, util, defensemen, centres, wingers, limit):
                 w -= weight
                 break
 
+    set_of_players = []
+    set_of_players.append(get_full_set(result, util, total_weight, total_value, position_players))
+    logging.debug(set_of_players)
+    return set_of_players
+
+
+def get_set_arrays(set_of_players):
+    if isinstance(set_of_players, np.ndarray):
+        return set_of_players['weight'], set_of_players['value']
+    if isinstance(set_of_players, PlayerPool):
+        return set_of_players.weights, set_of_players.values
+    weights = np.array([player_set['weight'] for player_set in set_of_players], dtype=np.int64)
+    values = np.array([player_set['value'] for player_set in set_of_players], dtype=np.float64)
+    return weights, values
+
+
+def relax_position(previous_row, weights, values):
+    # Only the first set with the highest value for each weight can ever be added, so relax all capacities for one
+    # weight at a time, keeping the lowest index on ties to match the order the sets are checked in the loop version.
+    # A set has to be added, capacities no set fits into stay at -inf.
+    limit = len(previous_row) - 1
+    row = np.full(limit + 1, -np.inf)
+    player_added = np.full(limit + 1, -1, dtype=np.intp)
+    order = np.lexsort((np.arange(len(weights)), -values, weights))
+    first_of_weight = np.ones(len(order), dtype=bool)
+    first_of_weight[1:] = weights[order][1:] != weights[order][:-1]
+    for index in order[first_of_weight]:
+        weight = weights[index]
+        start = max(weight, 1)
+        if start > limit:
+            continue
+
+        relaxed = previous_row[start - weight:limit + 1 - weight] + values[index]
+        current = row[start:]
+        added = player_added[start:]
+        better = (relaxed > current) | ((relaxed == current) & (added >= 0) & (index < added))
+        current[better] = relaxed[better]
+        added[better] = index
+
+    return row, player_added
+
+
+def multi_choice_knapsack_array(goalies, util, defensemen, centres, wingers, limit, position_players=None):
+    # Same as multi_choice_knapsack, with the table kept in arrays and the index of the added set stored for each cell
+    limit -= util.get_weight()
+    logging.debug("New limit, after removing chosen Util is: " + str(limit))
+
+    positions = ["G", "C", "W", "D"]
+    sets_by_position = {"G": goalies, "C": centres, "W": wingers, "D": defensemen}
+    table = np.zeros((len(positions) + 1, limit + 1), dtype=np.float64)
+    player_added = np.full((len(positions) + 1, limit + 1), -1, dtype=np.intp)
+    set_arrays = []
+    for i in range(1, len(positions) + 1):
+        logging.debug("Multiple Choice Knapsack: Checking position " + str(positions[i - 1]))
+        weights, values = get_set_arrays(sets_by_position[positions[i - 1]])
+        table[i], player_added[i] = relax_position(table[i - 1], weights, values)
+        set_arrays.append((weights, values))
+
+    result, total_weight, total_value = find_sets_added(table, player_added, positions, sets_by_position, set_arrays,
+                                                        limit)
+    set_of_players = []
+    set_of_players.append(get_full_set(result, util, total_weight, total_value, position_players))
+    logging.debug(set_of_players)
+    return set_of_players
+
+
+def find_sets_added(table, player_added, positions, sets_by_position, set_arrays, limit):
+    # Walk back from the limit, taking the set added where each row last changes value
+    result = []
+    w = limit
+    total_value = 0
+    total_weight = 0
+    for i in range(len(positions), 0, -1):
+        changed = np.nonzero(table[i][:w] != table[i][1:w + 1])[0]
+        if len(changed) == 0 or player_added[i][changed[-1] + 1] < 0:
+            raise ValueError("Could not find a set of players for position " + positions[i - 1] + ".")
+
+        index = player_added[i][changed[-1] + 1]
+        weights, values = set_arrays[i - 1]
+        result.append(sets_by_position[positions[i - 1]][index])
+        total_value += float(values[index])
+        total_weight += int(weights[index])
+        w -= int(weights[index])
+
+    return result, total_weight, total_value
+
+
+def multi_choice_knapsack_k_best(goalies, util, defensemen, centres, wingers, limit, number_of_sets,
+                                 position_players=None):
+    # Keep the number_of_sets best partial lineups in every cell of the table, so one pass gives that many distinct
+    # lineups ranked by value. Each cell holds lineups using exactly one set per position with weight up to the cell.
+    limit -= util.get_weight()
+    logging.debug("New limit, after removing chosen Util is: " + str(limit))
+
+    positions = ["G", "C", "W", "D"]
+    sets_by_position = {"G": goalies, "C": centres, "W": wingers, "D": defensemen}
+    table = np.full((len(positions) + 1, limit + 1, number_of_sets), -np.inf)
+    table[0, :, 0] = 0
+    player_added = np.full(table.shape, -1, dtype=np.intp)
+    previous_rank = np.full(table.shape, -1, dtype=np.intp)
+
+    # Both the previous cell and the sets of one weight are sorted by value, so only the rank pairs whose product
+    # fits in number_of_sets can make it into the best number_of_sets
+    rank_pairs = np.array([(rank, set_rank) for rank in range(number_of_sets) for set_rank in range(number_of_sets)
+                           if (rank + 1) * (set_rank + 1) <= number_of_sets], dtype=np.intp)
+
+    set_arrays = []
+    for i in range(1, len(positions) + 1):
+        logging.debug("Multiple Choice Knapsack: Checking position " + str(positions[i - 1]))
+        weights, values = get_set_arrays(sets_by_position[positions[i - 1]])
+        set_arrays.append((weights, values))
+        order = np.lexsort((np.arange(len(weights)), -values, weights))
+        starts = np.flatnonzero(np.r_[True, weights[order][1:] != weights[order][:-1]]) if len(order) else []
+        for start in starts:
+            weight = weights[order[start]]
+            if weight < 1 or weight > limit:
+                continue
+
+            group = order[start:start + number_of_sets]
+            group = group[weights[group] == weight]
+            pairs = rank_pairs[rank_pairs[:, 1] < len(group)]
+            previous = table[i - 1, :limit + 1 - weight]
+            relaxed = previous[:, pairs[:, 0]] + values[group][pairs[:, 1]]
+
+            # Merge with what the cells already hold, keeping earlier entries first on ties
+            merged = np.concatenate((table[i, weight:], relaxed), axis=1)
+            merged_sets = np.concatenate((player_added[i, weight:],
+                                          np.broadcast_to(group[pairs[:, 1]], relaxed.shape)), axis=1)
+            merged_ranks = np.concatenate((previous_rank[i, weight:],
+                                           np.broadcast_to(pairs[:, 0], relaxed.shape)), axis=1)
+            best = np.argsort(-merged, axis=1, kind='stable')[:, :number_of_sets]
+            table[i, weight:] = np.take_along_axis(merged, best, axis=1)
+            player_added[i, weight:] = np.take_along_axis(merged_sets, best, axis=1)
+            previous_rank[i, weight:] = np.take_along_axis(merged_ranks, best, axis=1)
+
+    set_of_players = []
+    for rank in range(number_of_sets):
+        if table[len(positions), limit, rank] == -np.inf:
+            break
+
+        result = []
+        w = limit
+        r = rank
+        total_value = 0
+        total_weight = 0
+        for i in range(len(positions), 0, -1):
+            index = player_added[i, w, r]
+            weights, values = set_arrays[i - 1]
+            result.append(sets_by_position[positions[i - 1]][index])
+            total_value += float(values[index])
+            total_weight += int(weights[index])
+            r = previous_rank[i, w, r]
+            w -= int(weights[index])
+
+        set_of_players.append(get_full_set(result, util, total_weight, total_value, position_players))
+
+    logging.debug("Found " + str(len(set_of_players)) + " sets of players.")
+    return set_of_players
+
+
+def multi_choice_knapsack_sparse(goalies, util, defensemen, centres, wingers, limit, position_players=None):
+    # Instead of a column for every weight up to the limit, each position row only keeps the reachable
+    # (weight, value) points that no other point beats on both, so the work follows the number of distinct salary
+    # sums rather than the limit, and slates with full salaries (not divided by 100) stay small
+    limit -= util.get_weight()
+    logging.debug("New limit, after removing chosen Util is: " + str(limit))
+
+    positions = ["G", "C", "W", "D"]
+    sets_by_position = {"G": goalies, "C": centres, "W": wingers, "D": defensemen}
+    frontier_weights = np.zeros(1, dtype=np.int64)
+    frontier_values = np.zeros(1, dtype=np.float64)
+    frontiers = []
+    set_arrays = []
+    for position in positions:
+        weights, values = get_set_arrays(sets_by_position[position])
+        set_arrays.append((weights, values))
+        candidates = get_non_dominated(weights, values)
+        candidates = candidates[weights[candidates] <= limit]
+
+        # Every point of the last row with every non-dominated set of this position, within the limit
+        point_weights = (frontier_weights[:, None] + weights[candidates][None, :]).ravel()
+        point_values = (frontier_values[:, None] + values[candidates][None, :]).ravel()
+        points = np.flatnonzero(point_weights <= limit)
+        points = points[get_non_dominated(point_weights[points], point_values[points])]
+        if len(points) == 0:
+            raise ValueError("Could not find a set of players for position " + position + ".")
+
+        previous_points, set_indexes = np.divmod(points, len(candidates))
+        frontiers.append((previous_points, candidates[set_indexes]))
+        frontier_weights = point_weights[points]
+        frontier_values = point_values[points]
+        logging.debug("Multiple Choice Knapsack: " + str(len(points)) + " points after position " + position)
+
+    # Walk back from the best point, results added in reverse order (D, W, C, G) as in the table versions
+    point = int(np.argmax(frontier_values))
+    result = []
+    total_value = 0
+    total_weight = 0
+    for i in range(len(positions) - 1, -1, -1):
+        previous_points, set_indexes = frontiers[i]
+        index = set_indexes[point]
+        weights, values = set_arrays[i]
+        result.append(sets_by_position[positions[i]][index])
+        total_value += float(values[index])
+        total_weight += int(weights[index])
+        point = previous_points[point]
+
+    set_of_players = []
+    set_of_players.append(get_full_set(result, util, total_weight, total_value, position_players))
+    logging.debug(set_of_players)
+    return set_of_players
+
+
+def get_full_set(result, util, total_weight, total_value, position_players=None):
     # Adding players names to a set of players, results added in reverse order (Util, D, W, C)
     logging.debug(result)
     total_weight += util.get_weight()
     total_value += util.get_value()
     logging.debug(total_value)
-    full_set = [result[2]['nameAndId'][0],
-                result[2]['nameAndId'][1],
-                result[1]['nameAndId'][0],
-                result[1]['nameAndId'][1],
-                result[1]['nameAndId'][2],
-                result[0]['nameAndId'][0],
-                result[0]['nameAndId'][1],
-                result[3]['nameAndId'],
-                util.get_name_and_id(),
-                total_weight,
-                total_value]
-    set_of_players = []
-    set_of_players.append(full_set)
-    logging.debug(set_of_players)
-    return set_of_players
+    if position_players is None:
+        position_players = {}
+    centre_names = get_name_and_ids(result[2], position_players.get("C"))
+    winger_names = get_name_and_ids(result[1], position_players.get("W"))
+    defence_names = get_name_and_ids(result[0], position_players.get("D"))
+    return [centre_names[0],
+            centre_names[1],
+            winger_names[0],
+            winger_names[1],
+            winger_names[2],
+            defence_names[0],
+            defence_names[1],
+            result[3]['nameAndId'],
+            util.get_name_and_id(),
+            total_weight,
+            total_value]
 
 
-def knapsack(skaters, goalies, util, limit, max_set_size=2000, max_triple_set_size=400000):
-    defensemen = find_player_pair(skaters, "D", max_set_size)
-    centres = find_player_pair(skaters, "C", max_set_size)
-    wingers = find_player_triples(skaters, "W", max_triple_set_size)
+def knapsack(skaters, goalies, util, limit, max_set_size=2000, max_triple_set_size=400000, vectorized=False,
+             prune=False, number_of_sets=1, sparse=False, streaming=False, stacking_rules=None):
+    # The vectorized sets refer to players by index, so keep the players for each position to look up names, they
+    # are solved with the array version of the knapsack table. Streamed triples and stacking are also by index.
+    stacking = None
+    if stacking_rules is not None:
+        stacking = get_stacking_masks(skaters, goalies, **stacking_rules)
+        if stacking["lines"] is not None:
+            raise ValueError("Line stacks are only supported by the integer program.")
+    vectorized = vectorized or streaming or stacking is not None
+    position_players = None
+    if vectorized:
+        position_players = {position: get_position_players(skaters, position) for position in ["D", "C", "W"]}
+
+    # With opposing goalies avoided the sets are pruned for each goalie, after the sets against it are taken out
+    by_goalie = stacking is not None and stacking["facing_goalie"] is not None
+    defensemen = find_player_pair(skaters, "D", max_set_size, vectorized)
+    centres = find_player_pair(skaters, "C", max_set_size, vectorized)
+    max_weight = None
+    if streaming:
+        # A triple can only be used if it fits with the Util and the cheapest goalie, C pair and D pair
+        max_weight = limit - util.get_weight()
+        for set_of_players in [goalies, centres, defensemen]:
+            set_weights = get_set_arrays(set_of_players)[0]
+            max_weight -= set_weights.min() if len(set_weights) else 0
+        # Streaming prunes as it goes, so by goalie the triples are streamed for each goalie once the wingers
+        # against it are taken out (a triple pruned for a set taken out later would be lost)
+        wingers = None if by_goalie else find_player_triples_streaming(skaters, "W", max_weight, number_of_sets)
+    else:
+        wingers = find_player_triples(skaters, "W", max_triple_set_size, vectorized)
+
+    if prune and not by_goalie:
+        defensemen = prune_dominated(defensemen, number_of_sets)
+        centres = prune_dominated(centres, number_of_sets)
+        if not streaming:
+            wingers = prune_dominated(wingers, number_of_sets)
 
     logging.debug("Number of D pairs being checked: " + str(len(defensemen)))
     logging.debug("Number of C pairs being checked: " + str(len(centres)))
-    logging.debug("Number of W pairs being checked: " + str(len(wingers)))
+    if wingers is not None:
+        logging.debug("Number of W pairs being checked: " + str(len(wingers)))
 
-    return multi_choice_knapsack(goalies, util, defensemen, centres, wingers, limit)
+    if by_goalie:
+        return multi_choice_knapsack_by_goalie(skaters, goalies, util, defensemen, centres, wingers, limit,
+                                               number_of_sets, sparse, prune, position_players,
+                                               stacking["facing_goalie"], max_weight)
+    return solve_multi_choice_knapsack(goalies, util, defensemen, centres, wingers, limit, number_of_sets, sparse,
+                                       vectorized, position_players)
 
 
-def brute_force(skaters, goalies, util, limit, max_set_size=2000):
-    defensemen = find_player_pair(skaters, "D", max_set_size)
-    centres = find_player_pair(skaters, "C", max_set_size)
-    wingers = find_player_triples(skaters, "W", max_set_size)
+def multi_choice_knapsack_by_goalie(skaters, goalies, util, defensemen, centres, wingers, limit, number_of_sets,
+                                    sparse, prune, position_players, facing_goalie, max_weight=None):
+    # Solve once for each goalie, without the sets that have a skater playing against that goalie's team (using the
+    # masks from get_stacking_masks), and keep the best sets over all the goalies. With wingers None the W triples are
+    # streamed for each goalie from the wingers not against it, up to max_weight.
+    set_of_players = []
+    for i in range(len(goalies)):
+        if goalies.team_ids[i] != -1 and util.get_opponent_id() == goalies.team_ids[i]:
+            logging.debug("Skipping goalie " + goalies.name_and_ids[i] + ", the Util plays against them.")
+            continue
+
+        sets_by_position = []
+        for position, sets in [("D", defensemen), ("C", centres), ("W", wingers)]:
+            facing = facing_goalie[i][skaters.position_indexes[position]]
+            if sets is None:
+                # Streamed triples are already pruned, refer them back to all the wingers
+                available = np.flatnonzero(~facing)
+                sets = find_player_triples_streaming(position_players[position].subset(available), position,
+                                                     max_weight, number_of_sets)
+                sets['players'] = available[sets['players']]
+                sets_by_position.append(sets)
+                continue
+            sets = sets[~facing[sets['players']].any(axis=1)]
+            sets_by_position.append(prune_dominated(sets, number_of_sets) if prune else sets)
+        try:
+            set_of_players += solve_multi_choice_knapsack(goalies.subset([i]), util, *sets_by_position,
+                                                          limit=limit, number_of_sets=number_of_sets, sparse=sparse,
+                                                          vectorized=True, position_players=position_players)
+        except ValueError as e:
+            logging.debug("No sets for goalie " + goalies.name_and_ids[i] + ": " + str(e))
+
+    if not set_of_players:
+        raise ValueError("Could not find a set of players without skaters against the goalie.")
+    return sorted(set_of_players, key=lambda tup: tup[10], reverse=True)[:number_of_sets]
+
+
+def solve_multi_choice_knapsack(goalies, util, defensemen, centres, wingers, limit, number_of_sets, sparse,
+                                vectorized, position_players):
+    if number_of_sets > 1:
+        return multi_choice_knapsack_k_best(goalies, util, defensemen, centres, wingers, limit, number_of_sets,
+                                            position_players)
+    if sparse:
+        return multi_choice_knapsack_sparse(goalies, util, defensemen, centres, wingers, limit, position_players)
+    if vectorized:
+        return multi_choice_knapsack_array(goalies, util, defensemen, centres, wingers, limit, position_players)
+    return multi_choice_knapsack(goalies, util, defensemen, centres, wingers, limit, position_players)
+
+
+def brute_force(skaters, goalies, util, limit, max_set_size=2000, number_of_sets=10, prune=False,
+                max_chunk_size=65536):
+    position_players = {position: get_position_players(skaters, position) for position in ["D", "C", "W"]}
+    defensemen = find_player_pair(skaters, "D", max_set_size, vectorized=True)
+    centres = find_player_pair(skaters, "C", max_set_size, vectorized=True)
+    wingers = find_player_triples(skaters, "W", max_set_size, vectorized=True)
+
+    if prune:
+        defensemen = prune_dominated(defensemen, number_of_sets)
+        centres = prune_dominated(centres, number_of_sets)
+        wingers = prune_dominated(wingers, number_of_sets)
 
     logging.info("Number of D pairs being checked: " + str(len(defensemen)))
     logging.info("Number of C pairs being checked: " + str(len(centres)))
     logging.info("Number of W pairs being checked: " + str(len(wingers)))
 
-    set_of_players = []
+    goalie_weights, goalie_values = get_set_arrays(goalies)
+    util_weight = util.get_weight()
+    util_value = util.get_value()
+
+    # Keep the top sets in a heap of (value, -order checked, indices), so the smallest value is dropped first and
+    # on equal values the set checked last goes, the same as sorting all sets and keeping the first ones
+    top_sets = []
     index = 0
 
     logging.info(
-        "Potential number of combinations: " + str(len(centres) * len(defensemen) * len(wingers)))
-    for i in range(0, len(goalies)-1):
-        for j in range(len(centres)):
-            for k in range(len(defensemen)):
-                for l in range(len(wingers)):
-                    # for m in range(len(skaters)):
-                    #     if skaters[m]['nameAndId'] not in centres[j]['nameAndId'] and skaters[m]['nameAndId'] not in defensemen[k]['nameAndId'] and skaters[m][
-                    #         0] not in wingers[l]['nameAndId'] and skaters[m]['nameAndId'] != winger['nameAndId']:
-                    weight = goalies[i]['weight'] + centres[j]['weight'] + defensemen[k]['weight'] + wingers[l]['weight'] + \
-                             util['weight']
-                    value = goalies[i]['value'] + centres[j]['value'] + defensemen[k]['value'] + wingers[l]['value'] + util[
-                        'value']
-                    index += 1
-
-                    if index % 10000 == 0:
-                        # Only keep the top 100 sets of players
-                        set_of_players = sorted(set_of_players, key=lambda tup: tup[10], reverse=True)
-                        set_of_players = set_of_players[:10]
-
-                    if index % 10000000 == 0:
-                        logging.info("Number of sets checked: " + str(index) + ", top set:")
-                        logging.info(set_of_players[0])
-
-                    if weight <= limit:
-                        full_set = [centres[j]['nameAndId'][0],
-                                    centres[j]['nameAndId'][1],
-                                    wingers[l]['nameAndId'][0],
-                                    wingers[l]['nameAndId'][1],
-                                    wingers[l]['nameAndId'][2],
-                                    defensemen[k]['nameAndId'][0],
-                                    defensemen[k]['nameAndId'][1],
-                                    goalies[i]['nameAndId'],
-                                    util['nameAndId'],
-                                    weight,
-                                    value]
-                        set_of_players.append(full_set)
+        "Potential number of combinations: " + str(
+            len(goalies) * len(centres) * len(defensemen) * len(wingers)))
+    # Every goalie, C pair and D pair combination is a row checked against all the W triples at once, a chunk of rows
+    # at a time, so a set's position in the rows and triples is the order it is checked in
+    number_of_rows = len(goalies) * len(centres) * len(defensemen)
+    chunk_size = max(1, max_chunk_size // max(len(wingers), 1))
+    for start in range(0, number_of_rows, chunk_size):
+        rows = np.arange(start, min(start + chunk_size, number_of_rows))
+        goalie_rows = rows // (len(centres) * len(defensemen))
+        centre_rows = rows // len(defensemen) % len(centres)
+        defence_rows = rows % len(defensemen)
+        weight = (goalie_weights[goalie_rows] + centres['weight'][centre_rows] +
+                  defensemen['weight'][defence_rows])[:, None] + wingers['weight'][None, :] + util_weight
+        value = (goalie_values[goalie_rows] + centres['value'][centre_rows] +
+                 defensemen['value'][defence_rows])[:, None] + wingers['value'][None, :] + util_value
+        index += weight.size
+
+        value = np.where(weight <= limit, value, -np.inf).ravel()
+        if len(top_sets) == number_of_sets:
+            candidates = np.flatnonzero(value >= top_sets[0][0])
+        else:
+            candidates = np.flatnonzero(value > -np.inf)
+        if len(candidates) > number_of_sets:
+            # Only the sets tied with or above the number_of_sets best value are sorted
+            kth_value = np.partition(value[candidates], -number_of_sets)[-number_of_sets]
+            candidates = candidates[value[candidates] >= kth_value]
+            candidates = candidates[np.lexsort((candidates, -value[candidates]))[:number_of_sets]]
+
+        for candidate in candidates:
+            row, l = divmod(int(candidate), len(wingers))
+            top_set = (float(value[candidate]), -(start * len(wingers) + int(candidate)),
+                       (int(goalie_rows[row]), int(centre_rows[row]), int(defence_rows[row]), l))
+            if len(top_sets) < number_of_sets:
+                heapq.heappush(top_sets, top_set)
+            elif top_set > top_sets[0]:
+                heapq.heapreplace(top_sets, top_set)
+
+    logging.info("Number of sets checked: " + str(index) + ", top set:")
+    if top_sets:
+        logging.info(max(top_sets))
+
+    set_of_players = []
+    for value, order, (i, j, k, l) in sorted(top_sets, reverse=True):
+        centre_names = get_name_and_ids(centres[j], position_players["C"])
+        winger_names = get_name_and_ids(wingers[l], position_players["W"])
+        defence_names = get_name_and_ids(defensemen[k], position_players["D"])
+        full_set = [centre_names[0],
+                    centre_names[1],
+                    winger_names[0],
+                    winger_names[1],
+                    winger_names[2],
+                    defence_names[0],
+                    defence_names[1],
+                    goalies[i]['nameAndId'],
+                    util.get_name_and_id(),
+                    int(goalie_weights[i] + centres['weight'][j] + defensemen['weight'][k] + wingers['weight'][l] +
+                        util_weight),
+                    value]
+        set_of_players.append(full_set)
 
     logging.debug("Number of sets checked: " + str(index))
-    return set_of_players
\ No newline at end of file
+    return set_of_players
@@ -0,0 +1,51 @@
+import json
+import logging
+import os
+import subprocess
+from benchmark import backends, run_benchmark
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the lineup solvers on synthetic DraftKings slates and appends the results to a JSON lines file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', nargs='+', type=int, default=[2, 4, 8, 14],
+                            help='Number of games on each synthetic slate.')
+        parser.add_argument('--backends', nargs='+', choices=sorted(backends.keys()),
+                            default=["knapsack_vectorized", "knapsack_pruned", "brute_force", "integer_program"],
+                            help='Solvers to run, the plain knapsack is left out by default as it is too slow for '
+                                 'large slates.')
+        parser.add_argument('--repeat', type=int, default=1, help='Runs for each solver, the fastest is kept.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic slates.')
+        parser.add_argument('--salary-divisor', type=int, default=100,
+                            help='Salaries are divided by this before solving, lower for finer salary steps (the '
+                                 'table based knapsack grows with the limit, the sparse one with the distinct sums).')
+        parser.add_argument('--output', default='../resources/benchmarks/lineups.jsonl',
+                            help='File to append the results to.')
+
+    def handle(self, *args, **options):
+        # Before the run, so a missing directory doesn't lose the results
+        os.makedirs(os.path.dirname(options['output']) or '.', exist_ok=True)
+        results = run_benchmark(options['games'], options['backends'], options['repeat'], options['seed'],
+                              options['salary_divisor'])
+
+        try:
+            commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+
+        created = timezone.now().isoformat()
+        with open(options['output'], "a") as output_file:
+            for result in results:
+                result.update({"commit": commit, "created": created})
+                output_file.write(json.dumps(result) + "\n")
+
+        for result in results:
+            self.stdout.write('%(games)2s games, %(backend)-20s %(wall_time)8.3fs %(peak_memory)12s bytes, value: '
+                              '%(value)s, gap: %(optimality_gap)s' % result)
+        logger.info('Wrote ' + str(len(results)) + ' benchmark results to ' + options['output'])
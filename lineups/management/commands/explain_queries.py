@@ -0,0 +1,103 @@
+import datetime
+import json
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from lineups.models import Player, Team, Game, PlayerLine, PlayerGameDraftKings
+
+logger = logging.getLogger('django')
+
+# Words in a plan line that show an index is used, and that a whole table is read
+index_markers = {'postgresql': ['Index Scan', 'Index Only Scan', 'Bitmap Index Scan'],
+                 'sqlite': ['USING INDEX', 'USING COVERING INDEX', 'USING INTEGER PRIMARY KEY']}
+scan_markers = {'postgresql': ['Seq Scan'], 'sqlite': ['SCAN ']}
+
+
+class Command(BaseCommand):
+    help = 'Explains the lookups the updates run most (player by name, team by city, game by teams, games by date, ' \
+           'recent lines and the DraftKings players of a day), save the plans before a migration and compare after ' \
+           'to see which plans change'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--save', metavar='FILE', help='Write the plans to this JSON file.')
+        parser.add_argument('--compare', metavar='FILE',
+                            help='Report which plans changed from the ones saved in this JSON file.')
+
+    def handle(self, *args, **options):
+        plans = {name: explain(queryset) for name, queryset in get_queries()}
+        saved = None
+        if options['compare']:
+            with open(options['compare']) as plans_file:
+                saved = json.load(plans_file)
+
+        for name, plan in plans.items():
+            if saved is None:
+                status = ''
+            elif name not in saved:
+                status = ' (new)'
+            else:
+                changed = get_plan_nodes(saved[name], connection.vendor) != get_plan_nodes(plan, connection.vendor)
+                status = ' (changed)' if changed else ' (unchanged)'
+            self.stdout.write(name + ': ' + get_access(plan) + status)
+            for line in plan:
+                self.stdout.write('    ' + line)
+
+        if options['save']:
+            with open(options['save'], 'w') as plans_file:
+                json.dump(plans, plans_file, indent=2)
+            logger.info('Wrote ' + str(len(plans)) + ' query plans to ' + options['save'])
+
+
+def get_queries():
+    # Same filters as the code running them, with values taken from the database where there are any
+    player = Player.objects.first()
+    team = Team.objects.first()
+    game = Game.objects.first()
+    now = timezone.now()
+    start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    return [
+        # PlayerManager.get_player_id_by_name
+        ('player by full name', Player.objects.filter(full_name=player.full_name if player else '')),
+        # TeamManager.get_team_id_by_city
+        ('team by location name', Team.objects.filter(location_name=team.location_name if team else '')),
+        # GameManager.get_game_pk_by_ids
+        ('latest game by teams', Game.objects.filter(home_team_id=game.home_team_id if game else 0,
+                                                     away_team_id=game.away_team_id if game else 0)
+         .order_by('-game_pk')[:1]),
+        # update_player_game
+        ('games since date', Game.objects.filter(game_date__gte=now - datetime.timedelta(days=1)).order_by('game_pk')),
+        # update_player_line
+        ('recently updated lines', PlayerLine.objects.filter(updated__gte=now - datetime.timedelta(hours=12))[:1]),
+        # The DraftKings players of a day, as a range so the index on date_for_lineup can be used
+        ('draftkings players of a day', PlayerGameDraftKings.objects.filter(
+            date_for_lineup__gte=start_of_day, date_for_lineup__lt=start_of_day + datetime.timedelta(days=1))),
+    ]
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(('EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN ') + sql, params)
+        # PostgreSQL gives one line per row, SQLite the detail in the last column
+        return [str(row[-1]) for row in cursor.fetchall()]
+
+
+def get_plan_nodes(plan, vendor):
+    # PostgreSQL plans as their nodes with the index each one uses, without the cost, row and width estimates that
+    # change with the data, SQLite plans have none
+    if vendor != 'postgresql':
+        return plan
+    return [line.split('(cost=')[0].replace('->', '').strip() for line in plan if '(cost=' in line]
+
+
+def get_access(plan):
+    text = '\n'.join(plan)
+    if any(marker in text for marker in index_markers.get(connection.vendor, [])):
+        return 'index'
+    if any(marker in text for marker in scan_markers.get(connection.vendor, [])):
+        return 'full scan'
+    return 'unknown'
@@ -1,21 +1,27 @@
 import argparse
-import copy
 import csv
 import datetime
 import logging
+import numpy as np
 import pytz
 import random
 import re
-import urllib
 from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from knapsack import knapsack, brute_force
+from integer_program import integer_program, integer_program_portfolio
+from player_pool import PlayerPool, position_codes
+from simulation import get_expected_stats, simulate_lineups, rank_lineups
+from stacking import get_line_ids
 
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection
 from django.db.models import Q, Avg
 from django.utils import timezone
 
-from lineups.models import Player, Game, PlayerGame, PlayerGameDraftKings
+from lineups.http_cache import cached_urlopen
+from lineups.models import Player, Game, PlayerGame, PlayerGameDraftKings, PlayerGameExpectedStats, PlayerLine
 
 from bs4 import BeautifulSoup
 
@@ -39,6 +45,28 @@ class Command(BaseCommand):
         default_date_string = datetime.datetime.strftime(default_date, date_format)
         parser.add_argument('date_for_lineup', nargs='?', type=valid_date, default=default_date_string,
                             help='Date to create lineups for.')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes to solve lineups with (by default one, in sequence).')
+        parser.add_argument('--single-pass', action='store_true',
+                            help='Take all lineups from one knapsack pass that keeps the best sets.')
+        parser.add_argument('--portfolio', action='store_true',
+                            help='Find all lineups from one integer program, with exposure and unique player limits '
+                                 'in place of lowering values.')
+        parser.add_argument('--max-exposure', type=float, default=1.0,
+                            help='Portfolio only, the most of the lineups (0 to 1) any player can be in.')
+        parser.add_argument('--min-unique', type=int, default=1,
+                            help='Portfolio only, the least number of players each lineup has that no other does.')
+        parser.add_argument('--percentile', type=float, default=None,
+                            help='Rank the final lineups by this percentile of simulated scores (e.g. 90 for ceiling) '
+                                 'instead of the expected value.')
+        parser.add_argument('--simulations', type=int, default=10000,
+                            help='Number of simulated slates used to rank lineups with --percentile.')
+        parser.add_argument('--min-line-stack', type=int, default=0,
+                            help='Each lineup has at least this many skaters from the same line (solved with the '
+                                 'integer program, with --workers or --single-pass the lineups come from its '
+                                 'portfolio).')
+        parser.add_argument('--avoid-opposing-goalie', action='store_true',
+                            help='No skaters playing against the goalie of the lineup.')
 
     def handle(self, *args, **options):
         logging.debug("Hardcoding date and goalies for the lineup....")
@@ -51,20 +79,36 @@ class Command(BaseCommand):
         lowering_value = -0.1  # Value decrease after player is used in lineup
 
         # calculate all lineups/entries
-        calculate_lineups(date_for_lineup, number_of_lineups, lineup_type, lowering_value, force_update)
+        calculate_lineups(date_for_lineup, number_of_lineups, lineup_type, lowering_value, force_update,
+                          workers=options['workers'], single_pass=options['single_pass'],
+                          portfolio=options['portfolio'], max_exposure=options['max_exposure'],
+                          min_unique=options['min_unique'], percentile=options['percentile'],
+                          number_of_simulations=options['simulations'], min_line_stack=options['min_line_stack'],
+                          avoid_opposing_goalie=options['avoid_opposing_goalie'])
 
         # Get statistics from previous night
         # if lineup_type == "initial":
         #     calculate_statistics(db)
 
-def calculate_sets_of_players(skaters, goalies, util, limit, type="knapsack"):
+def calculate_sets_of_players(skaters, goalies, util, limit, type="knapsack", number_of_sets=1, stacking_rules=None):
     if type == "knapsack":
-        return knapsack(skaters, goalies, util, limit)
+        return knapsack(skaters, goalies, util, limit, number_of_sets=number_of_sets, stacking_rules=stacking_rules)
     elif type == "brute_force":
+        if stacking_rules is not None:
+            raise ValueError("Stacking rules are not supported by brute_force, use knapsack or integer_program.")
         return brute_force(skaters, goalies, util, limit)  # , 100, 4000)
+    elif type == "integer_program":
+        # The integer program chooses its own Util, so give it back to the skaters. More than one set are the best
+        # lineups that each differ by a player, from the portfolio with no exposure limit.
+        skaters = PlayerPool.concatenate([skaters, util.as_pool()])
+        if number_of_sets > 1:
+            return list(integer_program_portfolio(skaters, goalies, limit, number_of_sets,
+                                                  stacking_rules=stacking_rules))
+        return integer_program(skaters, goalies, limit, stacking_rules)
     else:
         raise ValueError(
-            "Invalid type for calculate_set_of_players: " + type + ", choose either knapsack or brute_force.")
+            "Invalid type for calculate_set_of_players: " + type + ", choose either knapsack, brute_force or "
+                                                                   "integer_program.")
 
 
 def get_starting_goalies(db, date_for_lineup):
@@ -73,7 +117,7 @@ def get_starting_goalies(db, date_for_lineup):
         logging.info("Finding starting goalies...")
         url = "http://www2.dailyfaceoff.com/starting-goalies/" + str(date_for_lineup.year) + "/" + str(
             date_for_lineup.month) + "/" + str(date_for_lineup.day) + "/"
-        soup = BeautifulSoup(urllib.request.urlopen(url).read(), "html.parser")
+        soup = BeautifulSoup(cached_urlopen(url), "html.parser")
         # matchups = soup.find(id="matchups")
         for row in soup.find_all("div", "goalie"):
             if row.find("h5") != None:
@@ -183,7 +227,7 @@ def get_player_data(db, date_for_lineup, force_update=False):  # , ir_players):
                 # if name not in ir_players:
                 player_info = PlayerGameDraftKings(get_player_game_from_game_info(row[' Name'], row['GameInfo']),
                                                    name_and_id=row['Name + ID'],
-                                                   id=row[' ID'],
+                                                   draftkings_id=row[' ID'],
                                                    salary=int(int(row[' Salary']) / 100),
                                                    position=row['Position'],
                                                    draft_type="Standard",
@@ -258,7 +302,170 @@ def get_entries(db, date_for_lineup):
             return None
 
 
-def calculate_lineups(db, date_for_lineup, number_of_lineups, lineup_type="initial", lowering_value=-0.1, force_update=False):
+def lower_values(skaters, goalies, set_of_players, lowering_value):
+    # Lower value of non-chosen players in selected set (C,W,D), as they've already been selected
+    for players in [skaters, goalies]:
+        indexes = players.find(set_of_players[:9])
+        for index in indexes:
+            logging.info("Lowering value of " + str(players.name_and_ids[index]) + " by " + str(lowering_value) + ".")
+        players.add_value(indexes, lowering_value)
+
+
+def calculate_sets_of_players_in_sequence(skaters, goalies, limit, number_of_lineups, lowering_value,
+                                          type="knapsack", stacking_rules=None):
+    for i in range(number_of_lineups):
+        # Find the chosen goalies
+        # chosen_goalie = [item for item in players if item.get_name_and_id() == chosen_goalies[i]][0]
+
+        # Add random noise in order to get varied results (as a factor of the value used to lower player values that
+        # have been used in a previous lineup
+        # for skater in skaters:
+        #     skater.add_value(random.uniform(4 * lowering_value, -4 * lowering_value))
+
+        # Choose a Util based on the best value
+        skaters = skaters.sorted_by_value()
+        chosen_util = skaters[0]
+
+        # Remove Util from skaters (will be returned after calculating the set)
+        logging.info("Getting lineup with " + chosen_util.get_name_and_id() + " as Util.")
+
+        calculated_set_of_players = calculate_sets_of_players(skaters.subset(slice(1, None)), goalies, chosen_util,
+                                                              limit, type, stacking_rules=stacking_rules)
+        calculated_set_of_players = sorted(calculated_set_of_players, key=lambda tup: tup[10], reverse=True)
+
+        # Add Util back in at the end for next loop
+        skaters = skaters.subset(np.r_[1:len(skaters), 0])
+
+        lower_values(skaters, goalies, calculated_set_of_players[0], lowering_value)
+        yield calculated_set_of_players
+
+
+def calculate_sets_of_players_in_one_pass(skaters, goalies, limit, number_of_lineups, type="knapsack",
+                                          stacking_rules=None):
+    # Keep the best number_of_lineups sets in a single knapsack pass with the best value Util, instead of lowering
+    # values and solving again for each lineup
+    skaters = skaters.sorted_by_value()
+    chosen_util = skaters[0]
+    logging.info("Getting " + str(number_of_lineups) + " lineups with " + chosen_util.get_name_and_id() + " as Util.")
+
+    calculated_set_of_players = calculate_sets_of_players(skaters.subset(slice(1, None)), goalies, chosen_util, limit,
+                                                          type, number_of_lineups, stacking_rules)
+    calculated_set_of_players = sorted(calculated_set_of_players, key=lambda tup: tup[10], reverse=True)
+    for full_set in calculated_set_of_players:
+        yield [full_set]
+
+
+def calculate_sets_of_players_as_portfolio(skaters, goalies, limit, number_of_lineups, max_exposure=1.0,
+                                           min_unique=1, stacking_rules=None):
+    # The integer program chooses the Util and the exposure and unique player limits keep the lineups varied, so no
+    # values are lowered
+    logging.info("Getting a portfolio of " + str(number_of_lineups) + " lineups.")
+    for full_set in integer_program_portfolio(skaters, goalies, limit, number_of_lineups, max_exposure, min_unique,
+                                              stacking_rules):
+        yield [full_set]
+
+
+# Players given to each worker process once when the pool starts, only the value changes are sent with each solve
+worker_players = {}
+
+
+def init_lineup_worker(skaters, goalies, limit, type, stacking_rules=None):
+    worker_players['skaters'] = skaters
+    worker_players['goalies'] = goalies
+    worker_players['limit'] = limit
+    worker_players['type'] = type
+    worker_players['stacking_rules'] = stacking_rules
+
+
+def calculate_sets_of_players_for_util(util_index, skater_value_changes, goalie_value_changes):
+    # Work on copies so the worker's players keep their original values between solves
+    skaters = worker_players['skaters'].subset(slice(None))
+    goalies = worker_players['goalies'].subset(slice(None))
+    skaters.values += skater_value_changes
+    goalies.values += goalie_value_changes
+
+    chosen_util = skaters[util_index]
+    skaters = skaters.subset(np.flatnonzero(np.arange(len(skaters)) != util_index)).sorted_by_value()
+    logging.info("Getting lineup with " + chosen_util.get_name_and_id() + " as Util.")
+
+    calculated_set_of_players = calculate_sets_of_players(skaters, goalies, chosen_util, worker_players['limit'],
+                                                          worker_players['type'],
+                                                          stacking_rules=worker_players['stacking_rules'])
+    return sorted(calculated_set_of_players, key=lambda tup: tup[10], reverse=True)
+
+
+def calculate_sets_of_players_in_parallel(skaters, goalies, limit, number_of_lineups, lowering_value, workers,
+                                          type="knapsack", stacking_rules=None):
+    # Each round solves the best skaters as Util side by side with the same values, the values are then lowered for
+    # the results in the order the Utils were chosen, so the lineups don't depend on which worker finishes first
+    if type == "integer_program":
+        # The integer program puts each worker's Util back and chooses its own, so every worker of a round would
+        # find the same lineup
+        logging.info("Solving the integer program lineups as a portfolio instead of with " + str(workers) +
+                     " workers.")
+        for calculated_set_of_players in calculate_sets_of_players_as_portfolio(skaters, goalies, limit,
+                                                                                number_of_lineups,
+                                                                                stacking_rules=stacking_rules):
+            yield calculated_set_of_players
+        return
+
+    original_skater_values = skaters.values.copy()
+    original_goalie_values = goalies.values.copy()
+    number_of_sets = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_lineup_worker,
+                             initargs=(skaters, goalies, limit, type, stacking_rules)) as executor:
+        while number_of_sets < number_of_lineups:
+            round_size = min(workers, number_of_lineups - number_of_sets, len(skaters))
+            util_indexes = np.argsort(-skaters.values, kind='stable')[:round_size]
+            skater_value_changes = skaters.values - original_skater_values
+            goalie_value_changes = goalies.values - original_goalie_values
+
+            for calculated_set_of_players in executor.map(calculate_sets_of_players_for_util, util_indexes,
+                                                          repeat(skater_value_changes), repeat(goalie_value_changes)):
+                lower_values(skaters, goalies, calculated_set_of_players[0], lowering_value)
+                number_of_sets += 1
+                yield calculated_set_of_players
+
+
+def rank_lineups_by_simulation(players, sets_of_players, percentile, number_of_simulations=10000):
+    # Simulate the slate from the expected stats of the players and order the lineups by a percentile of their
+    # simulated scores
+    name_and_ids = {player.player_game_id: player.get_name_and_id() for player in players}
+    player_game_expected_stats = list(PlayerGameExpectedStats.objects.filter(
+        player_game_id__in=list(name_and_ids.keys())).select_related('player_game__player'))
+    expected_stats = get_expected_stats(player_game_expected_stats,
+                                        [name_and_ids[stats.player_game_id] for stats in player_game_expected_stats])
+
+    scores = simulate_lineups(expected_stats, sets_of_players, number_of_simulations)
+    logging.info("Ranking " + str(len(sets_of_players)) + " lineups by the " + str(percentile) + " percentile of " +
+                 str(number_of_simulations) + " simulated slates.")
+    return rank_lineups(scores, percentile)
+
+
+def get_stacking_ids(players):
+    # Team and opponent from the PlayerGame of each player and the latest line combination from PlayerLine
+    player_games = PlayerGame.objects.filter(id__in=[player.player_game_id for player in players]).select_related(
+        'player').in_bulk()
+    lines = {}
+    for player_line in PlayerLine.objects.filter(
+            player_id__in=[player_game.player_id for player_game in player_games.values()]).order_by('updated'):
+        lines[player_line.player_id] = player_line.line
+
+    team_ids = []
+    opponent_ids = []
+    player_lines = []
+    for player in players:
+        player_game = player_games.get(player.player_game_id)
+        team_ids.append(-1 if player_game is None or player_game.player.team_id is None else
+                        player_game.player.team_id)
+        opponent_ids.append(-1 if player_game is None else player_game.opponent_id)
+        player_lines.append(None if player_game is None else lines.get(player_game.player_id))
+    return np.array(team_ids), np.array(opponent_ids), np.array(get_line_ids(team_ids, player_lines))
+
+
+def calculate_lineups(db, date_for_lineup, number_of_lineups, lineup_type="initial", lowering_value=-0.1, force_update=False,
+                      workers=1, single_pass=False, portfolio=False, max_exposure=1.0, min_unique=1,
+                      percentile=None, number_of_simulations=10000, min_line_stack=0, avoid_opposing_goalie=False):
     # Create lineups/entries for all combinations of top goalies (or chosen goalies) and top value/cost players
     # Write top lineups/entries to file
     if lineup_type == "initial":
@@ -277,6 +484,7 @@ def calculate_lineups(db, date_for_lineup, number_of_lineups, lineup_type="initi
 
         logging.debug("Starting creating lineups....")
         all_lineups = []
+        all_sets_of_players = []
 
         logging.debug("Setting up players with ID and values....")
         players = get_player_data(db, date_for_lineup, force_update)
@@ -287,21 +495,30 @@ def calculate_lineups(db, date_for_lineup, number_of_lineups, lineup_type="initi
 
         logging.debug("Finding starting goalies....")
         starting_goalies = get_starting_goalies(db, date_for_lineup)
-        goalies = [item for item in players if item.get_name() in starting_goalies]
+        # Build the player pool once for the slate, the solvers only work on its arrays
+        player_pool = PlayerPool.from_players(players)
+
+        # Stacking rules need the team, opponent and line of each player, the line stack needs the integer program
+        stacking_rules = None
+        type = "knapsack"
+        if min_line_stack > 1 or avoid_opposing_goalie:
+            stacking_rules = {"min_line_stack": min_line_stack, "avoid_opposing_goalie": avoid_opposing_goalie}
+            player_pool.team_ids, player_pool.opponent_ids, player_pool.line_ids = get_stacking_ids(players)
+            if min_line_stack > 1:
+                type = "integer_program"
+        goalies = player_pool.subset([i for i, item in enumerate(players) if item.get_name() in starting_goalies])
         if len(goalies) == 0:
             raise ValueError("Could not find any starting goalies.")
 
         # Sort list of players and remove any goalies and players with value less than 1.0 and weight 25 or under, or if not active
         # Choose one Util from the from of the list
         logging.debug("Finding skaters....")
-        skaters = copy.deepcopy(players)
         active_players = get_all_active_player_ids(db)
-        skaters = [item for item in skaters if
-                   item.get_position() != "G" and
-                   item.get_value() > 1.0 and
-                   item.get_weight() > 25 and
-                   item.get_player_id() != None and
-                   item.get_player_id() in active_players]
+        skaters = player_pool.subset(np.flatnonzero((player_pool.positions != position_codes["G"]) &
+                                                    (player_pool.values > 1.0) &
+                                                    (player_pool.weights > 25) &
+                                                    (player_pool.player_ids != -1) &
+                                                    np.isin(player_pool.player_ids, list(active_players))))
         # for skater in skaters:
         #     logging.info(skater)
         #     logging.info(skater.get_player_id())
@@ -312,48 +529,28 @@ def calculate_lineups(db, date_for_lineup, number_of_lineups, lineup_type="initi
         # Use the following statements to check a specific player's value
         # ss_value = [item for item in skaters if item['nameAndId'] == 'Steven Stamkos (7723976)'][0]['value']
         # logging.debug("Steven Stamkos value: " + str(ss_value) + ", players length: " + str(len(players)))
-        for i in range(number_of_lineups):
-            # Find the chosen goalies
-            # chosen_goalie = [item for item in players if item.get_name_and_id() == chosen_goalies[i]][0]
-
-            # Add random noise in order to get varied results (as a factor of the value used to lower player values that
-            # have been used in a previous lineup
-            # for skater in skaters:
-            #     skater.add_value(random.uniform(4 * lowering_value, -4 * lowering_value))
-
-            # Choose a Util based on the best value
-            skaters = sorted(skaters, key=lambda tup: tup.get_value(), reverse=True)
-            chosen_util = skaters[0]
-
-            # Remove Util from skaters (will be returned after calculating the set)
-            skaters = [item for item in skaters if item.get_name_and_id() != chosen_util.get_name_and_id()]
-
-            # skaters = [item for item in unused_players if item['position'] != "G"]
-            logging.info("Getting lineup with " + chosen_util.get_name_and_id() + " as Util.")
+        if portfolio:
+            sets_of_players = calculate_sets_of_players_as_portfolio(skaters, goalies, limit, number_of_lineups,
+                                                                     max_exposure, min_unique, stacking_rules)
+        elif single_pass:
+            sets_of_players = calculate_sets_of_players_in_one_pass(skaters, goalies, limit, number_of_lineups, type,
+                                                                    stacking_rules)
+        elif workers > 1:
+            sets_of_players = calculate_sets_of_players_in_parallel(skaters, goalies, limit, number_of_lineups,
+                                                                    lowering_value, workers, type, stacking_rules)
+        else:
+            sets_of_players = calculate_sets_of_players_in_sequence(skaters, goalies, limit, number_of_lineups,
+                                                                    lowering_value, type, stacking_rules)
 
-            calculated_set_of_players = calculate_sets_of_players(skaters, goalies, chosen_util, limit)
-            calculated_set_of_players = sorted(calculated_set_of_players, key=lambda tup: tup[10], reverse=True)
+        for i, calculated_set_of_players in enumerate(sets_of_players):
             calculated_lineup = Lineup(db, calculated_set_of_players[0])
             logging.debug(calculated_lineup)
 
-            # Add Util back in for next loop
-            skaters.append(chosen_util)
-
-            # Lower value of non-chosen players in selected set (C,W,D), as they've already been selected
-            for skater in skaters:
-                if skater.get_name_and_id() in calculated_set_of_players[0]:
-                    logging.info("Lowering value of " + str(skater.get_name_and_id()) + " by " + str(lowering_value) + ".")
-                    skater.add_value(lowering_value)
-
-            for goalie in goalies:
-                if goalie.get_name_and_id() in calculated_set_of_players[0]:
-                    logging.info("Lowering value of " + str(goalie.get_name_and_id()) + " by " + str(lowering_value) + ".")
-                    goalie.add_value(lowering_value)
-
             # Add found lineup to all lineups
             logging.info("Lineup number " + str(i+1) + ":")
             logging.info(calculated_lineup)
             all_lineups.append(calculated_lineup)
+            all_sets_of_players.append(calculated_set_of_players[0])
 
             # Write top lineup to csv
             if lineup_type == "entry":
@@ -369,7 +566,11 @@ def calculate_lineups(db, date_for_lineup, number_of_lineups, lineup_type="initi
         csvfile.close()
 
     # Sort final lineups and print
-    all_lineups = sorted(all_lineups, key=lambda tup: tup.get_total_value(), reverse=True)
+    if percentile is not None:
+        order = rank_lineups_by_simulation(players, all_sets_of_players, percentile, number_of_simulations)
+        all_lineups = [all_lineups[index] for index in order]
+    else:
+        all_lineups = sorted(all_lineups, key=lambda tup: tup.get_total_value(), reverse=True)
     for s in range(len(all_lineups)):
         logging.info(all_lineups[s].get_list())
 
@@ -4,16 +4,21 @@ import json
 import logging
 import pytz
 import re
-import urllib.request
+import time
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import connection
-from django.db.models import Q, Avg
+from django.db import connection, transaction
+from django.db.models import Q, Avg, Sum
 from django.utils import timezone
 
+from lineups.game_stats import aggregate_fields, get_seconds, is_aggregated_game, get_aggregate_values
+from lineups.http_cache import cached_urlopen, get_cached, store, set_fixture_dirs
+from lineups.managers import identity_map_scope
 from lineups.models import Player, PlayerLine, Game, GameOdds, Team, TeamStats, PlayerGame, PlayerGameStats, PlayerGameExpectedStats
+from lineups.models import PlayerSeasonAggregate, PlayerDailyAggregate
 
 from bs4 import BeautifulSoup
+from game_feeds import iterate_game_feeds, get_game_feed_url, statsapi_url
 
 logger = logging.getLogger('django')
 date_format = "%Y-%m-%d"
@@ -35,16 +40,46 @@ class Command(BaseCommand):
         default_date_string = datetime.datetime.strftime(default_date, date_format)
         parser.add_argument('update_as_of', nargs='?', type=valid_date, default=default_date_string,
                             help='Date to update back to.')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Number of game feeds to download at once (by default one at a time).')
+        parser.add_argument('--batch-size', type=int, default=0,
+                            help='Write the stats of this many finished games at a time in one transaction (by '
+                                 'default one game at a time).')
+        parser.add_argument('--grouped-expected-stats', action='store_true',
+                            help='Find the expected stats of the players in every unfinished game together, with one '
+                                 'grouped query and one upsert (by default one query per player).')
+        parser.add_argument('--replay', metavar='DIRECTORY',
+                            help='Read the schedule, game feeds, odds and line combinations from fixtures captured in '
+                                 'this directory instead of downloading them, and report the time of each stage.')
+        parser.add_argument('--capture', metavar='DIRECTORY',
+                            help='Save every response read while updating to this directory, to replay later.')
 
     def handle(self, *args, **options):
         update_as_of = options['update_as_of']
-        update_teams()
-        update_team_stats("20162017")
-        update_games(update_as_of)
-        update_game_odds()
-        # update_player_game_starting_goalies()
-        update_player_line()
-        update_player_game(update_as_of)
+        replay = options['replay']
+        set_fixture_dirs(replay, options['capture'])
+        timings = []
+        try:
+            # Player and team lookups come from one load of each table for the whole run
+            with identity_map_scope():
+                time_stage(timings, "teams", update_teams)
+                time_stage(timings, "team stats", update_team_stats, "20162017")
+                time_stage(timings, "games", update_games, update_as_of)
+                time_stage(timings, "game odds", update_game_odds)
+                # update_player_game_starting_goalies()
+                # Replays always read the line combinations again, so every replay does the same work
+                time_stage(timings, "player lines", update_player_line, replay is not None)
+                number_of_games = time_stage(timings, "player games", update_player_game, update_as_of,
+                                             options['concurrency'], batch_size=options['batch_size'],
+                                             grouped_expected_stats=options['grouped_expected_stats'])
+        finally:
+            set_fixture_dirs()
+
+        for stage, seconds in timings:
+            logger.info("Stage " + stage + " took " + "{0:.3f}".format(seconds) + " seconds.")
+        logger.info("Updated " + str(number_of_games) + " games in " + "{0:.3f}".format(timings[-1][1]) + " seconds (" +
+                    "{0:.1f}".format(number_of_games / max(timings[-1][1], 1e-9)) + " games per second), " +
+                    "{0:.3f}".format(sum(seconds for stage, seconds in timings)) + " seconds in total.")
 
 
         # Find point values
@@ -54,9 +89,17 @@ class Command(BaseCommand):
         logger.info('Successfully updated games as of ' + str(options['update_as_of']))
 
 
+def time_stage(timings, stage, function, *args, **kwargs):
+    # Run a stage of the update, adding its wall clock time to timings
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings.append((stage, time.perf_counter() - start))
+    return result
+
+
 def update_teams():
     url = 'https://statsapi.web.nhl.com/api/v1/teams'
-    response = urllib.request.urlopen(url).read()
+    response = cached_urlopen(url)
     data = json.loads(response.decode())
     logger.debug(data)
     for team in data['teams']:
@@ -92,7 +135,7 @@ def update_teams():
 def update_team_stats(season):
     # Create team data
     url = "http://www.nhl.com/stats/rest/grouped/team/basic/season/teamsummary?cayenneExp=seasonId=" + season + "%20and%20gameTypeId=2"
-    response = urllib.request.urlopen(url).read()
+    response = cached_urlopen(url)
     data = json.loads(response.decode())
     logger.info("Updating team stats")
     for team_stat in data['data']:
@@ -134,7 +177,7 @@ def update_games(start_date):
     end_date = timezone.now() + datetime.timedelta(days=1)
     url = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=' + start_date.strftime(
         "%Y-%m-%d") + '&endDate=' + end_date.strftime("%Y-%m-%d")
-    response = urllib.request.urlopen(url).read()
+    response = cached_urlopen(url)
     data = json.loads(response.decode())
     for date in data['dates']:
         for game in date['games']:
@@ -164,99 +207,225 @@ def update_games(start_date):
                     raise e
 
 
-def update_player_game(update_date):
+def update_player_game(update_date, concurrency=1, base_url=statsapi_url, batch_size=0, grouped_expected_stats=False):
     # Create player stats data
-    # Loop through all games in DB where game date gte update date
-    for game in Game.objects.filter(game_date__gte=update_date).order_by('game_pk'):
-        game_pk = game.game_pk
-        url = 'https://statsapi.web.nhl.com/api/v1/game/' + str(game_pk) + '/feed/live'
-        response = urllib.request.urlopen(url).read()
-        gameJSON = json.loads(response.decode())
-
-        if gameJSON['gameData']['status']['statusCode'] != "7":  # Game isn't final, skip
-            logger.info("Game not finished, updating expected stats for game ID: " + str(game_pk))
-            update_player_game_expected_stats(game)
+    # Loop through all games in DB where game date gte update date, returns the number of games updated
+    games = Game.objects.filter(game_date__gte=update_date).order_by('game_pk')
+    number_of_games = 0
+    # Grouped, the expected stats of the unfinished games are found together once all the feeds are read
+    unfinished_games = []
+    if batch_size < 1:
+        for gameJSON, game in get_game_feeds(games, concurrency, base_url):
+            if grouped_expected_stats and not is_game_final(gameJSON):
+                unfinished_games.append(game)
+            else:
+                update_player_game_from_feed(gameJSON, game)
+            number_of_games += 1
+        if unfinished_games:
+            update_player_games_expected_stats(unfinished_games)
+        return number_of_games
+
+    # Batched, finished games are written batch_size games at a time
+    finished_games = []
+    for gameJSON, game in get_game_feeds(games, concurrency, base_url):
+        number_of_games += 1
+        if is_game_final(gameJSON):
+            finished_games.append((gameJSON, game))
+            if len(finished_games) >= batch_size:
+                upsert_player_game_stats(finished_games)
+                finished_games = []
+        elif grouped_expected_stats:
+            unfinished_games.append(game)
         else:
-            logger.info("Updating player stats for game ID: " + str(game_pk))
-            update_player_game_stats(gameJSON, game)
+            update_player_game_from_feed(gameJSON, game)
+    if finished_games:
+        upsert_player_game_stats(finished_games)
+    if unfinished_games:
+        update_player_games_expected_stats(unfinished_games)
+    return number_of_games
+
+
+def get_game_feeds(games, concurrency=1, base_url=statsapi_url):
+    # Yield (gameJSON, game) for each game
+    if concurrency > 1:
+        # Download the feeds side by side, the caller stays the only one writing to the database, feeds still fresh in
+        # the cache (finished games always are) aren't downloaded again
+        games_by_pk = {}
+        for game in games:
+            response = get_cached(get_game_feed_url(game.game_pk, base_url))
+            if response is None:
+                games_by_pk[game.game_pk] = game
+            else:
+                yield json.loads(response.decode()), game
+        for game_pk, response in iterate_game_feeds(list(games_by_pk.keys()), base_url, concurrency):
+            store(get_game_feed_url(game_pk, base_url), response)
+            yield json.loads(response.decode()), games_by_pk[game_pk]
+        return
 
+    for game in games:
+        url = get_game_feed_url(game.game_pk, base_url)
+        response = cached_urlopen(url)
+        yield json.loads(response.decode()), game
 
-def update_player_game_stats(gameJSON, game):
-    awayTeamId = gameJSON['liveData']['boxscore']['teams']['away']['team']['id']
-    homeTeamId = gameJSON['liveData']['boxscore']['teams']['home']['team']['id']
-    try:
-        for playerIndex in gameJSON['liveData']['boxscore']['teams']['away']['players']:
-            playerJSON = gameJSON['liveData']['boxscore']['teams']['away']['players'][playerIndex]
-            position = playerJSON['position']['abbreviation']
 
-            player = Player.objects.update_player(playerJSON['person']['id'])
-            playerGame = PlayerGame(player=player, game=game,
-                                    opponent=Team.objects.get(pk=homeTeamId))
-            playerGame.save()
-            if position in ['RW', 'LW', 'C', 'D']:
-                update_skater_stats(playerJSON, playerGame)
+def is_game_final(gameJSON):
+    return gameJSON['gameData']['status']['statusCode'] == "7"
 
-            elif position == 'G':
-                update_goalie_stats(playerJSON, playerGame)
 
-            else:
-                # raise ValueError("Invalid position.")
-                logger.debug(
-                    "Skipping player ID (most likely did not play): " + str(playerJSON['person']['id']))
+def update_player_game_from_feed(gameJSON, game):
+    game_pk = game.game_pk
+    if not is_game_final(gameJSON):  # Game isn't final, skip
+        logger.info("Game not finished, updating expected stats for game ID: " + str(game_pk))
+        update_player_game_expected_stats(game)
+    else:
+        logger.info("Updating player stats for game ID: " + str(game_pk))
+        update_player_game_stats(gameJSON, game)
 
-        for playerIndex in gameJSON['liveData']['boxscore']['teams']['home']['players']:
-            playerJSON = gameJSON['liveData']['boxscore']['teams']['home']['players'][playerIndex]
-            position = playerJSON['position']['abbreviation']
 
-            player = Player.objects.update_player(playerJSON['person']['id'])
-            playerGame = PlayerGame(player=player, game=game,
-                                    opponent=Team.objects.get(pk=awayTeamId))
-            playerGame.save()
-            if position in ['RW', 'LW', 'C', 'D']:
-                update_skater_stats(playerJSON, playerGame)
+def update_player_game_stats(gameJSON, game):
+    upsert_player_game_stats([(gameJSON, game)])
+
 
-            elif position == 'G':
-                update_goalie_stats(playerJSON, playerGame)
-            else:
-                # raise ValueError("Invalid position.")
-                logger.debug(
-                    "Skipping player ID (most likely did not play): " + str(playerJSON['person']['id']))
+def upsert_player_game_stats(games):
+    # Write the PlayerGame and PlayerGameStats rows of (gameJSON, game) pairs in one transaction, as upserts on their
+    # unique keys, so loading the same games again only rewrites the stats that changed
+    player_game_stats = []
+    for gameJSON, game in games:
+        player_game_stats += get_player_game_stats(gameJSON, game)
+
+    try:
+        with transaction.atomic():
+            inserted = upsert_rows(PlayerGame, [playerGame for playerGame, pgs in player_game_stats],
+                                   ['player_id', 'game_id'], update=False)
+            player_game_ids = {(player_id, game_id): player_game_id for player_id, game_id, player_game_id in
+                               PlayerGame.objects.filter(game_id__in=[game.id for gameJSON, game in games])
+                                   .values_list('player_id', 'game_id', 'id')}
+
+            stats = []
+            for playerGame, pgs in player_game_stats:
+                playerGame.id = player_game_ids[(playerGame.player_id, playerGame.game_id)]
+                if pgs is not None:
+                    # Set again now the PlayerGame has its ID
+                    pgs.player_game = playerGame
+                    stats.append(pgs)
+            old_stats = {pgs.player_game_id: pgs for pgs in
+                         PlayerGameStats.objects.filter(player_game_id__in=[pgs.player_game_id for pgs in stats])}
+            changed = upsert_rows(PlayerGameStats, stats, ['player_game_id'])
+            update_player_aggregates(stats, old_stats)
+        logger.info("Inserted " + str(inserted) + " player games and inserted or changed " + str(changed) +
+                    " player game stats for " + str(len(games)) + " games.")
 
     except Exception as e:
-        logger.error("Could not insert the following player stats:")
-        logger.error(playerJSON)
-        logger.error("Game PK: " + str(game.game_pk))
+        logger.error("Could not insert player stats for game PKs: " + str([game.game_pk for gameJSON, game in games]))
         logger.error("Got the following error:")
         logger.error(e)
-        # Roll back any change if something goes wrong
-        # db.rollback()
         raise e
 
 
-def update_skater_stats(playerJSON, playerGame):
-    pgs = PlayerGameStats(player_game=playerGame,
-                          time_on_ice=playerJSON['stats']['skaterStats']['timeOnIce'],
-                          assists=playerJSON['stats']['skaterStats']['assists'],
-                          goals=playerJSON['stats']['skaterStats']['goals'],
-                          shots=playerJSON['stats']['skaterStats']['shots'],
-                          hits=playerJSON['stats']['skaterStats']['hits'],
-                          power_play_goals=playerJSON['stats']['skaterStats']['powerPlayGoals'],
-                          power_play_assists=playerJSON['stats']['skaterStats']['powerPlayAssists'],
-                          penalty_minutes=playerJSON['stats']['skaterStats']['penaltyMinutes'],
-                          faceoff_wins=playerJSON['stats']['skaterStats']['faceOffWins'],
-                          faceoff_taken=playerJSON['stats']['skaterStats']['faceoffTaken'],
-                          takeaways=playerJSON['stats']['skaterStats']['takeaways'],
-                          giveaways=playerJSON['stats']['skaterStats']['giveaways'],
-                          short_handed_goals=playerJSON['stats']['skaterStats']['shortHandedGoals'],
-                          short_handed_assists=playerJSON['stats']['skaterStats']['shortHandedAssists'],
-                          blocked=playerJSON['stats']['skaterStats']['blocked'],
-                          plus_minus=playerJSON['stats']['skaterStats']['plusMinus'],
-                          even_time_on_ice=playerJSON['stats']['skaterStats']['evenTimeOnIce'],
-                          power_play_time_on_ice=playerJSON['stats']['skaterStats'][
-                              'powerPlayTimeOnIce'],
-                          short_handed_time_on_ice=playerJSON['stats']['skaterStats'][
-                              'shortHandedTimeOnIce'])
-    pgs.save()
+def upsert_rows(model, objects, unique_columns, update=True, rows_per_insert=500, add_columns=()):
+    # INSERT ... ON CONFLICT on the unique columns, rows already there are left alone, or with update only rewritten
+    # when a value differs (the add_columns are added to the values already there instead), returns the number of rows
+    # inserted or changed
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    columns = [field.column for field in fields]
+    quote_name = connection.ops.quote_name
+    table = quote_name(model._meta.db_table)
+    if update:
+        update_columns = [column for column in columns if column not in unique_columns and column != 'created']
+        compared_columns = [column for column in update_columns if column != 'updated']
+        on_conflict = "do update set " + ", ".join(
+            quote_name(column) + " = " + (table + "." + quote_name(column) + " + " if column in add_columns else "") +
+            "excluded." + quote_name(column) for column in update_columns)
+        if not add_columns:
+            on_conflict += " where (" + ", ".join(table + "." + quote_name(column) for column in compared_columns) + \
+                           ") is distinct from (" + \
+                           ", ".join("excluded." + quote_name(column) for column in compared_columns) + ")"
+    else:
+        on_conflict = "do nothing"
+
+    number_of_rows = 0
+    with connection.cursor() as cursor:
+        for start in range(0, len(objects), rows_per_insert):
+            chunk = objects[start:start + rows_per_insert]
+            values = []
+            for obj in chunk:
+                values += [field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields]
+            cursor.execute("insert into " + table + " (" + ", ".join(quote_name(column) for column in columns) +
+                           ") values " + ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(chunk)) +
+                           " on conflict (" + ", ".join(quote_name(column) for column in unique_columns) + ") " +
+                           on_conflict, values)
+            number_of_rows += cursor.rowcount
+    return number_of_rows
+
+
+def get_player_game_stats(gameJSON, game):
+    # Unsaved (PlayerGame, PlayerGameStats) for every player in the boxscore, the stats are None for players that did
+    # not play
+    player_game_stats = []
+    boxscore_teams = gameJSON['liveData']['boxscore']['teams']
+    for side, opponent_side in [('away', 'home'), ('home', 'away')]:
+        opponent = Team.objects.get_team(boxscore_teams[opponent_side]['team']['id'])
+        for playerIndex in boxscore_teams[side]['players']:
+            playerJSON = boxscore_teams[side]['players'][playerIndex]
+            position = playerJSON['position']['abbreviation']
+
+            try:
+                player = Player.objects.update_player(playerJSON['person']['id'])
+                playerGame = PlayerGame(player=player, game=game, opponent=opponent)
+                if position in ['RW', 'LW', 'C', 'D']:
+                    pgs = get_skater_stats(playerJSON, playerGame)
+
+                elif position == 'G':
+                    pgs = get_goalie_stats(playerJSON, playerGame)
+
+                else:
+                    # raise ValueError("Invalid position.")
+                    logger.debug(
+                        "Skipping player ID (most likely did not play): " + str(playerJSON['person']['id']))
+                    pgs = None
+
+            except Exception as e:
+                logger.error("Could not read the following player stats:")
+                logger.error(playerJSON)
+                logger.error("Game PK: " + str(game.game_pk))
+                logger.error("Got the following error:")
+                logger.error(e)
+                raise e
+
+            player_game_stats.append((playerGame, pgs))
+    return player_game_stats
+
+
+def get_skater_stats(playerJSON, playerGame):
+    return PlayerGameStats(player_game=playerGame,
+                           time_on_ice=playerJSON['stats']['skaterStats']['timeOnIce'],
+                           time_on_ice_seconds=get_seconds(playerJSON['stats']['skaterStats']['timeOnIce']),
+                           assists=playerJSON['stats']['skaterStats']['assists'],
+                           goals=playerJSON['stats']['skaterStats']['goals'],
+                           shots=playerJSON['stats']['skaterStats']['shots'],
+                           hits=playerJSON['stats']['skaterStats']['hits'],
+                           power_play_goals=playerJSON['stats']['skaterStats']['powerPlayGoals'],
+                           power_play_assists=playerJSON['stats']['skaterStats']['powerPlayAssists'],
+                           penalty_minutes=playerJSON['stats']['skaterStats']['penaltyMinutes'],
+                           penalty_seconds=get_seconds(playerJSON['stats']['skaterStats']['penaltyMinutes']),
+                           faceoff_wins=playerJSON['stats']['skaterStats']['faceOffWins'],
+                           faceoff_taken=playerJSON['stats']['skaterStats']['faceoffTaken'],
+                           takeaways=playerJSON['stats']['skaterStats']['takeaways'],
+                           giveaways=playerJSON['stats']['skaterStats']['giveaways'],
+                           short_handed_goals=playerJSON['stats']['skaterStats']['shortHandedGoals'],
+                           short_handed_assists=playerJSON['stats']['skaterStats']['shortHandedAssists'],
+                           blocked=playerJSON['stats']['skaterStats']['blocked'],
+                           plus_minus=playerJSON['stats']['skaterStats']['plusMinus'],
+                           even_time_on_ice=playerJSON['stats']['skaterStats']['evenTimeOnIce'],
+                           even_time_on_ice_seconds=get_seconds(playerJSON['stats']['skaterStats']['evenTimeOnIce']),
+                           power_play_time_on_ice=playerJSON['stats']['skaterStats'][
+                               'powerPlayTimeOnIce'],
+                           power_play_time_on_ice_seconds=get_seconds(playerJSON['stats']['skaterStats'][
+                                                                          'powerPlayTimeOnIce']),
+                           short_handed_time_on_ice=playerJSON['stats']['skaterStats'][
+                               'shortHandedTimeOnIce'],
+                           short_handed_time_on_ice_seconds=get_seconds(playerJSON['stats']['skaterStats'][
+                                                                            'shortHandedTimeOnIce']))
 
 
 def update_skater_expected_stats(playerGame, average_goals_against_for_league):
@@ -295,24 +464,25 @@ def update_skater_expected_stats(playerGame, average_goals_against_for_league):
         raise e
 
 
-def update_goalie_stats(playerJSON, playerGame):
-    pgs = PlayerGameStats(player_game=playerGame,
-                          time_on_ice=playerJSON['stats']['goalieStats']['timeOnIce'],
-                          assists=playerJSON['stats']['goalieStats']['assists'],
-                          goals=playerJSON['stats']['goalieStats']['goals'],
-                          penalty_minutes=playerJSON['stats']['goalieStats']['pim'],
-                          shots_against=playerJSON['stats']['goalieStats']['shots'],
-                          saves=playerJSON['stats']['goalieStats']['saves'],
-                          power_play_saves=playerJSON['stats']['goalieStats']['powerPlaySaves'],
-                          short_handed_saves=playerJSON['stats']['goalieStats']['shortHandedSaves'],
-                          even_saves=playerJSON['stats']['goalieStats']['evenSaves'],
-                          short_handed_shots_against=playerJSON['stats']['goalieStats'][
-                              'shortHandedShotsAgainst'],
-                          even_shots_against=playerJSON['stats']['goalieStats']['evenShotsAgainst'],
-                          power_play_shots_against=playerJSON['stats']['goalieStats'][
-                              'powerPlayShotsAgainst'],
-                          decision=playerJSON['stats']['goalieStats']['decision'])
-    pgs.save()
+def get_goalie_stats(playerJSON, playerGame):
+    return PlayerGameStats(player_game=playerGame,
+                           time_on_ice=playerJSON['stats']['goalieStats']['timeOnIce'],
+                           time_on_ice_seconds=get_seconds(playerJSON['stats']['goalieStats']['timeOnIce']),
+                           assists=playerJSON['stats']['goalieStats']['assists'],
+                           goals=playerJSON['stats']['goalieStats']['goals'],
+                           penalty_minutes=playerJSON['stats']['goalieStats']['pim'],
+                           penalty_seconds=get_seconds(playerJSON['stats']['goalieStats']['pim']),
+                           shots_against=playerJSON['stats']['goalieStats']['shots'],
+                           saves=playerJSON['stats']['goalieStats']['saves'],
+                           power_play_saves=playerJSON['stats']['goalieStats']['powerPlaySaves'],
+                           short_handed_saves=playerJSON['stats']['goalieStats']['shortHandedSaves'],
+                           even_saves=playerJSON['stats']['goalieStats']['evenSaves'],
+                           short_handed_shots_against=playerJSON['stats']['goalieStats'][
+                               'shortHandedShotsAgainst'],
+                           even_shots_against=playerJSON['stats']['goalieStats']['evenShotsAgainst'],
+                           power_play_shots_against=playerJSON['stats']['goalieStats'][
+                               'powerPlayShotsAgainst'],
+                           decision=playerJSON['stats']['goalieStats']['decision'])
 
 
 def update_goalie_expected_stats(playerGame):
@@ -406,13 +576,13 @@ def update_player_line(force_update=False):
         else:
             logging.info("Finding line combinations...")
             url = "http://www2.dailyfaceoff.com/teams"
-            soup = BeautifulSoup(urllib.request.urlopen(url).read(), "html.parser")
+            soup = BeautifulSoup(cached_urlopen(url), "html.parser")
             teams = soup.find(id="matchups_container")
             for team in teams.find_all("a"):
                 url = team.get("href")
                 if url.startswith("/teams"):
                     url = "http://www2.dailyfaceoff.com" + team.get("href")
-                    soup = BeautifulSoup(urllib.request.urlopen(url).read(), "html.parser")
+                    soup = BeautifulSoup(cached_urlopen(url), "html.parser")
                     lineups = soup.find(id="matchups_container")
                     for td in lineups.find_all("td"):
                         logging.debug(td)
@@ -448,7 +618,7 @@ def update_game_odds():
     try:
         # Use Vegas Insider
         url = "http://www.vegasinsider.com/nhl/odds/las-vegas/"
-        soup = BeautifulSoup(urllib.request.urlopen(url).read(), "lxml")
+        soup = BeautifulSoup(cached_urlopen(url), "lxml")
         table = soup.find('table', attrs={'class': 'frodds-data-tbl'})
         rows = table.find_all('tr')
         for i in range(len(rows)):
@@ -512,6 +682,75 @@ def update_game_odds():
         raise e
 
 
+# Seasons the expected stats are averaged over, with the games of the last two weeks as a third period
+last_season = 20152016
+this_season = 20162017
+recent_days = 14
+
+
+def update_player_aggregates(stats, old_stats):
+    # Add the difference each player game's stats make to the season and daily totals of its player (all of them for
+    # a new game, nothing for a game loaded again unchanged), old_stats are the rows being replaced by player game ID
+    season_totals = {}
+    daily_totals = {}
+    for pgs in stats:
+        game = pgs.player_game.game
+        if not is_aggregated_game(game):
+            continue
+        values = get_aggregate_values(pgs)
+        if pgs.player_game_id in old_stats:
+            old_values = get_aggregate_values(old_stats[pgs.player_game_id])
+            values = {field: value - old_values[field] for field, value in values.items()}
+            if not any(values.values()):
+                continue
+
+        player_id = pgs.player_game.player_id
+        date = timezone.localtime(game.game_date).date()
+        for totals in [season_totals.setdefault((player_id, game.season), {}),
+                       daily_totals.setdefault((player_id, game.season, date), {})]:
+            for field, value in values.items():
+                totals[field] = totals.get(field, 0) + value
+
+    add_columns = ['games'] + aggregate_fields
+    upsert_rows(PlayerSeasonAggregate, [PlayerSeasonAggregate(player_id=player_id, season=season, **totals)
+                                        for (player_id, season), totals in season_totals.items()],
+                ['player_id', 'season'], add_columns=add_columns)
+    upsert_rows(PlayerDailyAggregate, [PlayerDailyAggregate(player_id=player_id, season=season, date=date, **totals)
+                                       for (player_id, season, date), totals in daily_totals.items()],
+                ['player_id', 'date'], add_columns=add_columns)
+
+
+def get_aggregated_player_stats(player_ids):
+    # Averages of each stat last season, this season and the last two weeks, with the number of games in each (see
+    # set_weighted_stats), by player ID from the season rows and a sum of the recent daily rows of the players
+    player_stats = {}
+
+    def add_period(totals, period):
+        stats = player_stats.setdefault(totals['player_id'], {'games_last_year': 0, 'games_this_year': 0,
+                                                               'games_last_two_weeks': 0})
+        stats['games_' + period] = totals['games']
+        for field in aggregate_fields + ['shootout_goals']:
+            stats['average_' + field + '_' + period] = totals.get(field, 0) / totals['games'] if totals['games'] else 0
+
+    seasons = [last_season, this_season]
+    for totals in PlayerSeasonAggregate.objects.filter(player_id__in=player_ids, season__in=seasons) \
+            .values('player_id', 'season', 'games', *aggregate_fields):
+        add_period(totals, 'last_year' if totals['season'] == last_season else 'this_year')
+
+    recent_date = timezone.localdate() - datetime.timedelta(days=recent_days)
+    for totals in PlayerDailyAggregate.objects.filter(player_id__in=player_ids, season__in=seasons,
+                                                      date__gt=recent_date) \
+            .values('player_id').annotate(games=Sum('games'), **{field: Sum(field) for field in aggregate_fields}):
+        add_period(totals, 'last_two_weeks')
+
+    # Players without games in one of the periods average 0 in it
+    for stats in player_stats.values():
+        for period in ['last_year', 'this_year', 'last_two_weeks']:
+            for field in aggregate_fields + ['shootout_goals']:
+                stats.setdefault('average_' + field + '_' + period, 0)
+    return player_stats
+
+
 def dictfetchall(cursor):
     "Return all rows from a cursor as a dict"
     columns = [col[0] for col in cursor.description]
@@ -521,6 +760,28 @@ def dictfetchall(cursor):
         ]
 
 
+def set_weighted_stats(stats, player_stats, player_id):
+    # Calculate value (ignore players that haven't played a game this year)
+    if player_stats['games_this_year'] != 0:
+        # Calculate total games (will be over one due to last two weeks, but want to find the ratio for each stat)
+        total_games = player_stats['games_last_year'] + player_stats['games_this_year'] + player_stats[
+            'games_last_two_weeks']
+        games_last_year_ratio = player_stats['games_last_year'] / total_games
+        games_this_year_ratio = player_stats['games_this_year'] / total_games
+        games_last_two_weeks_ratio = player_stats['games_last_two_weeks'] / total_games
+        logging.debug("Total games last year is " + str(player_stats['games_last_year']))
+        logging.debug("Total games this year is " + str(player_stats['games_this_year']))
+        logging.debug("Total games last two weeks is " + str(player_stats['games_last_two_weeks']))
+
+        # Loop through and get an adjusted value based on each time interval
+        for key, value in stats.items():
+            stats[key] = games_last_year_ratio * float(player_stats['average_' + key + '_last_year']) + \
+                         games_this_year_ratio * float(player_stats['average_' + key + '_this_year']) + \
+                         games_last_two_weeks_ratio * float(player_stats['average_' + key + '_last_two_weeks'])
+            logging.debug("For player id " + str(player_id) + ": " + key + " = " + str(stats[key]) + "")
+    return stats
+
+
 def get_expected_skater_stats(playerGame):
     skater_stats = {"goals": 0,
                     "assists": 0,
@@ -536,62 +797,10 @@ def get_expected_skater_stats(playerGame):
     try:
         logging.debug("Getting player value for " + str(playerGame.player_id))
         # Find average points for last week and for the year
-        with connection.cursor() as cursor:
-            cursor.execute('''select coalesce(avg(case when g.game_pk between 2015020001 and 2015039999 then pgs.goals else null end),0) AS average_goals_last_year,
-                coalesce(avg(case when g.game_pk between 2016020001 and 2016039999 then pgs.goals else null end),0) AS average_goals_this_year,
-                coalesce(avg(case when g.game_date > localtimestamp - interval '14 days' then pgs.goals else null end),0) AS average_goals_last_two_weeks,
-                coalesce(avg(case when g.game_pk between 2015020001 and 2015039999 then pgs.assists else null end),0) AS average_assists_last_year,
-                coalesce(avg(case when g.game_pk between 2016020001 and 2016039999 then pgs.assists else null end),0) AS average_assists_this_year,
-                coalesce(avg(case when g.game_date > localtimestamp - interval '14 days' then pgs.assists else null end),0) AS average_assists_last_two_weeks,
-                coalesce(avg(case when g.game_pk between 2015020001 and 2015039999 then pgs.shots else null end),0) AS average_shots_on_goal_last_year,
-                coalesce(avg(case when g.game_pk between 2016020001 and 2016039999 then pgs.shots else null end),0) AS average_shots_on_goal_this_year,
-                coalesce(avg(case when g.game_date > localtimestamp - interval '14 days' then pgs.shots else null end),0) AS average_shots_on_goal_last_two_weeks,
-                coalesce(avg(case when g.game_pk between 2015020001 and 2015039999 then pgs.blocked else null end),0) AS average_blocked_shots_last_year,
-                coalesce(avg(case when g.game_pk between 2016020001 and 2016039999 then pgs.blocked else null end),0) AS average_blocked_shots_this_year,
-                coalesce(avg(case when g.game_date > localtimestamp - interval '14 days' then pgs.blocked else null end),0) AS average_blocked_shots_last_two_weeks,
-                coalesce(avg(case when g.game_pk between 2015020001 and 2015039999 then pgs.short_handed_goals + pgs.short_handed_assists else null end),0) AS average_short_handed_points_last_year,
-                coalesce(avg(case when g.game_pk between 2016020001 and 2016039999 then pgs.short_handed_goals + pgs.short_handed_assists else null end),0) AS average_short_handed_points_this_year,
-                coalesce(avg(case when g.game_date > localtimestamp - interval '14 days' then pgs.short_handed_goals + pgs.short_handed_assists else null end),0) AS average_short_handed_points_last_two_weeks,
-                0 average_shootout_goals_last_year,
-                0 average_shootout_goals_this_year,
-                0 average_shootout_goals_last_two_weeks,
-                coalesce(avg(case when g.game_pk between 2015020001 and 2015039999 then (case when pgs.goals >= 3 then 1 else 0 end) else null end),0) AS average_hat_tricks_last_year,
-                coalesce(avg(case when g.game_pk between 2016020001 and 2016039999 then (case when pgs.goals >= 3 then 1 else 0 end) else null end),0) AS average_hat_tricks_this_year,
-                coalesce(avg(case when g.game_date > localtimestamp - interval '14 days' then (case when pgs.goals >= 3 then 1 else 0 end) else null end),0) AS average_hat_tricks_last_two_weeks,
-                count(case when g.game_pk between 2015020001 and 2015039999 then 1 else null end) as games_last_year,
-                count(case when g.game_pk between 2016020001 and 2016039999 then 1 else null end) as games_this_year,
-                count(case when g.game_date > localtimestamp - interval '14 days' then 1 else null end) AS games_last_two_weeks
-            from lineups_playergamestats pgs
-            inner join lineups_playergame pg
-            on pgs.player_game_id = pg.id
-            inner join lineups_game g
-            on pg.game_id = g.id
-            where pg.player_id = %s and
-                (g.game_pk between 2015020001 and 2016039999)''', [playerGame.player_id])
-
-            value = 0
-            for player_stats in dictfetchall(cursor):
-                # Calculate value (ignore players that haven't played a game this year)
-                if player_stats['games_this_year'] != 0:
-                    # Calculate total games (will be over one due to last two weeks, but want to find the ratio for each stat)
-                    total_games = player_stats['games_last_year'] + player_stats['games_this_year'] + player_stats[
-                        'games_last_two_weeks']
-                    games_last_year_ratio = player_stats['games_last_year'] / total_games
-                    games_this_year_ratio = player_stats['games_this_year'] / total_games
-                    games_last_two_weeks_ratio = player_stats['games_last_two_weeks'] / total_games
-                    logging.debug("Total games last year is " + str(player_stats['games_last_year']))
-                    logging.debug("Total games this year is " + str(player_stats['games_this_year']))
-                    logging.debug("Total games last two weeks is " + str(player_stats['games_last_two_weeks']))
-
-                    # Loop through and get an adjusted value based on each time interval
-                    for key, value in skater_stats.items():
-                        skater_stats[key] = games_last_year_ratio * float(
-                            player_stats['average_' + key + '_last_year']) + games_this_year_ratio * float(
-                            player_stats['average_' + key + '_this_year']) + games_last_two_weeks_ratio * float(
-                            player_stats['average_' + key + '_last_two_weeks'])
-                        logging.debug("For player id " + str(playerGame.player_id) + ": " + key + " = " + str(skater_stats[key]) + "")
-
-            return skater_stats
+        for player_stats in get_aggregated_player_stats([playerGame.player_id]).values():
+            set_weighted_stats(skater_stats, player_stats, playerGame.player_id)
+
+        return skater_stats
 
     except Exception as e:
         logging.error("Could not get skater expected stats.")
@@ -613,58 +822,10 @@ def get_expected_goalie_stats(playerGame):
     try:
         logging.debug("Getting player value for " + str(playerGame.player_id))
         # Find average points for last week and for the year
-        with connection.cursor() as cursor:
-            cursor.execute('''select coalesce(avg(case when g.game_pk between 2015020001 and 2015039999 then (case when pgs.decision = 'W' then 1 else 0 end) else null end),0) AS average_wins_last_year,
-                coalesce(avg(case when g.game_pk between 2016020001 and 2016039999 then (case when pgs.decision = 'W' then 1 else 0 end) else null end),0) AS average_wins_this_year,
-                coalesce(avg(case when g.game_date > localtimestamp - interval '14 days' then (case when pgs.decision = 'W' then 1 else 0 end) else null end),0) AS average_wins_last_two_weeks,
-                coalesce(avg(case when g.game_pk between 2015020001 and 2015039999 then pgs.saves else null end),0) AS average_saves_last_year,
-                coalesce(avg(case when g.game_pk between 2016020001 and 2016039999 then pgs.saves else null end),0) AS average_saves_this_year,
-                coalesce(avg(case when g.game_date > localtimestamp - interval '14 days' then pgs.saves else null end),0) AS average_saves_last_two_weeks,
-                coalesce(avg(case when g.game_pk between 2015020001 and 2015039999 then pgs.shots_against - pgs.saves else null end),0) AS average_goals_against_last_year,
-                coalesce(avg(case when g.game_pk between 2016020001 and 2016039999 then pgs.shots_against - pgs.saves else null end),0) AS average_goals_against_this_year,
-                coalesce(avg(case when g.game_date > localtimestamp - interval '14 days' then pgs.shots_against - pgs.saves else null end),0) AS average_goals_against_last_two_weeks,
-                coalesce(avg(case when g.game_pk between 2015020001 and 2015039999 then (case when pgs.decision = 'W' and pgs.shots_against = pgs.saves and pgs.time_on_ice > '59:30' then 1 else 0 end) else null end),0) AS average_shutouts_last_year,
-                coalesce(avg(case when g.game_pk between 2016020001 and 2016039999 then (case when pgs.decision = 'W' and pgs.shots_against = pgs.saves and pgs.time_on_ice > '59:30' then 1 else 0 end) else null end),0) AS average_shutouts_this_year,
-                coalesce(avg(case when g.game_date > localtimestamp - interval '14 days' then (case when pgs.decision = 'W' and pgs.shots_against = pgs.saves and pgs.time_on_ice > '59:30' then 1 else 0 end) else null end),0) AS average_shutouts_last_two_weeks,
-                coalesce(avg(case when g.game_pk between 2015020001 and 2015039999 then pgs.goals else null end),0) AS average_goals_last_year,
-                coalesce(avg(case when g.game_pk between 2016020001 and 2016039999 then pgs.goals else null end),0) AS average_goals_this_year,
-                coalesce(avg(case when g.game_date > localtimestamp - interval '14 days' then pgs.goals else null end),0) AS average_goals_last_two_weeks,
-                coalesce(avg(case when g.game_pk between 2015020001 and 2015039999 then pgs.assists else null end),0) AS average_assists_last_year,
-                coalesce(avg(case when g.game_pk between 2016020001 and 2016039999 then pgs.assists else null end),0) AS average_assists_this_year,
-                coalesce(avg(case when g.game_date > localtimestamp - interval '14 days' then pgs.assists else null end),0) AS average_assists_last_two_weeks,
-                count(case when g.game_pk between 2015020001 and 2015039999 then 1 else null end) as games_last_year,
-                count(case when g.game_pk between 2016020001 and 2016039999 then 1 else null end) as games_this_year,
-                count(case when g.game_date > localtimestamp - interval '14 days' then 1 else null end) AS games_last_two_weeks
-            from lineups_playergamestats pgs
-            inner join lineups_playergame pg
-            on pgs.player_game_id = pg.id
-            inner join lineups_game g
-            on pg.game_id = g.id
-            where pg.player_id = %s and
-                (g.game_pk between 2015020001 and 2016039999)''', [playerGame.player_id])
-
-            value = 0
-            for player_stats in dictfetchall(cursor):
-                # Calculate value (ignore players that haven't played a game this year)
-                if player_stats['games_this_year'] != 0:
-                    # Calculate total games (will be over one due to last two weeks, but want to find the ratio for each stat)
-                    total_games = player_stats['games_last_year'] + player_stats['games_this_year'] + player_stats[
-                        'games_last_two_weeks']
-                    games_last_year_ratio = player_stats['games_last_year'] / total_games
-                    games_this_year_ratio = player_stats['games_this_year'] / total_games
-                    games_last_two_weeks_ratio = player_stats['games_last_two_weeks'] / total_games
-                    logging.debug("Total games last year is " + str(player_stats['games_last_year']))
-                    logging.debug("Total games this year is " + str(player_stats['games_this_year']))
-                    logging.debug("Total games last two weeks is " + str(player_stats['games_last_two_weeks']))
-
-                    # Loop through and get an adjusted value based on each time interval
-                    for key, value in goalie_stats.items():
-                        goalie_stats[key] = games_last_year_ratio * float(player_stats['average_' + key + '_last_year']) + \
-                                            games_this_year_ratio * float(player_stats['average_' + key + '_this_year']) + \
-                                            games_last_two_weeks_ratio * float(player_stats['average_' + key + '_last_two_weeks'])
-                        logging.debug("For player id " + str(playerGame.player_id) + ": " + key + " = " + str(goalie_stats[key]) + "")
-
-            return goalie_stats
+        for player_stats in get_aggregated_player_stats([playerGame.player_id]).values():
+            set_weighted_stats(goalie_stats, player_stats, playerGame.player_id)
+
+        return goalie_stats
 
     except Exception as e:
         logging.error("Could not get goalie expected stats.")
@@ -688,8 +849,8 @@ def update_player_game_expected_stats(game):
 
         # Find all players on the home team
         for player in Player.objects.filter(team_id=game.home_team_id, active=True):
-            playerGame = PlayerGame(player=player, game=game, opponent_id=game.away_team_id)
-            playerGame.save()
+            playerGame, created = PlayerGame.objects.get_or_create(player=player, game=game,
+                                                                   defaults={'opponent_id': game.away_team_id})
             if player.primary_position_abbr in ['RW', 'LW', 'C', 'D']:
                 update_skater_expected_stats(playerGame, average_goals_against_for_league)
             elif player.primary_position_abbr == 'G':
@@ -700,8 +861,8 @@ def update_player_game_expected_stats(game):
 
         # Find all players on the away team
         for player in Player.objects.filter(team_id=game.away_team_id, active=True):
-            playerGame = PlayerGame(player=player, game=game, opponent_id=game.home_team_id)
-            playerGame.save()
+            playerGame, created = PlayerGame.objects.get_or_create(player=player, game=game,
+                                                                   defaults={'opponent_id': game.home_team_id})
             if player.primary_position_abbr in ['RW', 'LW', 'C', 'D']:
                 update_skater_expected_stats(playerGame, average_goals_against_for_league)
             elif player.primary_position_abbr == 'G':
@@ -716,6 +877,116 @@ def update_player_game_expected_stats(game):
         logging.error(e)
         raise e
 
+
+def update_player_games_expected_stats(games):
+    # Set-based update_player_game_expected_stats for a game or a whole slate, the player games of every active player
+    # are inserted at once, their averages are read from the player aggregates together and the expected stats are
+    # written with one upsert
+    try:
+        average_goals_against_for_league = get_average_goals_against_for_league()
+        goals_against_per_game = dict(TeamStats.objects.values_list('team_id', 'goals_against_per_game'))
+        game_odds_by_game = {}
+        for game_odds in GameOdds.objects.filter(game__in=[game.id for game in games]).select_related('game'):
+            game_odds_by_game.setdefault(game_odds.game_id, []).append(game_odds)
+
+        players_by_team = {}
+        for player in Player.objects.filter(team_id__in=[team_id for game in games for team_id in
+                                                         [game.home_team_id, game.away_team_id]], active=True):
+            players_by_team.setdefault(player.team_id, []).append(player)
+
+        with transaction.atomic():
+            player_games = []
+            for game in games:
+                for team_id, opponent_id in [(game.home_team_id, game.away_team_id),
+                                             (game.away_team_id, game.home_team_id)]:
+                    for player in players_by_team.get(team_id, []):
+                        if player.primary_position_abbr in ['RW', 'LW', 'C', 'D', 'G']:
+                            player_games.append(PlayerGame(player=player, game=game, opponent_id=opponent_id))
+                        else:
+                            logger.debug("Skipping player ID (unknown position): " + str(player))
+            upsert_rows(PlayerGame, player_games, ['player_id', 'game_id'], update=False)
+            player_game_ids = {(player_id, game_id): player_game_id for player_id, game_id, player_game_id in
+                               PlayerGame.objects.filter(game_id__in=[game.id for game in games])
+                                   .values_list('player_id', 'game_id', 'id')}
+
+            player_stats_by_player = get_aggregated_player_stats(
+                set(playerGame.player_id for playerGame in player_games))
+            expected_stats = []
+            for playerGame in player_games:
+                playerGame.id = player_game_ids[(playerGame.player_id, playerGame.game_id)]
+                player_stats = player_stats_by_player.get(playerGame.player_id)
+                if playerGame.player.primary_position_abbr == 'G':
+                    game_odds = game_odds_by_game.get(playerGame.game_id, [])
+                    expected_stats.append(get_grouped_goalie_expected_stats(playerGame, player_stats, game_odds))
+                else:
+                    goals_against_percentage = goals_against_per_game[playerGame.opponent_id] / \
+                                               average_goals_against_for_league
+                    expected_stats.append(get_grouped_skater_expected_stats(playerGame, player_stats,
+                                                                            goals_against_percentage))
+            changed = upsert_rows(PlayerGameExpectedStats, expected_stats, ['player_game_id'])
+        logger.info("Inserted or changed " + str(changed) + " expected stats of " + str(len(expected_stats)) +
+                    " players for " + str(len(games)) + " games.")
+
+    except Exception as e:
+        logging.error("Could not update expected stats for games " + str([str(game) for game in games]))
+        logging.error("Got the following error:")
+        logging.error(e)
+        raise e
+
+
+def get_grouped_skater_expected_stats(playerGame, player_stats, goals_against_percentage):
+    # Same as update_skater_expected_stats, from the player's row of get_aggregated_player_stats
+    stats = {"goals": 0,
+             "assists": 0,
+             "shots_on_goal": 0,
+             "blocked_shots": 0,
+             "short_handed_points": 0,
+             "shootout_goals": 0,
+             "hat_tricks": 0}
+    if player_stats is not None:
+        set_weighted_stats(stats, player_stats, playerGame.player_id)
+    return PlayerGameExpectedStats(player_game=playerGame,
+                                   goals=stats['goals'] * goals_against_percentage,
+                                   assists=stats['assists'] * goals_against_percentage,
+                                   shots_on_goal=stats['shots_on_goal'],
+                                   blocked_shots=stats['blocked_shots'],
+                                   short_handed_points=stats['short_handed_points'],
+                                   shootout_goals=stats['shootout_goals'],
+                                   hat_tricks=stats['hat_tricks'],
+                                   wins=0,
+                                   saves=0,
+                                   goals_against=0,
+                                   shutouts=0)
+
+
+def get_grouped_goalie_expected_stats(playerGame, player_stats, game_odds):
+    # Same as update_goalie_expected_stats, from the player's row of get_aggregated_player_stats and the game's odds
+    stats = {"wins": 0,
+             "saves": 0,
+             "goals_against": 0,
+             "shutouts": 0,
+             "goals": 0,
+             "assists": 0}
+    if player_stats is not None:
+        set_weighted_stats(stats, player_stats, playerGame.player_id)
+    for odds in game_odds:
+        if odds.game.home_team_id == playerGame.player.team_id:
+            stats['wins'] = odds.home_probability
+        elif odds.game.away_team_id == playerGame.player.team_id:
+            stats['wins'] = odds.away_probability
+    return PlayerGameExpectedStats(player_game=playerGame,
+                                   goals=stats['goals'],
+                                   assists=stats['assists'],
+                                   shots_on_goal=0,
+                                   blocked_shots=0,
+                                   short_handed_points=0,
+                                   shootout_goals=0,
+                                   hat_tricks=0,
+                                   wins=stats['wins'],
+                                   saves=stats['saves'],
+                                   goals_against=stats['goals_against'],
+                                   shutouts=stats['shutouts'])
+
 # def update_games_draftkings_points(db, update_date):
 #     # Draftkings point system:
 #     # Players will accumulate points as follows:
@@ -1,28 +1,108 @@
+import contextlib
 import datetime
 import json
 import logging
 import pytz
+import threading
 import urllib.request
 
 from django.db import models
 from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+
+from lineups.http_cache import cached_urlopen
 
 logger = logging.getLogger('django')
 date_format = "%Y-%m-%d"
 
+# Run-scoped identity map, inside identity_map_scope() the Player and Team lookups of the managers below are served
+# from all the rows of each table, loaded with one query the first time the table is used. Rows saved or deleted
+# through the ORM (post_save, post_delete) replace or drop their entry, queryset update() and raw SQL aren't seen.
+local = threading.local()
+
+
+class IdentityMap(object):
+    def __init__(self):
+        self.rows = {}
+        self.indexes = {}
+
+    def get_rows(self, manager):
+        model = manager.model
+        if model not in self.rows:
+            self.rows[model] = {row.pk: row for row in manager.get_queryset()}
+            logger.debug("Loaded " + str(len(self.rows[model])) + " " + model.__name__ + " rows")
+        return self.rows[model]
+
+    def get(self, manager, pk):
+        return self.get_rows(manager).get(manager.model._meta.pk.to_python(pk))
+
+    def get_pk_by(self, manager, field, value):
+        # First row with the value, from an index of the field built on first use
+        key = (manager.model, field)
+        if key not in self.indexes:
+            index = {}
+            for pk, row in self.get_rows(manager).items():
+                index.setdefault(getattr(row, field), pk)
+            self.indexes[key] = index
+        return self.indexes[key].get(value)
+
+    def saved(self, model, instance):
+        if model in self.rows:
+            self.rows[model][model._meta.pk.to_python(instance.pk)] = instance
+            self.forget_indexes(model)
+
+    def deleted(self, model, instance):
+        if model in self.rows:
+            self.rows[model].pop(model._meta.pk.to_python(instance.pk), None)
+            self.forget_indexes(model)
+
+    def forget_indexes(self, model):
+        for key in [key for key in self.indexes if key[0] == model]:
+            del self.indexes[key]
+
+
+def get_identity_map():
+    return getattr(local, 'identity_map', None)
+
+
+@contextlib.contextmanager
+def identity_map_scope():
+    local.identity_map = IdentityMap()
+    try:
+        yield local.identity_map
+    finally:
+        local.identity_map = None
+
+
+def update_identity_map(sender, instance, **kwargs):
+    identity_map = get_identity_map()
+    if identity_map is not None:
+        identity_map.saved(sender, instance)
+
+
+def remove_from_identity_map(sender, instance, **kwargs):
+    identity_map = get_identity_map()
+    if identity_map is not None:
+        identity_map.deleted(sender, instance)
+
+
+post_save.connect(update_identity_map)
+post_delete.connect(remove_from_identity_map)
+
 
 class PlayerManager(models.Manager):
     def update_player(self, playerName, force_update=False):
         playerId = self.get_player_id_by_name(playerName)
+        player = None if force_update == True else self.get_player(playerId)
         # TODO: Check into any potential player updates
-        if self.model.objects.filter(id=playerId).exists() and force_update != True:
+        if player is not None:
             logger.debug("Skipping player ID: " + str(playerId))
-            return self.get(pk=playerId)
+            return player
         else:
             try:
                 logger.info("Updating player ID: " + str(playerId))
                 url = 'https://statsapi.web.nhl.com/api/v1/people/' + str(playerId)
-                response = urllib.request.urlopen(url).read()
+                response = cached_urlopen(url)
                 data = json.loads(response.decode())
 
                 for player in data['people']:
@@ -107,10 +187,27 @@ class PlayerManager(models.Manager):
                 # db.rollback()
                 raise e
 
+    def get_player(self, playerId):
+        # Player with the ID, None if there isn't one
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            return identity_map.get(self, playerId)
+        return self.filter(id=playerId).first()
+
     def get_player_id_by_name(self, playerName):
         try:
-            for player in self.model.objects.filter(full_name=playerName):
-                return player.id
+            # Ingestion passes the person ID from the game feeds
+            if isinstance(playerName, int):
+                return playerName
+
+            identity_map = get_identity_map()
+            if identity_map is not None:
+                playerId = identity_map.get_pk_by(self, 'full_name', playerName)
+                if playerId is not None:
+                    return playerId
+            else:
+                for player in self.model.objects.filter(full_name=playerName):
+                    return player.id
 
             # Couldn't find the player, use the NHL suggest search
             lastName = playerName.split(None, 1)[1].strip()
@@ -119,7 +216,7 @@ class PlayerManager(models.Manager):
 
             # Search by last name, then first name for all suggestions if more than one
             url = "https://suggest.svc.nhl.com/svc/suggest/v1/minactiveplayers/" + urllib.parse.quote(lastName) + "/99999"
-            response = urllib.request.urlopen(url).read()
+            response = cached_urlopen(url)
             data = json.loads(response.decode())
             # Response example: {"suggestions":["8477971|Englund|Andreas|1|0|6\u0027 3\"|189|Stockholm||SWE|1996-01-21|OTT|D|39|andreas-englund-8477971"]}
             if len(data['suggestions']) == 1:
@@ -132,7 +229,7 @@ class PlayerManager(models.Manager):
 
             # Nothing was found, so search by first name and look for last name
             url = "https://suggest.svc.nhl.com/svc/suggest/v1/minactiveplayers/" + urllib.parse.quote(firstName) + "/99999"
-            response = urllib.request.urlopen(url).read()
+            response = cached_urlopen(url)
             data = json.loads(response.decode())
             if len(data['suggestions']) == 1:
                 return data['suggestions'][0].split("|")[0]
@@ -169,7 +266,7 @@ class GameManager(models.Manager):
         try:
             # Find the latest gamePk with the given team IDs
             for game in self.model.objects.filter(Q(home_team_id=home_team_id), Q(away_team_id=away_team_id)).order_by(
-                    '-game_pk'):
+                    '-game_pk')[:1]:
                 return game.game_pk
 
         except Exception as e:
@@ -193,6 +290,15 @@ class GameManager(models.Manager):
             raise e
 
 class TeamManager(models.Manager):
+    def get_team(self, team_id):
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            team = identity_map.get(self, team_id)
+            if team is None:
+                raise self.model.DoesNotExist("Team matching query does not exist: " + str(team_id))
+            return team
+        return self.get(pk=team_id)
+
     def get_team_id(self, team_name):
         try:
             for team in self.model.objects.filter(Q(name=team_name) | Q(team_name=team_name.split()[1])):
@@ -206,8 +312,14 @@ class TeamManager(models.Manager):
 
     def get_team_id_by_city(self, team_city):
         try:
-            for team in self.model.objects.filter(location_name=team_city):
-                return team.id
+            identity_map = get_identity_map()
+            if identity_map is not None:
+                team_id = identity_map.get_pk_by(self, 'location_name', team_city)
+                if team_id is not None:
+                    return team_id
+            else:
+                for team in self.model.objects.filter(location_name=team_city):
+                    return team.id
 
             if team_city == "N.Y. Rangers":
                 return 3
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Max, Min
+
+
+# Tables pointing at PlayerGame, with their foreign key fields
+player_game_references = [
+    ('PlayerGameStats', ['player_game']),
+    ('PlayerGameExpectedStats', ['player_game']),
+    ('PlayerGameValues', ['player_game']),
+    ('PlayerGameStartingGoalies', ['player_game']),
+    ('PlayerGameDraftKings', ['player_game']),
+    ('Lineup', ['centre1', 'centre2', 'winger1', 'winger2', 'winger3', 'defence1', 'defence2', 'goalie', 'util']),
+]
+
+
+def remove_duplicate_player_games(apps, schema_editor):
+    # Keep the first PlayerGame of each (player, game), move everything pointing at the others to it, then keep the
+    # latest stats and expected stats of each PlayerGame
+    PlayerGame = apps.get_model('lineups', 'PlayerGame')
+    duplicates = PlayerGame.objects.values('player_id', 'game_id').annotate(count=Count('id'), kept_id=Min('id')) \
+        .filter(count__gt=1)
+    for duplicate in duplicates:
+        duplicate_ids = list(PlayerGame.objects.filter(player_id=duplicate['player_id'], game_id=duplicate['game_id'])
+                             .exclude(id=duplicate['kept_id']).values_list('id', flat=True))
+        for model_name, fields in player_game_references:
+            try:
+                model = apps.get_model('lineups', model_name)
+            except LookupError:
+                # PlayerGameDraftKings has no table yet
+                continue
+            for field in fields:
+                model.objects.filter(**{field + '_id__in': duplicate_ids}).update(**{field + '_id': duplicate['kept_id']})
+        PlayerGame.objects.filter(id__in=duplicate_ids).delete()
+
+    for model_name in ['PlayerGameStats', 'PlayerGameExpectedStats']:
+        model = apps.get_model('lineups', model_name)
+        for duplicate in model.objects.values('player_game_id').annotate(count=Count('id'), kept_id=Max('id')) \
+                .filter(count__gt=1):
+            model.objects.filter(player_game_id=duplicate['player_game_id']).exclude(id=duplicate['kept_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lineups', '0017_playergamestartinggoalies'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_player_games, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lineups', '0018_remove_duplicate_player_games'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='playergame',
+            unique_together=set([('player', 'game')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='playergamestats',
+            unique_together=set([('player_game',)]),
+        ),
+    ]
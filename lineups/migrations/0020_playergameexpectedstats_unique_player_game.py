@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lineups', '0019_playergame_unique_player_game'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='playergameexpectedstats',
+            unique_together=set([('player_game',)]),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def get_aggregate_fields():
+    return [
+        ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+        ('season', models.IntegerField()),
+        ('games', models.IntegerField(default=0)),
+        ('goals', models.IntegerField(default=0)),
+        ('assists', models.IntegerField(default=0)),
+        ('shots_on_goal', models.IntegerField(default=0)),
+        ('blocked_shots', models.IntegerField(default=0)),
+        ('short_handed_points', models.IntegerField(default=0)),
+        ('hat_tricks', models.IntegerField(default=0)),
+        ('wins', models.IntegerField(default=0)),
+        ('saves', models.IntegerField(default=0)),
+        ('goals_against', models.IntegerField(default=0)),
+        ('shutouts', models.IntegerField(default=0)),
+        ('created', models.DateTimeField(auto_now_add=True)),
+        ('updated', models.DateTimeField(auto_now=True)),
+        ('player', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='lineups.Player')),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lineups', '0020_playergameexpectedstats_unique_player_game'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayerSeasonAggregate',
+            fields=get_aggregate_fields(),
+            options={
+                'unique_together': set([('player', 'season')]),
+            },
+        ),
+        migrations.CreateModel(
+            name='PlayerDailyAggregate',
+            fields=get_aggregate_fields() + [
+                ('date', models.DateField()),
+            ],
+            options={
+                'unique_together': set([('player', 'date')]),
+            },
+        ),
+    ]
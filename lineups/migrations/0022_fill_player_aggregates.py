@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.utils import timezone
+
+
+def get_aggregate_values(pgs):
+    # Same as get_aggregate_values in update_stats
+    return {'games': 1,
+            'goals': pgs.goals,
+            'assists': pgs.assists,
+            'shots_on_goal': pgs.shots,
+            'blocked_shots': pgs.blocked,
+            'short_handed_points': pgs.short_handed_goals + pgs.short_handed_assists,
+            'hat_tricks': int(pgs.goals >= 3),
+            'wins': int(pgs.decision == 'W'),
+            'saves': pgs.saves,
+            'goals_against': pgs.shots_against - pgs.saves,
+            'shutouts': int(pgs.decision == 'W' and pgs.shots_against == pgs.saves and pgs.time_on_ice > '59:30')}
+
+
+def fill_player_aggregates(apps, schema_editor):
+    # Totals of the regular season and playoff games already loaded, by player and season, and by player and day
+    PlayerGameStats = apps.get_model('lineups', 'PlayerGameStats')
+    PlayerSeasonAggregate = apps.get_model('lineups', 'PlayerSeasonAggregate')
+    PlayerDailyAggregate = apps.get_model('lineups', 'PlayerDailyAggregate')
+    season_totals = {}
+    daily_totals = {}
+    for pgs in PlayerGameStats.objects.select_related('player_game__game').iterator():
+        game = pgs.player_game.game
+        if game.game_pk // 10000 % 100 not in (2, 3):
+            continue
+        player_id = pgs.player_game.player_id
+        date = timezone.localtime(game.game_date).date()
+        for totals in [season_totals.setdefault((player_id, game.season), {}),
+                       daily_totals.setdefault((player_id, game.season, date), {})]:
+            for field, value in get_aggregate_values(pgs).items():
+                totals[field] = totals.get(field, 0) + value
+
+    PlayerSeasonAggregate.objects.bulk_create(
+        [PlayerSeasonAggregate(player_id=player_id, season=season, **totals)
+         for (player_id, season), totals in season_totals.items()], batch_size=500)
+    PlayerDailyAggregate.objects.bulk_create(
+        [PlayerDailyAggregate(player_id=player_id, season=season, date=date, **totals)
+         for (player_id, season, date), totals in daily_totals.items()], batch_size=500)
+
+
+def remove_player_aggregates(apps, schema_editor):
+    apps.get_model('lineups', 'PlayerSeasonAggregate').objects.all().delete()
+    apps.get_model('lineups', 'PlayerDailyAggregate').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lineups', '0021_playerseasonaggregate_playerdailyaggregate'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_player_aggregates, remove_player_aggregates),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lineups', '0022_fill_player_aggregates'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='player',
+            name='full_name',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='team',
+            name='location_name',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='game',
+            name='game_date',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='game',
+            index_together=set([('home_team', 'away_team', 'game_pk')]),
+        ),
+        migrations.AlterField(
+            model_name='playerline',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lineups', '0023_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playergamestats',
+            name='time_on_ice_seconds',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='playergamestats',
+            name='penalty_seconds',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='playergamestats',
+            name='even_time_on_ice_seconds',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='playergamestats',
+            name='power_play_time_on_ice_seconds',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='playergamestats',
+            name='short_handed_time_on_ice_seconds',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='playerseasonaggregate',
+            name='time_on_ice_seconds',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='playerdailyaggregate',
+            name='time_on_ice_seconds',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+
+from lineups.game_stats import get_seconds, is_aggregated_game, get_aggregate_values
+
+# Text fields of PlayerGameStats and the seconds field filled from each
+seconds_fields = [
+    ('time_on_ice', 'time_on_ice_seconds'),
+    ('penalty_minutes', 'penalty_seconds'),
+    ('even_time_on_ice', 'even_time_on_ice_seconds'),
+    ('power_play_time_on_ice', 'power_play_time_on_ice_seconds'),
+    ('short_handed_time_on_ice', 'short_handed_time_on_ice_seconds'),
+]
+rows_per_update = 500
+
+
+def fill_time_on_ice_seconds(apps, schema_editor):
+    # Seconds worked out in memory, then one UPDATE for every rows_per_update rows with each seconds field set from a
+    # CASE on the row ID
+    PlayerGameStats = apps.get_model('lineups', 'PlayerGameStats')
+    rows = list(PlayerGameStats.objects.values_list('id', *[field for field, seconds_field in seconds_fields]))
+    for start in range(0, len(rows), rows_per_update):
+        chunk = rows[start:start + rows_per_update]
+        PlayerGameStats.objects.filter(id__in=[row[0] for row in chunk]).update(**{
+            seconds_field: models.Case(*[models.When(id=row[0], then=models.Value(get_seconds(row[i + 1])))
+                                         for row in chunk], output_field=models.IntegerField())
+            for i, (field, seconds_field) in enumerate(seconds_fields)})
+
+
+def fill_player_aggregates(apps, schema_editor):
+    # The aggregates 0022 filled compared the time on ice as text (missing shutouts past 100 minutes in the playoffs)
+    # and had no time on ice, so they are deleted and added up again from the games already loaded
+    PlayerGameStats = apps.get_model('lineups', 'PlayerGameStats')
+    PlayerSeasonAggregate = apps.get_model('lineups', 'PlayerSeasonAggregate')
+    PlayerDailyAggregate = apps.get_model('lineups', 'PlayerDailyAggregate')
+    season_totals = {}
+    daily_totals = {}
+    for pgs in PlayerGameStats.objects.select_related('player_game__game').iterator():
+        game = pgs.player_game.game
+        if not is_aggregated_game(game):
+            continue
+        player_id = pgs.player_game.player_id
+        date = timezone.localtime(game.game_date).date()
+        for totals in [season_totals.setdefault((player_id, game.season), {}),
+                       daily_totals.setdefault((player_id, game.season, date), {})]:
+            for field, value in get_aggregate_values(pgs).items():
+                totals[field] = totals.get(field, 0) + value
+
+    PlayerSeasonAggregate.objects.all().delete()
+    PlayerDailyAggregate.objects.all().delete()
+    PlayerSeasonAggregate.objects.bulk_create(
+        [PlayerSeasonAggregate(player_id=player_id, season=season, **totals)
+         for (player_id, season), totals in season_totals.items()], batch_size=500)
+    PlayerDailyAggregate.objects.bulk_create(
+        [PlayerDailyAggregate(player_id=player_id, season=season, date=date, **totals)
+         for (player_id, season, date), totals in daily_totals.items()], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lineups', '0024_time_on_ice_seconds'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_time_on_ice_seconds, migrations.RunPython.noop),
+        migrations.RunPython(fill_player_aggregates, migrations.RunPython.noop),
+    ]
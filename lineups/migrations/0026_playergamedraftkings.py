@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lineups', '0025_fill_time_on_ice_seconds'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayerGameDraftKings',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name_and_id', models.CharField(max_length=100)),
+                ('draftkings_id', models.IntegerField()),
+                ('salary', models.IntegerField()),
+                ('position', models.CharField(max_length=100)),
+                ('draft_type', models.CharField(max_length=100)),
+                ('date_for_lineup', models.DateTimeField(db_index=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('player_game', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT,
+                                                  to='lineups.PlayerGame')),
+            ],
+        ),
+    ]
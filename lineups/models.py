@@ -1,5 +1,5 @@
 from django.db import models
-from lineups.managers import PlayerManager
+from lineups.managers import PlayerManager, GameManager, TeamManager
 
 
 class Team(models.Model):
@@ -7,7 +7,7 @@ class Team(models.Model):
     link = models.CharField(max_length=200)
     abbreviation = models.CharField(max_length=10)
     team_name = models.CharField(max_length=200)
-    location_name = models.CharField(max_length=200)
+    location_name = models.CharField(max_length=200, db_index=True)
     first_year_of_play = models.IntegerField()
     official_site_url = models.CharField(max_length=200)
     division_id = models.IntegerField()
@@ -18,6 +18,8 @@ class Team(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    objects = TeamManager()
+
     def __str__(self):
         return '%s' % (self.team_name)
 
@@ -51,7 +53,7 @@ class TeamStats(models.Model):
 
 class Player(models.Model):
     team = models.ForeignKey(Team, on_delete=models.PROTECT, null=True)
-    full_name = models.CharField(max_length=200)
+    full_name = models.CharField(max_length=200, db_index=True)
     link = models.CharField(max_length=400)
     first_name = models.CharField(max_length=200)
     last_name = models.CharField(max_length=200)
@@ -84,7 +86,7 @@ class Game(models.Model):
     link = models.CharField(max_length=400)
     game_type = models.CharField(max_length=10)
     season = models.IntegerField()
-    game_date = models.DateTimeField()
+    game_date = models.DateTimeField(db_index=True)
     status_code = models.IntegerField()
     away_team = models.ForeignKey(Team, on_delete=models.PROTECT, related_name="away_team")
     away_score = models.IntegerField()
@@ -93,6 +95,12 @@ class Game(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    objects = GameManager()
+
+    class Meta:
+        # Latest game between two teams (GameManager.get_game_pk_by_ids)
+        index_together = [["home_team", "away_team", "game_pk"]]
+
     def __str__(self):
         return '%s' % (self.game_pk)
 
@@ -119,6 +127,9 @@ class PlayerGame(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        unique_together = (("player", "game"),)
+
     def __str__(self):
         return '%s, %s' % (self.player, self.game)
 
@@ -126,6 +137,7 @@ class PlayerGame(models.Model):
 class PlayerGameStats(models.Model):
     player_game = models.ForeignKey(PlayerGame, on_delete=models.PROTECT)
     time_on_ice = models.CharField(max_length=50)
+    time_on_ice_seconds = models.IntegerField(default=0)
     assists = models.IntegerField()
     goals = models.IntegerField()
     shots = models.IntegerField(default=0)
@@ -133,6 +145,7 @@ class PlayerGameStats(models.Model):
     power_play_goals = models.IntegerField(default=0)
     power_play_assists = models.IntegerField(default=0)
     penalty_minutes = models.CharField(max_length=50, default="0:00")
+    penalty_seconds = models.IntegerField(default=0)
     faceoff_wins = models.IntegerField(default=0)
     faceoff_taken = models.IntegerField(default=0)
     takeaways = models.IntegerField(default=0)
@@ -142,8 +155,11 @@ class PlayerGameStats(models.Model):
     blocked = models.IntegerField(default=0)
     plus_minus = models.IntegerField(default=0)
     even_time_on_ice = models.CharField(max_length=50, default="0:00")
+    even_time_on_ice_seconds = models.IntegerField(default=0)
     power_play_time_on_ice = models.CharField(max_length=50, default="0:00")
+    power_play_time_on_ice_seconds = models.IntegerField(default=0)
     short_handed_time_on_ice = models.CharField(max_length=50, default="0:00")
+    short_handed_time_on_ice_seconds = models.IntegerField(default=0)
     shots_against = models.IntegerField(default=0)
     saves = models.IntegerField(default=0)
     power_play_saves = models.IntegerField(default=0)
@@ -156,6 +172,9 @@ class PlayerGameStats(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        unique_together = (("player_game",),)
+
     def __str__(self):
         return '%s: (%s, %,s) (goals, assists)' % (self.player_game, self.goals, self.assists)
 
@@ -176,10 +195,67 @@ class PlayerGameExpectedStats(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        unique_together = (("player_game",),)
+
     def __str__(self):
         return '%s: (%s, %,s) (goals, assists)' % (self.player_game, self.goals, self.assists)
 
 
+class PlayerSeasonAggregate(models.Model):
+    # Totals of a player's regular season and playoff games in a season, kept up to date as final games are loaded, so
+    # expected stats don't have to average the player's game stats again
+    player = models.ForeignKey(Player, on_delete=models.PROTECT)
+    season = models.IntegerField()
+    games = models.IntegerField(default=0)
+    goals = models.IntegerField(default=0)
+    assists = models.IntegerField(default=0)
+    shots_on_goal = models.IntegerField(default=0)
+    blocked_shots = models.IntegerField(default=0)
+    short_handed_points = models.IntegerField(default=0)
+    hat_tricks = models.IntegerField(default=0)
+    wins = models.IntegerField(default=0)
+    saves = models.IntegerField(default=0)
+    goals_against = models.IntegerField(default=0)
+    shutouts = models.IntegerField(default=0)
+    time_on_ice_seconds = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (("player", "season"),)
+
+    def __str__(self):
+        return '%s, %s: %s games' % (self.player, self.season, self.games)
+
+
+class PlayerDailyAggregate(models.Model):
+    # Same totals for the games of a player on one day, summed over the last few days for the recent form of a player
+    player = models.ForeignKey(Player, on_delete=models.PROTECT)
+    season = models.IntegerField()
+    date = models.DateField()
+    games = models.IntegerField(default=0)
+    goals = models.IntegerField(default=0)
+    assists = models.IntegerField(default=0)
+    shots_on_goal = models.IntegerField(default=0)
+    blocked_shots = models.IntegerField(default=0)
+    short_handed_points = models.IntegerField(default=0)
+    hat_tricks = models.IntegerField(default=0)
+    wins = models.IntegerField(default=0)
+    saves = models.IntegerField(default=0)
+    goals_against = models.IntegerField(default=0)
+    shutouts = models.IntegerField(default=0)
+    time_on_ice_seconds = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (("player", "date"),)
+
+    def __str__(self):
+        return '%s, %s: %s games' % (self.player, self.date, self.games)
+
+
 class PlayerGameValues(models.Model):
     player_game = models.ForeignKey(PlayerGame, on_delete=models.PROTECT)
     expected_value = models.FloatField(default=0.0)
@@ -203,23 +279,24 @@ class PlayerGameStartingGoalies(models.Model):
 class PlayerGameDraftKings(models.Model):
     player_game = models.ForeignKey(PlayerGame, on_delete=models.PROTECT)
     name_and_id = models.CharField(max_length=100)
-    id = models.IntegerField()
+    draftkings_id = models.IntegerField()
     salary = models.IntegerField()
     position = models.CharField(max_length=100)
     draft_type = models.CharField(max_length=100)
-    date_for_lineup = models.DateTimeField()
+    date_for_lineup = models.DateTimeField(db_index=True)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
     def __str__(self):
-        return '%s, (%s, %s, %,s) (id, position, salary)' % (self.player_game, self.id, self.position, self.salary)
+        return '%s, (%s, %s, %,s) (id, position, salary)' % (self.player_game, self.draftkings_id, self.position,
+                                                             self.salary)
 
 
 class PlayerLine(models.Model):
     player = models.ForeignKey(Player, on_delete=models.PROTECT)
     line = models.CharField(max_length=50)
     created = models.DateTimeField(auto_now_add=True)
-    updated = models.DateTimeField(auto_now=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return '%s, %s' % (self.player, self.line)
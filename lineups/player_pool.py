@@ -0,0 +1,142 @@
+import numpy as np
+
+__author__ = "jaredg"
+
+positions = ["G", "C", "W", "D"]
+position_codes = {position: code for code, position in enumerate(positions)}
+
+
+def get_id_array(ids, length):
+    if ids is None:
+        return np.full(length, -1, dtype=np.int64)
+    return np.asarray(ids, dtype=np.int64)
+
+
+class PlayerPool(object):
+    # Players for a slate kept as parallel arrays (name and ID, player ID, position code, salary weight and value),
+    # with the indexes of each position, so the solvers work on arrays instead of calling getters on every player.
+    # Team, opponent and line IDs (-1 when not known) are only used for stacking rules.
+    __slots__ = ["name_and_ids", "player_ids", "positions", "weights", "values", "team_ids", "opponent_ids",
+                 "line_ids", "position_indexes"]
+
+    def __init__(self, name_and_ids, player_ids, positions, weights, values, team_ids=None, opponent_ids=None,
+                 line_ids=None):
+        self.name_and_ids = np.asarray(name_and_ids, dtype=object)
+        self.player_ids = np.asarray(player_ids, dtype=np.int64)
+        self.positions = np.asarray(positions, dtype=np.int8)
+        self.weights = np.asarray(weights, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.team_ids = get_id_array(team_ids, len(self.name_and_ids))
+        self.opponent_ids = get_id_array(opponent_ids, len(self.name_and_ids))
+        self.line_ids = get_id_array(line_ids, len(self.name_and_ids))
+        self.position_indexes = {position: np.flatnonzero(self.positions == code)
+                                 for position, code in position_codes.items()}
+
+    @classmethod
+    def from_players(cls, players):
+        # Only place the getters are called, once per player for the slate
+        name_and_ids = []
+        player_ids = []
+        codes = []
+        weights = []
+        values = []
+        for player in players:
+            if player.get_position() not in position_codes:
+                raise ValueError("Unknown position for " + str(player.get_name_and_id()) + ": " + str(
+                    player.get_position()))
+            name_and_ids.append(player.get_name_and_id())
+            player_ids.append(-1 if player.get_player_id() is None else player.get_player_id())
+            codes.append(position_codes[player.get_position()])
+            weights.append(player.get_weight())
+            values.append(player.get_value())
+        return cls(name_and_ids, player_ids, codes, weights, values)
+
+    @classmethod
+    def concatenate(cls, pools):
+        return cls(np.concatenate([pool.name_and_ids for pool in pools]),
+                   np.concatenate([pool.player_ids for pool in pools]),
+                   np.concatenate([pool.positions for pool in pools]),
+                   np.concatenate([pool.weights for pool in pools]),
+                   np.concatenate([pool.values for pool in pools]),
+                   np.concatenate([pool.team_ids for pool in pools]),
+                   np.concatenate([pool.opponent_ids for pool in pools]),
+                   np.concatenate([pool.line_ids for pool in pools]))
+
+    def __len__(self):
+        return len(self.name_and_ids)
+
+    def __getitem__(self, index):
+        return PooledPlayer(self, index)
+
+    def __iter__(self):
+        return (PooledPlayer(self, index) for index in range(len(self)))
+
+    def subset(self, indexes):
+        # Copies the arrays (slices included), so changing values in the subset leaves this pool as is
+        indexes = np.arange(len(self))[indexes]
+        return PlayerPool(self.name_and_ids[indexes], self.player_ids[indexes], self.positions[indexes],
+                          self.weights[indexes], self.values[indexes], self.team_ids[indexes],
+                          self.opponent_ids[indexes], self.line_ids[indexes])
+
+    def get_position(self, position):
+        return self.subset(self.position_indexes[position])
+
+    def get_position_names(self):
+        return np.array(positions)[self.positions]
+
+    def sorted_by_value(self):
+        return self.subset(np.argsort(-self.values, kind='stable'))
+
+    def find(self, name_and_ids):
+        return np.flatnonzero(np.isin(self.name_and_ids, list(name_and_ids)))
+
+    def add_value(self, indexes, value):
+        self.values[indexes] += value
+
+
+class PooledPlayer(object):
+    # A single player of a pool, for the few places that need one player (the Util or a chosen set), reading and
+    # writing through to the pool arrays. Item access matches the set dicts used for goalies in the knapsack.
+    __slots__ = ["pool", "index"]
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+
+    def __getitem__(self, key):
+        if key == 'nameAndId':
+            return self.get_name_and_id()
+        elif key == 'weight':
+            return self.get_weight()
+        elif key == 'value':
+            return self.get_value()
+        elif key == 'position':
+            return self.get_position()
+        raise KeyError(key)
+
+    def get_name_and_id(self):
+        return self.pool.name_and_ids[self.index]
+
+    def get_player_id(self):
+        return self.pool.player_ids[self.index]
+
+    def get_position(self):
+        return positions[self.pool.positions[self.index]]
+
+    def get_weight(self):
+        return int(self.pool.weights[self.index])
+
+    def get_value(self):
+        return float(self.pool.values[self.index])
+
+    def get_team_id(self):
+        return self.pool.team_ids[self.index]
+
+    def get_opponent_id(self):
+        return self.pool.opponent_ids[self.index]
+
+    def add_value(self, value):
+        self.pool.values[self.index] += value
+
+    def as_pool(self):
+        return self.pool.subset([self.index])
@@ -0,0 +1,109 @@
+import logging
+import numpy as np
+
+__author__ = "jaredg"
+
+logger = logging.getLogger(__name__)
+
+# DraftKings NHL scoring, per unit of each expected stat (hat tricks and shutouts are found from the sampled goals)
+skater_points = {"goals": 3, "assists": 2, "shots_on_goal": 0.5, "blocked_shots": 0.5, "short_handed_points": 1,
+                 "shootout_goals": 0.2, "hat_tricks": 1.5}
+goalie_points = {"goals": 3, "assists": 2, "wins": 3, "saves": 0.2, "goals_against": -1, "shutouts": 2}
+
+# Fields read from PlayerGameExpectedStats
+expected_stat_fields = ["goals", "assists", "shots_on_goal", "blocked_shots", "short_handed_points", "shootout_goals",
+                        "wins", "saves", "goals_against"]
+
+
+def get_expected_stats(player_game_expected_stats, name_and_ids=None):
+    # Arrays of the expected stats, one entry per PlayerGameExpectedStats (select_related player_game__player to
+    # avoid a query for each), with the team and opponent of each player for the correlation between players
+    expected_stats = {field: [] for field in expected_stat_fields + ["team", "opponent", "is_goalie"]}
+    for stats in player_game_expected_stats:
+        for field in expected_stat_fields:
+            expected_stats[field].append(getattr(stats, field))
+        expected_stats["team"].append(stats.player_game.player.team_id)
+        expected_stats["opponent"].append(stats.player_game.opponent_id)
+        expected_stats["is_goalie"].append(stats.player_game.player.primary_position_abbr == "G")
+
+    expected_stats = {field: np.array(values) for field, values in expected_stats.items()}
+    if name_and_ids is not None:
+        expected_stats["name_and_ids"] = np.asarray(name_and_ids, dtype=object)
+    return expected_stats
+
+
+def get_team_indexes(expected_stats):
+    # Teams and opponents as indexes into the columns of the team factors
+    teams, indexes = np.unique(np.concatenate((expected_stats["team"], expected_stats["opponent"])),
+                               return_inverse=True)
+    number_of_players = len(expected_stats["team"])
+    return len(teams), indexes[:number_of_players], indexes[number_of_players:]
+
+
+def simulate_points(expected_stats, number_of_simulations, random_state, team_variance=0.2):
+    # DraftKings points for every player in every simulation, as a (simulations x players) matrix. Each team gets a
+    # gamma factor (mean 1) per simulation that scales the scoring of its skaters and the goals against of the goalie
+    # facing it, so players on the same team move together.
+    number_of_teams, teams, opponents = get_team_indexes(expected_stats)
+    team_factors = random_state.gamma(1.0 / team_variance, team_variance, (number_of_simulations, number_of_teams))
+    team_factor = team_factors[:, teams]
+    opponent_factor = team_factors[:, opponents]
+
+    goals = random_state.poisson(expected_stats["goals"] * team_factor)
+    points = goals * skater_points["goals"] + (goals >= 3) * skater_points["hat_tricks"]
+    points += random_state.poisson(expected_stats["assists"] * team_factor) * skater_points["assists"]
+    points += random_state.poisson(expected_stats["shots_on_goal"] * team_factor) * skater_points["shots_on_goal"]
+    points += random_state.poisson(expected_stats["blocked_shots"]) * skater_points["blocked_shots"]
+    points += random_state.poisson(expected_stats["short_handed_points"]) * skater_points["short_handed_points"]
+    points += random_state.poisson(expected_stats["shootout_goals"]) * skater_points["shootout_goals"]
+
+    # Goalies face shots from the opponent, each one saved with the expected save percentage
+    is_goalie = expected_stats["is_goalie"]
+    if is_goalie.any():
+        expected_shots = expected_stats["saves"][is_goalie] + expected_stats["goals_against"][is_goalie]
+        save_percentage = np.divide(expected_stats["saves"][is_goalie], expected_shots,
+                                    out=np.zeros(len(expected_shots)), where=expected_shots > 0)
+        shots = random_state.poisson(expected_shots * opponent_factor[:, is_goalie])
+        saves = random_state.binomial(shots, save_percentage)
+        goals_against = shots - saves
+        wins = random_state.random_sample(saves.shape) < expected_stats["wins"][is_goalie]
+        points[:, is_goalie] = goals[:, is_goalie] * goalie_points["goals"] + \
+                               random_state.poisson(expected_stats["assists"][is_goalie] *
+                                                    team_factor[:, is_goalie]) * goalie_points["assists"] + \
+                               saves * goalie_points["saves"] + \
+                               goals_against * goalie_points["goals_against"] + \
+                               wins * goalie_points["wins"] + \
+                               (goals_against == 0) * goalie_points["shutouts"]
+    return points
+
+
+def get_lineup_matrix(sets_of_players, name_and_ids):
+    # One row per lineup (the first 9 entries of each full set are the players), with a 1 for each player in it
+    indexes = {name_and_id: index for index, name_and_id in enumerate(name_and_ids)}
+    lineups = np.zeros((len(sets_of_players), len(name_and_ids)))
+    for i, set_of_players in enumerate(sets_of_players):
+        for name_and_id in set_of_players[:9]:
+            if name_and_id not in indexes:
+                raise ValueError("No expected stats for " + str(name_and_id) + ".")
+            lineups[i, indexes[name_and_id]] = 1
+    return lineups
+
+
+def simulate_lineups(expected_stats, sets_of_players, number_of_simulations=10000, seed=None, team_variance=0.2,
+                     chunk_size=1000):
+    # Scores of every lineup in every simulation, (simulations x lineups), from one matrix multiply per chunk of
+    # simulations, so only a chunk of the player points is held at once
+    random_state = np.random.RandomState(seed)
+    lineups = get_lineup_matrix(sets_of_players, expected_stats["name_and_ids"])
+    scores = np.empty((number_of_simulations, len(lineups)))
+    for start in range(0, number_of_simulations, chunk_size):
+        size = min(chunk_size, number_of_simulations - start)
+        scores[start:start + size] = simulate_points(expected_stats, size, random_state, team_variance) @ lineups.T
+
+    logging.debug("Simulated " + str(number_of_simulations) + " slates for " + str(len(lineups)) + " lineups.")
+    return scores
+
+
+def rank_lineups(scores, percentile=50):
+    # Order of the lineups, best first, by the given percentile of their simulated scores (higher for ceiling)
+    return np.argsort(-np.percentile(scores, percentile, axis=0), kind='stable')
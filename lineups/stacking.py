@@ -0,0 +1,52 @@
+import logging
+import numpy as np
+
+__author__ = "jaredg"
+
+logger = logging.getLogger(__name__)
+
+# Line combinations from dailyfaceoff (PlayerLine.line) are the position and line number, forwards on the same number
+# make up a line (C1, LW1, RW1) and defence on the same number a pair (LD1, RD1)
+line_group_positions = {"C": "F", "LW": "F", "RW": "F", "LD": "D", "RD": "D"}
+
+
+def get_line_group(line):
+    # Group of a PlayerLine.line within its team (e.g. "F1" for LW1), None for goalies, IR and power play units
+    position = line.rstrip("0123456789")
+    number = line[len(position):]
+    if position not in line_group_positions or not number:
+        return None
+    return line_group_positions[position] + number
+
+
+def get_line_ids(team_ids, lines):
+    # Number every (team, line group) so players can be compared on one integer, -1 for players without a line
+    line_ids = {}
+    ids = []
+    for team_id, line in zip(team_ids, lines):
+        line_group = get_line_group(line) if line else None
+        if line_group is None or team_id is None or team_id == -1:
+            ids.append(-1)
+        else:
+            ids.append(line_ids.setdefault((team_id, line_group), len(line_ids)))
+    return ids
+
+
+def get_stacking_masks(skaters, goalies, min_line_stack=0, avoid_opposing_goalie=False):
+    # Stacking rules as boolean masks over the skaters of the pools, computed once before solving:
+    #   lines, one row for each line with at least min_line_stack skaters, of the skaters on that line
+    #   facing_goalie, one row for each goalie, of the skaters playing against that goalie's team
+    stacking = {"min_line_stack": min_line_stack, "lines": None, "facing_goalie": None}
+    if min_line_stack > 1:
+        line_ids, counts = np.unique(skaters.line_ids[skaters.line_ids != -1], return_counts=True)
+        line_ids = line_ids[counts >= min_line_stack]
+        if len(line_ids) == 0:
+            raise ValueError("No line has " + str(min_line_stack) + " skaters to stack.")
+        stacking["lines"] = skaters.line_ids[None, :] == line_ids[:, None]
+    if avoid_opposing_goalie:
+        stacking["facing_goalie"] = (skaters.opponent_ids[None, :] == goalies.team_ids[:, None]) & \
+                                    (goalies.team_ids[:, None] != -1)
+
+    logging.debug("Stacking with " + str(0 if stacking["lines"] is None else len(stacking["lines"])) +
+                  " lines and " + ("opposing goalies avoided" if avoid_opposing_goalie else "any goalie"))
+    return stacking
@@ -1,3 +1,865 @@
-from django.test import TestCase
+import aiohttp
+import asyncio
+import collections
+import datetime
+import importlib
+import io
+import itertools
+import json
+import numpy as np
+import os
+import pytz
+import shutil
+import tempfile
+import threading
+import time
+from aiohttp import web
+from unittest import mock
+from benchmark import generate_slate, get_limit
+from game_feeds import iterate_game_feeds
+from integer_program import integer_program_portfolio, integer_program
+from knapsack import find_player_pair, find_player_triples, get_position_players, get_name_and_ids, knapsack, \
+    brute_force, triple_dtype, multi_choice_knapsack_array, multi_choice_knapsack_k_best
+from player_pool import PlayerPool
+from simulation import expected_stat_fields, simulate_lineups, rank_lineups
+from stacking import get_line_ids
 
-# Create your tests here.
+from django.apps import apps
+from django.core.management import call_command
+from django.db import transaction, connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from lineups.game_stats import aggregate_fields
+from lineups.http_cache import get_cached, store, cached_urlopen, set_fixture_dirs
+from lineups.management.commands.explain_queries import get_plan_nodes
+from lineups.management.commands.update_lineups import calculate_sets_of_players_in_parallel, lower_values, \
+    calculate_sets_of_players_in_one_pass
+from lineups.management.commands.update_stats import update_player_game_stats, upsert_player_game_stats, \
+    update_player_game_expected_stats, update_player_games_expected_stats
+from lineups.managers import identity_map_scope, get_identity_map
+from lineups.models import Player, Team, Game, PlayerGame, PlayerGameStats, PlayerSeasonAggregate, \
+    PlayerDailyAggregate, GameOdds, TeamStats, PlayerGameExpectedStats
+
+
+class SlatePlayer(object):
+    # Player with the getters and item access the solvers read, for slates built by hand
+    def __init__(self, name_and_id, position, weight, value):
+        self.name_and_id = name_and_id
+        self.position = position
+        self.weight = weight
+        self.value = value
+
+    def __getitem__(self, key):
+        return {"nameAndId": self.name_and_id, "position": self.position, "weight": self.weight,
+                "value": self.value}[key]
+
+    def get_name_and_id(self):
+        return self.name_and_id
+
+    def get_position(self):
+        return self.position
+
+    def get_weight(self):
+        return self.weight
+
+    def get_value(self):
+        return self.value
+
+
+def get_small_slate(seed, counts=(("C", 4), ("W", 5), ("D", 4), ("G", 2))):
+    # Few enough players to check every lineup, values roughly following salary
+    random_state = np.random.RandomState(seed)
+    players = []
+    for position, number_of_players in counts:
+        for i in range(number_of_players):
+            weight = int(random_state.randint(25, 90))
+            players.append(SlatePlayer(position + str(i) + " (" + str(len(players)) + ")", position, weight,
+                                       round(weight / 15.0 + random_state.gamma(2.0, 0.6), 2)))
+    return [player for player in players if player.position != "G"], \
+           [player for player in players if player.position == "G"]
+
+
+class IntegerProgramTests(SimpleTestCase):
+    def get_best_value(self, skaters, goalies, limit):
+        # Every 8 skaters filling 2 C, 3 W, 2 D and a Util, with every goalie
+        best_value = None
+        for chosen_skaters in itertools.combinations(skaters, 8):
+            positions = [skater.get_position() for skater in chosen_skaters]
+            if positions.count("C") < 2 or positions.count("W") < 3 or positions.count("D") < 2:
+                continue
+            for goalie in goalies:
+                if sum(skater.get_weight() for skater in chosen_skaters) + goalie['weight'] <= limit:
+                    value = sum(skater.get_value() for skater in chosen_skaters) + goalie['value']
+                    best_value = value if best_value is None else max(best_value, value)
+        return best_value
+
+    def test_matches_every_lineup(self):
+        # The best lineup of each slate is over the cap, so the salary row has to hold
+        for seed in range(5):
+            skaters, goalies = get_small_slate(seed)
+            set_of_players = integer_program(skaters, goalies, 520)[0]
+            self.assertLessEqual(set_of_players[9], 520)
+            self.assertEqual(len(set(set_of_players[:9])), 9)
+            self.assertAlmostEqual(set_of_players[10], self.get_best_value(skaters, goalies, 520))
+
+
+class BruteForceTests(SimpleTestCase):
+    def get_top_sets(self, skaters, goalies, util, limit, number_of_sets):
+        # Every set under the cap in the order brute_force checks them, best value first and on ties the first checked
+        position_players = {position: get_position_players(skaters, position) for position in ["D", "C", "W"]}
+        defensemen = find_player_pair(skaters, "D", vectorized=True)
+        centres = find_player_pair(skaters, "C", vectorized=True)
+        wingers = find_player_triples(skaters, "W", vectorized=True)
+        sets_of_players = []
+        for goalie, centre_pair, defence_pair, winger_triple in itertools.product(goalies, centres, defensemen,
+                                                                                   wingers):
+            weight = goalie['weight'] + centre_pair['weight'] + defence_pair['weight'] + winger_triple['weight'] + \
+                     util.get_weight()
+            value = goalie['value'] + centre_pair['value'] + defence_pair['value'] + winger_triple['value'] + \
+                    util.get_value()
+            if weight <= limit:
+                sets_of_players.append(get_name_and_ids(centre_pair, position_players["C"]) +
+                                       get_name_and_ids(winger_triple, position_players["W"]) +
+                                       get_name_and_ids(defence_pair, position_players["D"]) +
+                                       [goalie['nameAndId'], util.get_name_and_id(), int(weight), float(value)])
+        return sorted(sets_of_players, key=lambda set_of_players: -set_of_players[10])[:number_of_sets]
+
+    def test_top_sets_in_order(self):
+        # The last one asks for more sets than there are under the cap, so all 300 come back
+        for seed, number_of_sets, number_of_top_sets in [(0, 1, 1), (1, 10, 10), (2, 25, 25), (2, 1000, 300)]:
+            skaters, goalies = get_small_slate(seed, (("C", 5), ("W", 7), ("D", 5), ("G", 3)))
+            util = skaters.pop(0)
+            top_sets = self.get_top_sets(skaters, goalies, util, 520, number_of_sets)
+            self.assertEqual(len(top_sets), number_of_top_sets)
+            # Chunks of a single set, part of the sets and all of them at once
+            for max_chunk_size in [1, 7, 1000000]:
+                self.assertEqual(brute_force(skaters, goalies, util, 520, number_of_sets=number_of_sets,
+                                             max_chunk_size=max_chunk_size), top_sets)
+
+
+class BenchmarkCommandTests(SimpleTestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def test_appends_results(self):
+        output = os.path.join(self.output_dir, "benchmarks", "lineups.jsonl")
+        for i in range(2):
+            call_command('benchmark_lineups', '--games', '1', '--backends', 'knapsack_pruned', 'integer_program',
+                         '--output', output, stdout=io.StringIO())
+        with open(output) as output_file:
+            results = [json.loads(line) for line in output_file]
+        self.assertEqual([(result['games'], result['backend']) for result in results],
+                         [(1, 'knapsack_pruned'), (1, 'integer_program')] * 2)
+        for result in results:
+            self.assertIsNone(result['error'])
+            self.assertIn('commit', result)
+        # The integer program is exact, so the gaps are against its value
+        self.assertGreaterEqual(results[0]['optimality_gap'], 0)
+        self.assertEqual(results[1]['optimality_gap'], 0)
+
+
+def get_skater(player_id, goals=1):
+    return {"person": {"id": player_id}, "position": {"abbreviation": "C"},
+            "stats": {"skaterStats": {"timeOnIce": "15:30", "assists": 1, "goals": goals, "shots": 3, "hits": 1,
+                                      "powerPlayGoals": 0, "powerPlayAssists": 0, "penaltyMinutes": 2,
+                                      "faceOffWins": 1, "faceoffTaken": 2, "takeaways": 0, "giveaways": 0,
+                                      "shortHandedGoals": 0, "shortHandedAssists": 0, "blocked": 1, "plusMinus": 0,
+                                      "evenTimeOnIce": "12:00", "powerPlayTimeOnIce": "2:00",
+                                      "shortHandedTimeOnIce": "1:30"}}}
+
+
+def get_goalie(player_id, saves=30, decision="W", time_on_ice="60:00"):
+    return {"person": {"id": player_id}, "position": {"abbreviation": "G"},
+            "stats": {"goalieStats": {"timeOnIce": time_on_ice, "assists": 0, "goals": 0, "pim": 0, "shots": 30,
+                                      "saves": saves, "powerPlaySaves": 0, "shortHandedSaves": 0, "evenSaves": saves,
+                                      "shortHandedShotsAgainst": 0, "evenShotsAgainst": 30,
+                                      "powerPlayShotsAgainst": 0, "decision": decision}}}
+
+
+def get_feed(away_players, home_players):
+    return {"gameData": {"status": {"statusCode": "7"}},
+            "liveData": {"boxscore": {"teams": {
+                "away": {"team": {"id": 1}, "players": {"ID" + str(player["person"]["id"]): player
+                                                        for player in away_players}},
+                "home": {"team": {"id": 2}, "players": {"ID" + str(player["person"]["id"]): player
+                                                        for player in home_players}}}}}}
+
+
+class IngestionTestCase(TestCase):
+    # Two teams of two skaters and a goalie, playing two finished games
+    def setUp(self):
+        for team_id in [1, 2]:
+            team = Team.objects.create(id=team_id, name="Team " + str(team_id), link="",
+                                       abbreviation="T" + str(team_id), team_name="Team",
+                                       location_name="City " + str(team_id),
+                                       first_year_of_play=1917, official_site_url="", division_id=1, conference_id=1,
+                                       franchise_id=team_id, short_name="", active=True)
+            for number, position in enumerate(["C", "C", "G"]):
+                player_id = team_id * 10 + number
+                Player.objects.create(id=player_id, team=team, full_name="Player " + str(player_id), link="",
+                                      first_name="Player", last_name=str(player_id),
+                                      birth_date=datetime.datetime(1990, 1, 1, tzinfo=pytz.utc), birth_city="",
+                                      birth_country="", height="", active=True, rookie=False, roster_status="Y",
+                                      primary_position_abbr=position)
+        self.games = [Game.objects.create(game_pk=game_pk, link="", game_type="R", season=20162017,
+                                          game_date=datetime.datetime.now(pytz.utc) - datetime.timedelta(days=days),
+                                          status_code=7, away_team_id=1, away_score=1, home_team_id=2, home_score=2)
+                      for game_pk, days in [(2016020001, 3), (2016020002, 1)]]
+
+    def get_feed(self, goals=1, saves=30):
+        return get_feed([get_skater(10, goals), get_skater(11), get_goalie(12, saves, "L")],
+                        [get_skater(20), get_skater(21), get_goalie(22)])
+
+    def get_stats(self):
+        return sorted(PlayerGameStats.objects.values_list(
+            'player_game__player_id', 'player_game__game_id', 'player_game__opponent_id', 'goals', 'assists',
+            'shots', 'saves', 'decision', 'time_on_ice_seconds', 'penalty_seconds'))
+
+
+class GroupedExpectedStatsTests(IngestionTestCase):
+    def setUp(self):
+        super().setUp()
+        upsert_player_game_stats([(self.get_feed(goals=goals), game) for goals, game in zip([1, 3], self.games)])
+        for team_id, goals_against_per_game in [(1, 2.5), (2, 3.1)]:
+            TeamStats.objects.create(team_id=team_id, season_id=20162017, games_played=2, wins=1, ties=0, losses=1,
+                                     ot_losses=0, points=2, reg_plus_ot_wins=1, point_pctg=0.5, goals_for=4,
+                                     goals_against=5, goals_for_per_game=2,
+                                     goals_against_per_game=goals_against_per_game, pp_pctg=20, pk_pctg=80,
+                                     shots_for_per_game=30, shots_against_per_game=30, faceoff_win_pctg=50)
+        # A player without any games yet and the odds of a game still to come
+        Player.objects.create(id=13, team_id=1, full_name="Player 13", link="", first_name="Player", last_name="13",
+                              birth_date=datetime.datetime(1990, 1, 1, tzinfo=pytz.utc), birth_city="",
+                              birth_country="", height="", active=True, rookie=False, roster_status="Y",
+                              primary_position_abbr="D")
+        self.game = Game.objects.create(game_pk=2016020003, link="", game_type="R", season=20162017,
+                                        game_date=datetime.datetime.now(pytz.utc) + datetime.timedelta(days=1),
+                                        status_code=1, away_team_id=1, away_score=0, home_team_id=2, home_score=0)
+        GameOdds.objects.create(game=self.game, home_moneyline="-150", home_probability=0.6, away_moneyline="+130",
+                                away_probability=0.4, number_of_goals="5.5")
+
+    def get_expected_stats(self):
+        return sorted(PlayerGameExpectedStats.objects.filter(player_game__game=self.game).values_list(
+            'player_game__player_id', 'player_game__opponent_id', 'goals', 'assists', 'shots_on_goal',
+            'blocked_shots', 'short_handed_points', 'shootout_goals', 'hat_tricks', 'wins', 'saves', 'goals_against',
+            'shutouts'))
+
+    def test_matches_per_player(self):
+        with transaction.atomic():
+            update_player_game_expected_stats(self.game)
+            per_player = self.get_expected_stats()
+            transaction.set_rollback(True)
+        self.assertFalse(PlayerGameExpectedStats.objects.exists())
+
+        update_player_games_expected_stats([self.game])
+        self.assertEqual(len(per_player), 7)
+        self.assertNotEqual(per_player[0][2], 0)
+        self.assertEqual(self.get_expected_stats(), per_player)
+
+
+class ExplainQueriesTests(TestCase):
+    def setUp(self):
+        self.plans_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.plans_dir)
+
+    def test_lookups_use_indexes(self):
+        plans_file = os.path.join(self.plans_dir, "plans.json")
+        call_command('explain_queries', '--save', plans_file, stdout=io.StringIO())
+        output = io.StringIO()
+        call_command('explain_queries', '--compare', plans_file, stdout=output)
+        accesses = [line for line in output.getvalue().splitlines() if not line.startswith(' ')]
+        self.assertEqual(len(accesses), 6)
+        for access in accesses:
+            self.assertTrue(access.endswith(': index (unchanged)'), access)
+
+    def test_estimates_left_out(self):
+        plan = ["Limit  (cost=0.15..8.17 rows=1 width=120)",
+                "  ->  Index Scan Backward using lineups_game_home_team_id_away_team_id_game_pk_idx on lineups_game  "
+                "(cost=0.15..8.17 rows=1 width=120)",
+                "        Index Cond: ((home_team_id = 1) AND (away_team_id = 2))"]
+        estimated_again = [line.replace("0.15..8.17 rows=1", "0.29..16.31 rows=4") for line in plan]
+        scanned = ["Limit  (cost=0.00..35.50 rows=1 width=120)",
+                   "  ->  Seq Scan on lineups_game  (cost=0.00..35.50 rows=1 width=120)",
+                   "        Filter: ((home_team_id = 1) AND (away_team_id = 2))"]
+        self.assertEqual(get_plan_nodes(plan, 'postgresql'),
+                         ["Limit", "Index Scan Backward using lineups_game_home_team_id_away_team_id_game_pk_idx on "
+                                   "lineups_game"])
+        self.assertEqual(get_plan_nodes(estimated_again, 'postgresql'), get_plan_nodes(plan, 'postgresql'))
+        self.assertNotEqual(get_plan_nodes(scanned, 'postgresql'), get_plan_nodes(plan, 'postgresql'))
+
+
+def copy_slate(skaters, goalies):
+    return skaters.subset(slice(None)), goalies.subset(slice(None))
+
+
+class GameFeedsTests(SimpleTestCase):
+    # Feeds from a stub statsapi on 127.0.0.1, game 503 is unavailable for its first two requests and game 404 always
+    # missing
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.requests = collections.Counter()
+        app = web.Application()
+        app.router.add_get('/game/{game_pk}/feed/live', cls.get_feed)
+        cls.loop = asyncio.new_event_loop()
+        cls.runner = web.AppRunner(app)
+        cls.loop.run_until_complete(cls.runner.setup())
+        cls.loop.run_until_complete(web.TCPSite(cls.runner, '127.0.0.1', 0).start())
+        cls.base_url = 'http://127.0.0.1:' + str(cls.runner.addresses[0][1])
+        cls.thread = threading.Thread(target=cls.loop.run_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        asyncio.run_coroutine_threadsafe(cls.runner.cleanup(), cls.loop).result()
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+        cls.loop.close()
+        super().tearDownClass()
+
+    @classmethod
+    async def get_feed(cls, request):
+        game_pk = int(request.match_info['game_pk'])
+        cls.requests[game_pk] += 1
+        if game_pk == 404 or (game_pk == 503 and cls.requests[game_pk] <= 2):
+            return web.Response(status=game_pk)
+        return web.json_response({'gamePk': game_pk})
+
+    def setUp(self):
+        self.requests.clear()
+
+    def get_feeds(self, game_pks, **kwargs):
+        return iterate_game_feeds(game_pks, self.base_url, backoff=0.01, **kwargs)
+
+    def test_server_error_is_retried(self):
+        self.assertEqual(list(self.get_feeds([503])), [(503, b'{"gamePk": 503}')])
+        self.assertEqual(self.requests[503], 3)
+
+    def test_missing_feed_is_not_retried(self):
+        with self.assertRaises(aiohttp.ClientResponseError) as raised:
+            list(self.get_feeds([404]))
+        self.assertEqual(raised.exception.status, 404)
+        self.assertEqual(self.requests[404], 1)
+
+    def test_feeds_in_order(self):
+        game_pks = list(range(1, 21))
+        feeds = list(self.get_feeds(game_pks, concurrency=1, max_queued=2))
+        self.assertEqual(feeds, [(game_pk, json.dumps({'gamePk': game_pk}).encode()) for game_pk in game_pks])
+
+    def test_closing_stops_downloads(self):
+        feeds = self.get_feeds(list(range(1, 101)), concurrency=1, max_queued=1)
+        self.assertEqual(next(feeds), (1, b'{"gamePk": 1}'))
+        feeds.close()
+        self.assertFalse(any(thread.name == "game-feeds" for thread in threading.enumerate()))
+        self.assertLess(sum(self.requests.values()), 100)
+
+
+class PlayerSetTests(SimpleTestCase):
+    def test_vectorized_sets_match_loops(self):
+        skaters, goalies = generate_slate(2, seed=1)
+        for position, find_sets in [("C", find_player_pair), ("D", find_player_pair), ("W", find_player_triples)]:
+            players = get_position_players(skaters, position)
+            looped = find_sets(skaters, position)
+            vectorized = find_sets(skaters, position, vectorized=True)
+            self.assertEqual([player_set['nameAndId'] for player_set in looped],
+                             [get_name_and_ids(player_set, players) for player_set in vectorized])
+            self.assertEqual([player_set['weight'] for player_set in looped], list(vectorized['weight']))
+            self.assertEqual([player_set['value'] for player_set in looped], list(vectorized['value']))
+
+
+def solve(skaters, goalies, **kwargs):
+    # Best value skater as the Util, as calculate_lineups does
+    skaters = skaters.sorted_by_value()
+    return knapsack(skaters.subset(slice(1, None)), goalies, skaters[0], get_limit(), **kwargs)
+
+
+class PruneDominatedTests(SimpleTestCase):
+    def assertSameValues(self, sets_of_players, other_sets_of_players):
+        self.assertEqual(len(sets_of_players), len(other_sets_of_players))
+        for set_of_players, other_set_of_players in zip(sets_of_players, other_sets_of_players):
+            self.assertAlmostEqual(set_of_players[10], other_set_of_players[10])
+
+    def test_keeps_optimum(self):
+        for number_of_games, seed in [(1, 0), (2, 2), (3, 1)]:
+            skaters, goalies = generate_slate(number_of_games, seed)
+            self.assertSameValues(solve(skaters, goalies, vectorized=True, prune=True),
+                                  solve(skaters, goalies, vectorized=True))
+
+    def test_keeps_best_sets(self):
+        skaters, goalies = generate_slate(2, seed=0)
+        self.assertSameValues(solve(skaters, goalies, prune=True, number_of_sets=5),
+                              solve(skaters, goalies, number_of_sets=5))
+
+
+class ArrayKnapsackTests(SimpleTestCase):
+    def test_matches_loop(self):
+        for number_of_games, seed in [(1, 0), (2, 2), (3, 1)]:
+            skaters, goalies = generate_slate(number_of_games, seed)
+            self.assertEqual(solve(skaters, goalies, vectorized=True), solve(skaters, goalies))
+
+    def test_lowered_slate(self):
+        # Lowering the picks used to leave the table's best value on a lineup missing a position
+        skaters, goalies = generate_slate(3, seed=2)
+        for i in range(15):
+            set_of_players = solve(skaters, goalies, vectorized=True)[0]
+            self.assertLessEqual(set_of_players[9], get_limit())
+            self.assertEqual(len(set(set_of_players[:9])), 9)
+            lower_values(skaters, goalies, set_of_players, -0.3)
+
+
+class ParallelLineupTests(SimpleTestCase):
+    def test_matches_serial_rounds(self):
+        # Each round of two solves the two best skaters as Util with the same values, then lowers both lineups
+        skaters, goalies = generate_slate(2, seed=0)
+        in_parallel = list(calculate_sets_of_players_in_parallel(*copy_slate(skaters, goalies), limit=get_limit(),
+                                                                 number_of_lineups=4, lowering_value=-0.3,
+                                                                 workers=2))
+        serially = []
+        while len(serially) < 4:
+            round_sets = []
+            for util_index in np.argsort(-skaters.values, kind='stable')[:2]:
+                others = skaters.subset(np.arange(len(skaters)) != util_index).sorted_by_value()
+                round_sets.append(knapsack(others, goalies, skaters[util_index], get_limit()))
+            for set_of_players in round_sets:
+                lower_values(skaters, goalies, set_of_players[0], -0.3)
+            serially += round_sets
+        self.assertEqual(in_parallel, serially)
+
+
+class KBestKnapsackTests(SimpleTestCase):
+    def test_matches_brute_force(self):
+        for number_of_games, seed in [(1, 0), (2, 1)]:
+            skaters, goalies = generate_slate(number_of_games, seed)
+            k_best = solve(skaters, goalies, vectorized=True, number_of_sets=10)
+            skaters = skaters.sorted_by_value()
+            top_sets = brute_force(skaters.subset(slice(1, None)), goalies, skaters[0], get_limit(), number_of_sets=10)
+            self.assertEqual(len(k_best), 10)
+            for set_of_players, top_set in zip(k_best, top_sets):
+                self.assertAlmostEqual(set_of_players[10], top_set[10])
+                self.assertLessEqual(set_of_players[9], get_limit())
+
+
+class PlayerPoolTests(SimpleTestCase):
+    def test_from_players(self):
+        skaters, goalies = generate_slate(1, seed=0)
+        pool = PlayerPool.from_players(list(skaters))
+        for field in ["name_and_ids", "player_ids", "positions", "weights", "values"]:
+            self.assertEqual(list(getattr(pool, field)), list(getattr(skaters, field)))
+
+    def test_subset_copies_values(self):
+        skaters, goalies = generate_slate(1, seed=0)
+        values = skaters.values.copy()
+        subset = skaters.subset(slice(1, None))
+        subset.add_value([0], -1.0)
+        self.assertEqual(list(skaters.values), list(values))
+        self.assertEqual(subset.values[0], values[1] - 1.0)
+
+    def test_knapsack_matches_players(self):
+        # The pools give the same lineup as lists of players with getters
+        skaters, goalies = generate_slate(2, seed=0)
+        skaters = skaters.sorted_by_value()
+        self.assertEqual(knapsack(skaters.subset(slice(1, None)), goalies, skaters[0], get_limit()),
+                         knapsack(list(skaters)[1:], list(goalies), skaters[0], get_limit()))
+
+
+class SparseKnapsackTests(SimpleTestCase):
+    def test_matches_dense(self):
+        for number_of_games, seed, salary_divisor in [(1, 0, 100), (2, 2, 100), (3, 1, 100), (2, 0, 10)]:
+            skaters, goalies = generate_slate(number_of_games, seed, salary_divisor)
+            skaters = skaters.sorted_by_value()
+            limit = get_limit(salary_divisor)
+            sparse = knapsack(skaters.subset(slice(1, None)), goalies, skaters[0], limit, sparse=True)
+            dense = knapsack(skaters.subset(slice(1, None)), goalies, skaters[0], limit, vectorized=True)
+            self.assertAlmostEqual(sparse[0][10], dense[0][10])
+            self.assertLessEqual(sparse[0][9], limit)
+
+
+def get_all_triples(players):
+    # Every combination of three players, the triples streaming covers
+    triples = np.array(list(itertools.combinations(range(len(players)), 3)), dtype=np.intp)
+    set_of_players = np.empty(len(triples), dtype=triple_dtype)
+    set_of_players['players'] = triples
+    set_of_players['weight'] = players.weights[triples].sum(axis=1)
+    set_of_players['value'] = players.values[triples].sum(axis=1)
+    return set_of_players
+
+
+class StreamingKnapsackTests(SimpleTestCase):
+    def solve_dense(self, skaters, goalies, number_of_sets=1):
+        # The array knapsack over all the winger triples
+        skaters = skaters.sorted_by_value()
+        others = skaters.subset(slice(1, None))
+        position_players = {position: get_position_players(others, position) for position in ["D", "C", "W"]}
+        sets_by_position = [find_player_pair(others, "D", vectorized=True),
+                            find_player_pair(others, "C", vectorized=True), get_all_triples(position_players["W"])]
+        if number_of_sets > 1:
+            return multi_choice_knapsack_k_best(goalies, skaters[0], *sets_by_position, limit=get_limit(),
+                                                number_of_sets=number_of_sets, position_players=position_players)
+        return multi_choice_knapsack_array(goalies, skaters[0], *sets_by_position, limit=get_limit(),
+                                           position_players=position_players)
+
+    def test_matches_dense(self):
+        for number_of_games, seed in [(1, 0), (2, 2), (3, 1)]:
+            skaters, goalies = generate_slate(number_of_games, seed)
+            self.assertAlmostEqual(solve(skaters, goalies, streaming=True)[0][10],
+                                   self.solve_dense(skaters, goalies)[0][10])
+
+    def test_matches_dense_best_sets(self):
+        skaters, goalies = generate_slate(2, seed=1)
+        streamed = solve(skaters, goalies, streaming=True, number_of_sets=5)
+        dense = self.solve_dense(skaters, goalies, number_of_sets=5)
+        self.assertEqual(len(streamed), 5)
+        for set_of_players, dense_set_of_players in zip(streamed, dense):
+            self.assertAlmostEqual(set_of_players[10], dense_set_of_players[10])
+
+
+class PortfolioTests(SimpleTestCase):
+    def test_exposure_and_unique_players(self):
+        skaters, goalies = generate_slate(2, seed=0)
+        sets_of_players = list(integer_program_portfolio(skaters, goalies, get_limit(), 6, max_exposure=0.5,
+                                                         min_unique=2))
+        self.assertEqual(len(sets_of_players), 6)
+        exposures = collections.Counter(name_and_id for set_of_players in sets_of_players
+                                        for name_and_id in set_of_players[:9])
+        self.assertLessEqual(max(exposures.values()), 3)
+        for set_of_players, other_set_of_players in itertools.combinations(sets_of_players, 2):
+            self.assertLessEqual(len(set(set_of_players[:9]) & set(other_set_of_players[:9])), 7)
+        for set_of_players in sets_of_players:
+            self.assertEqual(len(set(set_of_players[:9])), 9)
+            self.assertLessEqual(set_of_players[9], get_limit())
+
+
+def get_stacking_slate(number_of_games, seed):
+    # The generated slate with team 0 playing team 1, 2 playing 3 and so on, and the lines from the position numbers
+    # (C0, W0 and W1 on the first line, D0 and D1 on the first pair)
+    pools = []
+    for pool in generate_slate(number_of_games, seed):
+        team_ids = []
+        lines = []
+        for name_and_id in pool.name_and_ids:
+            team, player = name_and_id.split()[:2]
+            team_ids.append(int(team[len("Team"):]))
+            position, number = player[0], int(player[1:])
+            if position == "C":
+                lines.append("C" + str(number + 1))
+            elif position in "WD":
+                lines.append(("L" if number % 2 == 0 else "R") + position + str(number // 2 + 1))
+            else:
+                lines.append("G")
+        team_ids = np.array(team_ids)
+        pools.append(PlayerPool(pool.name_and_ids, pool.player_ids, pool.positions, pool.weights, pool.values, team_ids,
+                                team_ids ^ 1, get_line_ids(team_ids, lines)))
+    return pools
+
+
+class StackingTests(SimpleTestCase):
+    def get_players(self, skaters, set_of_players):
+        return skaters.find(set_of_players[:9])
+
+    def test_line_stack(self):
+        skaters, goalies = get_stacking_slate(2, seed=0)
+        set_of_players = integer_program(skaters, goalies, get_limit(), {"min_line_stack": 3})[0]
+        line_ids = skaters.line_ids[self.get_players(skaters, set_of_players)]
+        self.assertGreaterEqual(max(collections.Counter(line_ids[line_ids != -1]).values()), 3)
+
+    def test_opposing_goalie(self):
+        skaters, goalies = get_stacking_slate(3, seed=1)
+        stacking_rules = {"avoid_opposing_goalie": True}
+        for set_of_players in [integer_program(skaters, goalies, get_limit(), stacking_rules)[0],
+                               solve(skaters, goalies, stacking_rules=stacking_rules)[0]]:
+            goalie_team_id = goalies.team_ids[goalies.find([set_of_players[7]])[0]]
+            opponent_ids = skaters.opponent_ids[self.get_players(skaters, set_of_players)]
+            self.assertEqual(len(opponent_ids), 8)
+            self.assertNotIn(goalie_team_id, opponent_ids)
+
+    def assertDistinctLineups(self, sets_of_players, number_of_lineups):
+        self.assertEqual(len(sets_of_players), number_of_lineups)
+        self.assertEqual(len(set(frozenset(set_of_players[0][:9]) for set_of_players in sets_of_players)),
+                         number_of_lineups)
+
+    def test_line_stack_in_parallel(self):
+        # Every worker used to get the same lineup back from the integer program
+        skaters, goalies = get_stacking_slate(2, seed=0)
+        self.assertDistinctLineups(list(calculate_sets_of_players_in_parallel(
+            skaters, goalies, get_limit(), 4, -0.3, workers=2, type="integer_program",
+            stacking_rules={"min_line_stack": 2})), 4)
+
+    def test_line_stack_in_one_pass(self):
+        skaters, goalies = get_stacking_slate(2, seed=0)
+        self.assertDistinctLineups(list(calculate_sets_of_players_in_one_pass(
+            skaters, goalies, get_limit(), 5, type="integer_program", stacking_rules={"min_line_stack": 2})), 5)
+
+    def brute_force_opposing_goalie(self, skaters, goalies):
+        # Best value over every goalie with every D pair, C pair and W triple that has no skater against it
+        skaters = skaters.sorted_by_value()
+        util = skaters[0]
+        others = skaters.subset(slice(1, None))
+        position_players = {position: get_position_players(others, position) for position in ["D", "C", "W"]}
+        all_sets = {"D": find_player_pair(others, "D", vectorized=True),
+                    "C": find_player_pair(others, "C", vectorized=True), "W": get_all_triples(position_players["W"])}
+        best_value = -np.inf
+        for i in range(len(goalies)):
+            if goalies.team_ids[i] == util.get_opponent_id():
+                continue
+            sets = {position: set_of_players[~(position_players[position].opponent_ids == goalies.team_ids[i])[
+                set_of_players['players']].any(axis=1)] for position, set_of_players in all_sets.items()}
+            weight = goalies.weights[i] + util.get_weight() + sets["D"]['weight'][:, None] + \
+                sets["W"]['weight'][None, :]
+            value = goalies.values[i] + util.get_value() + sets["D"]['value'][:, None] + sets["W"]['value'][None, :]
+            for centres in sets["C"]:
+                fits = weight + centres['weight'] <= get_limit()
+                if fits.any():
+                    best_value = max(best_value, (value + centres['value'])[fits].max())
+        return best_value
+
+    def test_streamed_opposing_goalie(self):
+        # The streamed triples used to be pruned before the ones against each goalie were taken out
+        stacking_rules = {"avoid_opposing_goalie": True}
+        for seed in [0, 2, 6]:
+            skaters, goalies = get_stacking_slate(2, seed)
+            self.assertAlmostEqual(solve(skaters, goalies, streaming=True, stacking_rules=stacking_rules)[0][10],
+                                   self.brute_force_opposing_goalie(skaters, goalies))
+
+
+class SimulationTests(SimpleTestCase):
+    def get_expected_stats(self):
+        # Two lineups of eight skaters and a goalie, the players of the second expected to do twice as well
+        expected_stats = {field: np.zeros(18) for field in expected_stat_fields}
+        for field, value in [("goals", 0.3), ("assists", 0.4), ("shots_on_goal", 2.5), ("blocked_shots", 1.0)]:
+            expected_stats[field] = np.r_[np.full(9, value), np.full(9, 2 * value)]
+        expected_stats["is_goalie"] = np.arange(18) % 9 == 8
+        for field, value in [("saves", 25.0), ("goals_against", 3.0), ("wins", 0.4)]:
+            expected_stats[field] = np.where(expected_stats["is_goalie"], value, 0.0)
+        expected_stats["goals"][expected_stats["is_goalie"]] = 0
+        expected_stats["team"] = np.r_[np.full(9, 1), np.full(9, 2)]
+        expected_stats["opponent"] = np.r_[np.full(9, 3), np.full(9, 4)]
+        expected_stats["name_and_ids"] = np.array(["Player " + str(i) for i in range(18)], dtype=object)
+        sets_of_players = [list(expected_stats["name_and_ids"][:9]) + [0, 0],
+                           list(expected_stats["name_and_ids"][9:]) + [0, 0]]
+        return expected_stats, sets_of_players
+
+    def test_seeded(self):
+        expected_stats, sets_of_players = self.get_expected_stats()
+        scores = simulate_lineups(expected_stats, sets_of_players, 2000, seed=1)
+        self.assertEqual(scores.shape, (2000, 2))
+        self.assertTrue((scores == simulate_lineups(expected_stats, sets_of_players, 2000, seed=1)).all())
+
+    def test_rank(self):
+        expected_stats, sets_of_players = self.get_expected_stats()
+        scores = simulate_lineups(expected_stats, sets_of_players, 2000, seed=1)
+        for percentile in [10, 50, 90]:
+            self.assertEqual(list(rank_lineups(scores, percentile)), [1, 0])
+
+    def test_unknown_player(self):
+        expected_stats, sets_of_players = self.get_expected_stats()
+        with self.assertRaises(ValueError):
+            simulate_lineups(expected_stats, [["Someone else"] * 9 + [0, 0]], 10)
+
+
+class HttpCacheTests(SimpleTestCase):
+    schedule_url = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2017-01-01&endDate=2017-01-01'
+    feed_url = 'https://statsapi.web.nhl.com/api/v1/game/2016020001/feed/live'
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def get_cached_later(self, url, seconds):
+        with mock.patch('lineups.http_cache.time.time', return_value=time.time() + seconds):
+            return get_cached(url, self.cache_dir)
+
+    def test_entry_expires(self):
+        store(self.schedule_url, b'{"dates": []}', self.cache_dir)
+        self.assertEqual(get_cached(self.schedule_url, self.cache_dir), b'{"dates": []}')
+        self.assertEqual(self.get_cached_later(self.schedule_url, 4 * 60), b'{"dates": []}')
+        self.assertIsNone(self.get_cached_later(self.schedule_url, 6 * 60))
+
+    def test_final_game_feed_kept(self):
+        live = json.dumps({'gameData': {'status': {'statusCode': "3"}}}).encode()
+        final = json.dumps({'gameData': {'status': {'statusCode': "7"}}}).encode()
+        store(self.feed_url, live, self.cache_dir)
+        self.assertIsNone(self.get_cached_later(self.feed_url, 2 * 60))
+        store(self.feed_url, final, self.cache_dir)
+        self.assertEqual(self.get_cached_later(self.feed_url, 365 * 24 * 60 * 60), final)
+
+    def test_same_body_stored_once(self):
+        store(self.schedule_url, b'{}', self.cache_dir)
+        store(self.feed_url, b'{}', self.cache_dir)
+        objects = [name for path, directories, names in os.walk(os.path.join(self.cache_dir, 'objects'))
+                   for name in names]
+        self.assertEqual(len(objects), 1)
+
+
+class FixtureTests(SimpleTestCase):
+    feed_url = 'https://statsapi.web.nhl.com/api/v1/game/2016020001/feed/live'
+
+    def setUp(self):
+        self.fixture_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.fixture_dir)
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.addCleanup(set_fixture_dirs)
+
+    def test_replay(self):
+        os.makedirs(os.path.join(self.fixture_dir, 'feeds'))
+        with open(os.path.join(self.fixture_dir, 'feeds', '2016020001.json'), 'wb') as f:
+            f.write(b'{"gamePk": 2016020001}')
+        set_fixture_dirs(replay=self.fixture_dir)
+        with mock.patch('lineups.http_cache.urllib.request.urlopen') as urlopen:
+            self.assertEqual(cached_urlopen(self.feed_url), b'{"gamePk": 2016020001}')
+            with self.assertRaises(OSError):
+                cached_urlopen('https://statsapi.web.nhl.com/api/v1/game/2016020002/feed/live')
+        urlopen.assert_not_called()
+
+    def test_capture(self):
+        set_fixture_dirs(capture=self.fixture_dir)
+        with mock.patch('lineups.http_cache.urllib.request.urlopen') as urlopen:
+            urlopen.return_value.read.return_value = b'{"gamePk": 2016020001}'
+            cached_urlopen(self.feed_url, self.cache_dir)
+        with open(os.path.join(self.fixture_dir, 'feeds', '2016020001.json'), 'rb') as f:
+            self.assertEqual(f.read(), b'{"gamePk": 2016020001}')
+
+
+class BatchedIngestionTests(IngestionTestCase):
+    def test_matches_per_game(self):
+        with transaction.atomic():
+            for game in self.games:
+                update_player_game_stats(self.get_feed(), game)
+            per_game = self.get_stats()
+            transaction.set_rollback(True)
+        self.assertFalse(PlayerGame.objects.exists())
+
+        with identity_map_scope():
+            upsert_player_game_stats([(self.get_feed(), game) for game in self.games])
+        self.assertEqual(len(per_game), 12)
+        self.assertEqual(self.get_stats(), per_game)
+
+
+class IdempotentIngestionTests(IngestionTestCase):
+    def get_aggregates(self):
+        return (sorted(PlayerSeasonAggregate.objects.values_list('player_id', 'season', 'games', 'goals', 'saves',
+                                                                 'wins', 'time_on_ice_seconds', 'updated')),
+                sorted(PlayerDailyAggregate.objects.values_list('player_id', 'date', 'games', 'goals', 'saves',
+                                                                'wins', 'time_on_ice_seconds', 'updated')))
+
+    def test_reingest_adds_nothing(self):
+        upsert_player_game_stats([(self.get_feed(), game) for game in self.games])
+        stats = list(PlayerGameStats.objects.order_by('id').values())
+        aggregates = self.get_aggregates()
+        self.assertEqual(len(aggregates[0]), 6)
+
+        upsert_player_game_stats([(self.get_feed(), game) for game in self.games])
+        self.assertEqual(PlayerGame.objects.count(), 12)
+        self.assertEqual(list(PlayerGameStats.objects.order_by('id').values()), stats)
+        self.assertEqual(self.get_aggregates(), aggregates)
+
+
+class AggregateDeltaTests(IngestionTestCase):
+    def get_totals(self, model, **filters):
+        return model.objects.filter(**filters).values_list('games', 'goals', 'saves', 'goals_against')[0]
+
+    def test_changed_stats_move_aggregates(self):
+        upsert_player_game_stats([(self.get_feed(), game) for game in self.games])
+        first_date, second_date = [game.game_date.date() for game in self.games]
+        season = [self.get_totals(PlayerSeasonAggregate, player_id=player_id) for player_id in [10, 12]]
+        first_day = [self.get_totals(PlayerDailyAggregate, player_id=player_id, date=first_date)
+                     for player_id in [10, 12]]
+        second_day = [self.get_totals(PlayerDailyAggregate, player_id=player_id, date=second_date)
+                      for player_id in [10, 12]]
+
+        # Three more goals for player 10 and four fewer saves for goalie 12 in the second game
+        upsert_player_game_stats([(self.get_feed(goals=4, saves=26), self.games[1])])
+        self.assertEqual([self.get_totals(PlayerSeasonAggregate, player_id=player_id) for player_id in [10, 12]],
+                         [(season[0][0], season[0][1] + 3, season[0][2], season[0][3]),
+                          (season[1][0], season[1][1], season[1][2] - 4, season[1][3] + 4)])
+        self.assertEqual([self.get_totals(PlayerDailyAggregate, player_id=player_id, date=first_date)
+                          for player_id in [10, 12]], first_day)
+        self.assertEqual([self.get_totals(PlayerDailyAggregate, player_id=player_id, date=second_date)
+                          for player_id in [10, 12]],
+                         [(second_day[0][0], second_day[0][1] + 3, second_day[0][2], second_day[0][3]),
+                          (second_day[1][0], second_day[1][1], second_day[1][2] - 4, second_day[1][3] + 4)])
+
+
+class ShutoutTests(IngestionTestCase):
+    def get_shutouts(self, time_on_ice, game_pk=2016020003):
+        game = Game.objects.create(game_pk=game_pk, link="", game_type="R", season=20162017,
+                                   game_date=datetime.datetime.now(pytz.utc), status_code=7, away_team_id=1,
+                                   away_score=0, home_team_id=2, home_score=1)
+        feed = get_feed([get_skater(10), get_goalie(12, 29, "L")],
+                        [get_skater(20), get_goalie(22, 30, "W", time_on_ice)])
+        upsert_player_game_stats([(feed, game)])
+        return PlayerSeasonAggregate.objects.get(player_id=22).shutouts
+
+    def test_playoff_overtime(self):
+        # Compared as text "105:12" is less than "59:30"
+        self.assertEqual(self.get_shutouts("105:12", game_pk=2016030001), 1)
+
+    def test_pulled_goalie(self):
+        self.assertEqual(self.get_shutouts("59:45"), 1)
+        self.assertEqual(PlayerSeasonAggregate.objects.get(player_id=22).time_on_ice_seconds, 59 * 60 + 45)
+
+    def test_relieved_goalie(self):
+        self.assertEqual(self.get_shutouts("59:00"), 0)
+
+
+class FillAggregatesTests(IngestionTestCase):
+    def get_aggregates(self):
+        return (sorted(PlayerSeasonAggregate.objects.values_list('player_id', 'season', *aggregate_fields)),
+                sorted(PlayerDailyAggregate.objects.values_list('player_id', 'date', *aggregate_fields)))
+
+    def test_matches_ingestion(self):
+        upsert_player_game_stats([(self.get_feed(), game) for game in self.games])
+        stats = self.get_stats()
+        aggregates = self.get_aggregates()
+        self.assertEqual(len(aggregates[1]), 12)
+
+        # As left by 0022 and 0024, seconds not filled and aggregates from the text time on ice
+        PlayerGameStats.objects.update(time_on_ice_seconds=0, penalty_seconds=0, even_time_on_ice_seconds=0,
+                                       power_play_time_on_ice_seconds=0, short_handed_time_on_ice_seconds=0)
+        PlayerSeasonAggregate.objects.update(shutouts=0, time_on_ice_seconds=0)
+        PlayerDailyAggregate.objects.filter(player_id=10).delete()
+
+        migration = importlib.import_module('lineups.migrations.0025_fill_time_on_ice_seconds')
+        with mock.patch.object(migration, 'rows_per_update', 5):
+            migration.fill_time_on_ice_seconds(apps, None)
+        migration.fill_player_aggregates(apps, None)
+        self.assertEqual(self.get_stats(), stats)
+        self.assertEqual(self.get_aggregates(), aggregates)
+
+
+class IdentityMapTests(IngestionTestCase):
+    def test_lookups_from_memory(self):
+        with identity_map_scope():
+            with CaptureQueriesContext(connection) as first:
+                Player.objects.get_player(10)
+                Team.objects.get_team(1)
+            with CaptureQueriesContext(connection) as rest:
+                self.assertEqual([Player.objects.get_player(player_id).full_name for player_id in [10, 11, 21]],
+                                 ["Player 10", "Player 11", "Player 21"])
+                self.assertEqual(Player.objects.get_player_id_by_name("Player 22"), 22)
+                self.assertIsNone(Player.objects.get_player(99))
+                self.assertEqual(Team.objects.get_team(2).location_name, "City 2")
+                self.assertRaises(Team.DoesNotExist, Team.objects.get_team, 99)
+        self.assertEqual(len(first.captured_queries), 2)
+        self.assertEqual(len(rest.captured_queries), 0)
+        self.assertIsNone(get_identity_map())
+
+    def test_saves_and_deletes(self):
+        with identity_map_scope():
+            Player.objects.get_player(10)
+            player = Player.objects.get(pk=11)
+            player.full_name = "Renamed Player"
+            player.save()
+            Player.objects.create(id=30, team_id=1, full_name="New Player", link="", first_name="New",
+                                  last_name="Player", birth_date=datetime.datetime(1990, 1, 1, tzinfo=pytz.utc),
+                                  birth_city="", birth_country="", height="", active=True, rookie=False,
+                                  roster_status="Y", primary_position_abbr="C")
+            Player.objects.get(pk=21).delete()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(Player.objects.get_player(11).full_name, "Renamed Player")
+                self.assertEqual(Player.objects.get_player_id_by_name("Renamed Player"), 11)
+                self.assertEqual(Player.objects.get_player(30).full_name, "New Player")
+                self.assertEqual(Player.objects.get_player_id_by_name("New Player"), 30)
+                self.assertIsNone(Player.objects.get_player(21))
+            self.assertEqual(len(queries.captured_queries), 0)